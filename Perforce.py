@@ -24,48 +24,696 @@
 import sublime
 import sublime_plugin
 
+import copy
 import os
 import stat
 import subprocess
 import tempfile
 import threading
+import time
+import re
+import signal
+import codecs
 import json
+import hashlib
+import marshal
+import struct
+import difflib
 import sys
 try:
     from Queue import Queue, Empty
 except ImportError:
     from queue import Queue, Empty  # python 3.x
+from collections import deque
+
+# a reload runs this module again in the same module object, the background threads and timers of the previous run
+# are stopped before new ones are created
+if(hasattr(sys.modules.get(__name__), 'StopBackgroundServices')):
+    sys.modules[__name__].StopBackgroundServices()
 # Plugin Settings are located in 'perforce.sublime-settings' make a copy in the User folder to keep changes
 
-# global variable used when calling p4 - it stores the path of the file in the current view, used to determine with P4CONFIG to use
+# folder of the file in the last selected view, window commands use it when their window has no file opened
 # whenever a view is selected, the variable gets updated
-global_folder = ''
+last_activated_folder = ''
 
 class PerforceP4CONFIGHandler(sublime_plugin.EventListener):  
     def on_activated(self, view):
         if view.file_name():
-            global global_folder
-            global_folder, filename = os.path.split(view.file_name())
+            global last_activated_folder
+            last_activated_folder, filename = os.path.split(view.file_name())
+            workspace_prefetcher.Request(last_activated_folder)
+        ShowConnectionStatus(view)
 
 # Executed at startup to store the path of the plugin... necessary to open files relative to the plugin
 perforceplugin_dir = os.getcwdu()
 
-command_prefix = ""
-def PrepareCommand():
+# Environment section
+# the environment p4 runs in is captured once from the sourced profile and reused for every call, the profile
+# is only sourced again when the settings change or when the environment is refreshed on demand
+perforce_environment = None
+perforce_environment_lock = threading.Lock()
+
+def CaptureEnvironment():
     perforce_settings = sublime.load_settings('Perforce.sublime-settings')
     p4Env = perforce_settings.get('perforce_p4env')
-    global command_prefix
-    command_prefix = ''
+    sourcecommand = ''
     if(p4Env and p4Env != ''):
-        command_prefix = 'source ' + p4Env + ' && '
+        sourcecommand = '. ' + p4Env
     elif(sublime.platform() == "osx"):
-        command_prefix = 'source ~/.bash_profile && '
-    # Revert change until threading is fixed
-    # command_prefix = getPerforceConfigFromPreferences(command)
+        sourcecommand = '. ~/.bash_profile'
+
+    environment = dict(os.environ)
+    if(not sourcecommand):
+        return environment
+
+    p = subprocess.Popen(sourcecommand + ' && env', stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    result, err = p.communicate()
+    if(p.returncode != 0):
+        WarnUser("Unable to source the environment: " + err.strip())
+        return environment
+
+    environment = {}
+    name = None
+    for line in result.splitlines():
+        match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)=(.*)$', line)
+        if(match):
+            name = match.group(1)
+            environment[name] = match.group(2)
+        elif(name): # multi-line value
+            environment[name] += '\n' + line
+    return environment
+
+def GetPerforceEnvironment():
+    global perforce_environment
+    perforce_environment_lock.acquire()
+    try:
+        if(perforce_environment is None):
+            perforce_environment = CaptureEnvironment()
+        return perforce_environment
+    finally:
+        perforce_environment_lock.release()
+
+def RefreshPerforceEnvironment():
+    global perforce_environment
+    perforce_environment_lock.acquire()
+    try:
+        perforce_environment = None
+    finally:
+        perforce_environment_lock.release()
+    threading.Thread(target=GetPerforceEnvironment).start()
+
+# Telemetry section
+# every p4 process is measured: wall time, size of its output and whether it failed are recorded per p4 subcommand
+# and per plugin command (the origin of the context it runs with, all the calls made with one context being one
+# invocation). Totals cover the whole session, percentiles the most recent samples. When a trace log is set in
+# the settings, each call is also appended to it as a line of JSON
+class StatsSeries(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.processes = 0
+        self.outbytes = 0
+        self.errbytes = 0
+        self.samples = deque(maxlen=500)
+
+    def Percentile(self, in_percent):
+        durations = sorted([sample['time'] for sample in self.samples])
+        if(not durations):
+            return 0.0
+        return durations[min(len(durations) - 1, int(len(durations) * in_percent / 100.0))]
+
+class PerforceStats(object):
+    def __init__(self):
+        self.p4commands = {}
+        self.plugincommands = {}
+        self.lock = threading.Lock()
+        self.starttime = time.time()
+
+    def RecordP4Call(self, in_context, in_arguments, in_duration, in_outbytes, in_errbytes, in_error):
+        subcommand = GetP4Subcommand(in_arguments)
+        self.lock.acquire()
+        try:
+            series = self.p4commands.setdefault(subcommand, StatsSeries())
+            series.count += 1
+            series.processes += 1
+            series.errors += int(in_error)
+            series.outbytes += in_outbytes
+            series.errbytes += in_errbytes
+            series.samples.append({'time': in_duration})
+
+            series = self.plugincommands.setdefault(in_context.origin, StatsSeries())
+            if(in_context.invocation is None):
+                in_context.invocation = {'time': 0.0, 'errors': 0}
+                series.count += 1
+                series.samples.append(in_context.invocation)
+            in_context.invocation['time'] += in_duration
+            # an invocation fails when any of its calls fails
+            if(in_error and not in_context.invocation['errors']):
+                series.errors += 1
+            in_context.invocation['errors'] += int(in_error)
+            series.processes += 1
+            series.outbytes += in_outbytes
+            series.errbytes += in_errbytes
+        finally:
+            self.lock.release()
+
+        TraceP4Call(in_context, subcommand, in_duration, in_outbytes, in_errbytes, in_error)
+
+    def MakeReport(self):
+        lines = []
+        lines.append("Perforce performance stats, " + str(int(time.time() - self.starttime)) + " seconds since the plugin was loaded")
+        lines.append("times are in milliseconds, percentiles over the last 500 samples")
+
+        def add_table(in_title, in_series):
+            lines.append('')
+            lines.append("%-40s %7s %7s %7s %8s %8s %8s %10s %10s" % (in_title, 'count', 'p4', 'errors', 'p50', 'p90', 'p99', 'stdout KB', 'stderr KB'))
+            for name in sorted(in_series.keys()):
+                series = in_series[name]
+                errorrate = '%d%%' % (100 * series.errors / max(series.count, 1))
+                lines.append("%-40s %7d %7d %7s %8.0f %8.0f %8.0f %10.1f %10.1f" % (name, series.count, series.processes, errorrate,
+                    series.Percentile(50) * 1000, series.Percentile(90) * 1000, series.Percentile(99) * 1000,
+                    series.outbytes / 1024.0, series.errbytes / 1024.0))
+
+        self.lock.acquire()
+        try:
+            add_table("p4 command", self.p4commands)
+            add_table("plugin command (time spent in p4)", self.plugincommands)
+        finally:
+            self.lock.release()
+
+        return '\n'.join(lines) + '\n'
+
+def GetP4Subcommand(in_arguments):
+    # skips the global options, some of them take a value
+    position = 0
+    while(position < len(in_arguments) and in_arguments[position].startswith('-')):
+        if(in_arguments[position] in ['-x', '-c', '-C', '-d', '-H', '-p', '-P', '-u', '-L', '-z']):
+            position += 1
+        position += 1
+    if(position < len(in_arguments)):
+        return in_arguments[position]
+    return ''
+
+perforce_trace_lock = threading.Lock()
+
+def TraceP4Call(in_context, in_subcommand, in_duration, in_outbytes, in_errbytes, in_error):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    tracelog = perforce_settings.get('perforce_trace_log')
+    if(not tracelog):
+        return
+
+    entry = {'time': time.time(), 'origin': in_context.origin, 'command': in_subcommand, 'duration': in_duration,
+        'stdout': in_outbytes, 'stderr': in_errbytes, 'error': bool(in_error)}
+    perforce_trace_lock.acquire()
+    try:
+        try:
+            f = open(os.path.expanduser(tracelog), 'a')
+            try:
+                f.write(json.dumps(entry) + '\n')
+            finally:
+                f.close()
+        except IOError:
+            pass
+    finally:
+        perforce_trace_lock.release()
+
+perforce_stats = PerforceStats()
+
+# Workspace context section
+# a command captures the workspace it works on when it starts: the folder p4 runs in, the environment, the P4CONFIG
+# file that applies to the folder and the key of the workspace, under which its connection info, client view, opened
+# files and pending changelists are cached. The context is passed to every helper, so selecting another view while a
+# command runs doesn't affect it and commands on different workspaces can run at the same time
+class WorkspaceContext(object):
+    def __init__(self, in_folder, in_origin):
+        self.folder = in_folder
+        self.environment = GetPerforceEnvironment()
+        self.configfile = FindP4ConfigFile(in_folder, self.environment)
+        self.key = (self.configfile, self.environment.get('P4PORT', ''), self.environment.get('P4CLIENT', ''), self.environment.get('P4USER', ''))
+        # the plugin command or listener the p4 calls made with this context are accounted to
+        if(not isinstance(in_origin, basestring)):
+            in_origin = in_origin.__class__.__name__
+        self.origin = in_origin
+        # the p4 calls made with this context, created with the first of them
+        self.invocation = None
+
+    def WithOrigin(self, in_origin):
+        # the same workspace, for work done on behalf of something else
+        context = copy.copy(self)
+        context.origin = in_origin
+        context.invocation = None
+        return context
+
+def GetViewContext(in_view, in_origin):
+    return WorkspaceContext(os.path.dirname(in_view.file_name()), in_origin)
+
+def GetWindowContext(in_window, in_origin):
+    # the workspace of the file in the active view, or of the last selected file
+    view = in_window.active_view()
+    if(view and view.file_name()):
+        return WorkspaceContext(os.path.dirname(view.file_name()), in_origin)
+    return WorkspaceContext(last_activated_folder, in_origin)
 
 # Utility functions
-def ConstructCommand(in_command):
-    return command_prefix + in_command;
+def ConstructCommand(in_arguments):
+    return ['p4'] + in_arguments
+
+class IncompleteRecord(Exception):
+    def __init__(self, in_neededlength):
+        self.neededlength = in_neededlength
+        Exception.__init__(self)
+
+def ReadMarshalledValue(in_data, in_position):
+    # decodes the subset of the marshal format written by 'p4 -G', starting at in_position
+    # marshal.load can't be used on the pipe: it blocks without releasing the interpreter lock
+    if(in_position >= len(in_data)):
+        raise IncompleteRecord(in_position + 1)
+
+    code = in_data[in_position]
+    position = in_position + 1
+    if(code == '{'):
+        value = {}
+        while True:
+            if(position >= len(in_data)):
+                raise IncompleteRecord(position + 1)
+            if(in_data[position] == '0'):
+                return value, position + 1
+            key, position = ReadMarshalledValue(in_data, position)
+            value[key], position = ReadMarshalledValue(in_data, position)
+    if(code in 'stu'):
+        if(position + 4 > len(in_data)):
+            raise IncompleteRecord(position + 4)
+        length = struct.unpack('<i', in_data[position:position + 4])[0]
+        position += 4
+        if(position + length > len(in_data)):
+            raise IncompleteRecord(position + length)
+        value = in_data[position:position + length]
+        if(code == 'u'):
+            value = value.decode('utf-8')
+        return value, position + length
+    if(code == 'i'):
+        if(position + 4 > len(in_data)):
+            raise IncompleteRecord(position + 4)
+        return struct.unpack('<i', in_data[position:position + 4])[0], position + 4
+    if(code == 'N'):
+        return None, position
+    if(code == 'T'):
+        return True, position
+    if(code == 'F'):
+        return False, position
+    raise ValueError("Unexpected marshal type '" + code + "' in the output of p4 -G")
+
+# Circuit breaker section
+# when the server of a workspace can't be reached a few times in a row, the p4 calls of that workspace fail at once
+# for a cool-down period instead of each one waiting for the network to time out (a save would block that long).
+# Once the period is over a single call goes through to probe the server, the breaker closes when it succeeds and
+# opens again when it fails. While a breaker is open, it is shown in the status bar of every view
+connection_failure_pattern = re.compile(r'Connect to server failed|TCP connect to .* failed|TCP (receive|send) failed|Connection refused|Connection timed out|Partner exited unexpectedly', re.IGNORECASE)
+
+def IsConnectionFailure(in_errors):
+    return connection_failure_pattern.search(in_errors) is not None
+
+class CircuitBreaker(object):
+    def __init__(self):
+        # per workspace key: the consecutive failures, when the breaker closes again and whether a probe is running
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def Check(self, in_context):
+        # raises P4Unavailable when the call mustn't be made
+        message = None
+        self.lock.acquire()
+        try:
+            state = self.states.get(in_context.key)
+            if(state and state['openuntil']):
+                remaining = state['openuntil'] - time.time()
+                if(remaining > 0):
+                    message = "The Perforce server could not be reached, p4 is not called for " + str(int(remaining) + 1) + " more seconds."
+                elif(state['probing']):
+                    message = "The Perforce server could not be reached, waiting for the connection to be tested."
+                else:
+                    state['probing'] = True
+        finally:
+            self.lock.release()
+
+        if(message):
+            raise P4Unavailable(message)
+
+    def RecordFailure(self, in_context):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        threshold = perforce_settings.get('perforce_circuit_breaker_threshold', 3)
+        cooldown = perforce_settings.get('perforce_circuit_breaker_cooldown', 30)
+        if(not threshold):
+            return
+
+        self.lock.acquire()
+        try:
+            state = self.states.setdefault(in_context.key, {'failures': 0, 'openuntil': None, 'probing': False})
+            state['failures'] += 1
+            opened = state['probing'] or state['failures'] >= threshold
+            if(opened):
+                state['openuntil'] = time.time() + cooldown
+                state['probing'] = False
+        finally:
+            self.lock.release()
+
+        if(opened):
+            sublime.set_timeout(UpdateConnectionStatus, 10)
+            # the status changes when the cool-down period is over
+            sublime.set_timeout(UpdateConnectionStatus, int(cooldown * 1000) + 100)
+
+    def RecordSuccess(self, in_context):
+        self.lock.acquire()
+        try:
+            state = self.states.pop(in_context.key, None)
+        finally:
+            self.lock.release()
+
+        if(state and state['openuntil']):
+            sublime.set_timeout(UpdateConnectionStatus, 10)
+
+    def ReleaseProbe(self, in_context):
+        # the probe was cancelled, the next call tests the connection
+        self.lock.acquire()
+        try:
+            state = self.states.get(in_context.key)
+            if(state):
+                state['probing'] = False
+        finally:
+            self.lock.release()
+
+    def Reset(self):
+        self.lock.acquire()
+        try:
+            self.states.clear()
+        finally:
+            self.lock.release()
+        sublime.set_timeout(UpdateConnectionStatus, 10)
+
+    def GetStatusText(self):
+        self.lock.acquire()
+        try:
+            openuntil = [state['openuntil'] for state in self.states.values() if state['openuntil']]
+        finally:
+            self.lock.release()
+
+        if(not openuntil):
+            return None
+        if(max(openuntil) > time.time()):
+            return "Perforce: server unreachable, retrying after " + time.strftime('%H:%M:%S', time.localtime(max(openuntil)))
+        return "Perforce: server unreachable, the next command retries"
+
+perforce_circuit_breaker = CircuitBreaker()
+
+def ShowConnectionStatus(in_view):
+    text = perforce_circuit_breaker.GetStatusText()
+    if(text):
+        in_view.set_status('perforce_connection', text)
+    else:
+        in_view.erase_status('perforce_connection')
+
+def UpdateConnectionStatus():
+    for window in sublime.windows():
+        for view in window.views():
+            ShowConnectionStatus(view)
+
+# Process section
+# every p4 process runs in its own process group with a deadline per p4 subcommand, the group is killed when the
+# deadline passes or when the running commands are cancelled. The processes are registered while they run so that
+# the cancel command can find them
+running_processes = {}
+running_processes_lock = threading.Lock()
+
+class P4Unavailable(Exception):
+    def __init__(self, in_message):
+        Exception.__init__(self, in_message)
+        self.message = in_message
+
+# the bulk and streaming subcommands take as long as the files they work on are many or large, they have no
+# deadline unless the settings give them one
+unbounded_subcommands = ['fstat', 'reconcile', 'revert', 'diff', 'diff2', 'annotate', 'describe', 'filelog']
+
+def GetCommandTimeout(in_arguments):
+    # in seconds, 0 for no deadline
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    timeouts = perforce_settings.get('perforce_command_timeouts') or {}
+    subcommand = GetP4Subcommand(in_arguments)
+    if(subcommand in timeouts):
+        return timeouts[subcommand]
+    if(subcommand in unbounded_subcommands):
+        return 0
+    return timeouts.get('default', 0)
+
+def IsServerAnswering(in_context):
+    # a cheap 'p4 info' made outside of the breaker, tells a slow command from a server that can't be reached
+    try:
+        p = subprocess.Popen(ConstructCommand(['info']), stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_context.folder, env=in_context.environment)
+    except OSError:
+        return False
+
+    def kill():
+        try:
+            p.kill()
+        except OSError:
+            pass # already gone
+    timer = threading.Timer(GetCommandTimeout(['info']) or 15, kill)
+    timer.setDaemon(True)
+    timer.start()
+    result, err = p.communicate()
+    timer.cancel()
+    return p.returncode == 0 and not IsConnectionFailure(err)
+
+def KillProcessGroup(in_process):
+    try:
+        if(os.name == 'nt'):
+            subprocess.Popen(['taskkill', '/F', '/T', '/PID', str(in_process.pid)], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+        else:
+            os.killpg(in_process.pid, signal.SIGKILL)
+    except OSError:
+        pass # already gone
+
+def StopP4Process(in_process, in_reason):
+    if(in_process.stopreason is None and in_process.poll() is None):
+        in_process.stopreason = in_reason
+        KillProcessGroup(in_process)
+
+def LaunchP4Process(in_arguments, in_context, in_stdin=None, in_timeout=None):
+    # every p4 process of the plugin is started here, in the folder and environment of the context
+    # in_timeout overrides the deadline of the settings, 0 for no deadline
+    perforce_circuit_breaker.Check(in_context)
+
+    if(os.name == 'nt'):
+        groupoptions = {'creationflags': 0x00000200} # CREATE_NEW_PROCESS_GROUP
+    else:
+        groupoptions = {'preexec_fn': os.setsid}
+    try:
+        p = subprocess.Popen(ConstructCommand(in_arguments), stdin=in_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_context.folder, env=in_context.environment, **groupoptions)
+    except OSError, e:
+        # p4 missing from the PATH or a folder that no longer exists, reported like any other failed call. The
+        # failure also ends the probe the breaker may have let through
+        perforce_circuit_breaker.RecordFailure(in_context)
+        perforce_circuit_breaker.ReleaseProbe(in_context)
+        raise P4Unavailable("Unable to run p4: " + str(e))
+
+    p.stopreason = None
+    p.timeout = in_timeout
+    if(p.timeout is None):
+        p.timeout = GetCommandTimeout(in_arguments)
+    p.timer = None
+    if(p.timeout):
+        p.timer = threading.Timer(p.timeout, StopP4Process, [p, 'timeout'])
+        p.timer.setDaemon(True)
+        p.timer.start()
+
+    running_processes_lock.acquire()
+    try:
+        running_processes[p.pid] = p
+    finally:
+        running_processes_lock.release()
+    return p
+
+def FinishP4Process(in_process, in_arguments, in_context, in_errors, in_errorrecords=''):
+    # called once the process has exited, returns the error output completed with the reason it was stopped
+    # the error output and the data of the error records tell whether the server could be reached
+    if(in_process.timer):
+        in_process.timer.cancel()
+    running_processes_lock.acquire()
+    try:
+        running_processes.pop(in_process.pid, None)
+    finally:
+        running_processes_lock.release()
+
+    subcommand = GetP4Subcommand(in_arguments)
+    if(in_process.stopreason == 'cancel'):
+        perforce_circuit_breaker.ReleaseProbe(in_context)
+        return "p4 " + subcommand + " was cancelled.\n" + in_errors
+
+    if(in_process.stopreason == 'timeout'):
+        in_errors = "p4 " + subcommand + " timed out after " + str(in_process.timeout) + " seconds.\n" + in_errors
+        # a command slower than its deadline only counts against the breaker when the server doesn't answer
+        if(IsConnectionFailure(in_errorrecords + in_errors) or not IsServerAnswering(in_context)):
+            perforce_circuit_breaker.RecordFailure(in_context)
+        else:
+            perforce_circuit_breaker.RecordSuccess(in_context)
+    elif(IsConnectionFailure(in_errorrecords + in_errors)):
+        perforce_circuit_breaker.RecordFailure(in_context)
+    else:
+        perforce_circuit_breaker.RecordSuccess(in_context)
+    return in_errors
+
+def CancelRunningP4Processes():
+    running_processes_lock.acquire()
+    try:
+        processes = running_processes.values()
+    finally:
+        running_processes_lock.release()
+
+    for p in processes:
+        StopP4Process(p, 'cancel')
+    return len(processes)
+
+def RunP4TextCommand(in_arguments, in_context, in_input=None):
+    # for the commands whose text output is shown as is
+    starttime = time.time()
+    try:
+        p = LaunchP4Process(in_arguments, in_context, subprocess.PIPE)
+    except P4Unavailable, e:
+        return '', e.message
+    result, err = p.communicate(in_input)
+    err = FinishP4Process(p, in_arguments, in_context, err)
+    perforce_stats.RecordP4Call(in_context, in_arguments, time.time() - starttime, len(result), len(err), err.strip() != '' or p.returncode != 0)
+    return result, err
+
+def FeedP4Input(in_process, in_input):
+    # fed from another thread so that p4 can start answering before it has read all of its input
+    def feed_input():
+        try:
+            try:
+                in_process.stdin.write(in_input)
+            finally:
+                in_process.stdin.close()
+        except IOError:
+            pass # p4 was stopped before it read everything
+    threading.Thread(target=feed_input).start()
+
+def P4Records(in_arguments, in_context, in_input=None, in_timeout=None):
+    # runs p4 with -G and yields the marshalled records one at a time as they are read from its output
+    # errors are reported as records too, their 'code' is 'error'. When p4 was stopped (deadline or cancel), the
+    # last error record has the reason in 'stopreason'
+    starttime = time.time()
+    stdin = None
+    if(in_input is not None):
+        stdin = subprocess.PIPE
+    try:
+        p = LaunchP4Process(['-G'] + in_arguments, in_context, stdin, in_timeout)
+    except P4Unavailable, e:
+        yield {'code': 'error', 'data': e.message}
+        return
+
+    if(in_input is not None):
+        FeedP4Input(p, in_input)
+
+    # read from another thread, p4 would block if it filled that pipe
+    errors = []
+    errorsthread = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+    errorsthread.start()
+
+    outputlength = 0
+    haserrorrecords = False
+    errorrecords = ''
+    try:
+        data = ''
+        chunks = []
+        availablelength = 0
+        neededlength = 1
+        while True:
+            chunk = os.read(p.stdout.fileno(), 65536)
+            if(not chunk):
+                break
+            outputlength += len(chunk)
+            chunks.append(chunk)
+            availablelength += len(chunk)
+            # large records span many reads, only join them once they are complete
+            if(availablelength < neededlength):
+                continue
+
+            data = data + ''.join(chunks)
+            chunks = []
+            position = 0
+            while True:
+                try:
+                    record, nextposition = ReadMarshalledValue(data, position)
+                except IncompleteRecord, e:
+                    neededlength = e.neededlength - position
+                    break
+                position = nextposition
+                if(record.get('code') == 'error'):
+                    haserrorrecords = True
+                    # kept to recognize connection failures, the first ones are enough
+                    if(len(errorrecords) < 4096):
+                        errorrecords += record.get('data', '')
+                yield record
+            data = data[position:]
+            availablelength = len(data)
+    finally:
+        p.stdout.close()
+        p.wait()
+        errorsthread.join()
+        err = FinishP4Process(p, in_arguments, in_context, ''.join(errors), errorrecords)
+        perforce_stats.RecordP4Call(in_context, in_arguments, time.time() - starttime, outputlength, len(err), haserrorrecords or err.strip() != '')
+
+    if(err.strip()):
+        record = {'code': 'error', 'data': err}
+        if(p.stopreason):
+            record['stopreason'] = p.stopreason
+        yield record
+
+def RunP4Command(in_arguments, in_context, in_input=None):
+    # collects all the records of a command, errors are joined in a single message
+    records = []
+    errors = []
+    for record in P4Records(in_arguments, in_context, in_input):
+        if(record.get('code') == 'error'):
+            errors.append(record.get('data', '').strip())
+        else:
+            records.append(record)
+    return records, '\n'.join(errors)
+
+def StreamP4Output(in_arguments, in_context, in_onoutput, in_input=None):
+    # for the commands whose text output is shown while p4 runs, the output is passed to in_onoutput as it is read
+    # returns the error output
+    starttime = time.time()
+    stdin = None
+    if(in_input is not None):
+        stdin = subprocess.PIPE
+    try:
+        p = LaunchP4Process(in_arguments, in_context, stdin)
+    except P4Unavailable, e:
+        return e.message + "\n"
+
+    if(in_input is not None):
+        FeedP4Input(p, in_input)
+
+    # read from another thread, p4 would block if it filled that pipe
+    errors = []
+    errorsthread = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+    errorsthread.start()
+
+    outputlength = 0
+    try:
+        while True:
+            chunk = os.read(p.stdout.fileno(), 65536)
+            if(not chunk):
+                break
+            outputlength += len(chunk)
+            in_onoutput(chunk)
+    finally:
+        p.stdout.close()
+        p.wait()
+        errorsthread.join()
+        err = FinishP4Process(p, in_arguments, in_context, ''.join(errors))
+        perforce_stats.RecordP4Call(in_context, in_arguments, time.time() - starttime, outputlength, len(err), err.strip() != '' or p.returncode != 0)
+    return err
 
 def getPerforceConfigFromPreferences(command):
     perforce_settings = sublime.load_settings('Perforce.sublime-settings')
@@ -86,70 +734,356 @@ def getPerforceConfigFromPreferences(command):
     command = addP4Var(command, "P4PASSWD")
     return command
 
-def GetUserFromClientspec():
-    command = ConstructCommand('p4 info')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+# Connection info cache section
+# 'p4 info' results are kept per workspace, the key being the effective P4CONFIG/P4PORT/P4CLIENT/P4USER
+# of the context, so that the frequent client root checks do not each cost a round trip to the server
+connection_info_cache = {}
+connection_info_cache_lock = threading.Lock()
+
+def FindP4ConfigFile(in_folder, in_environment):
+    configname = in_environment.get('P4CONFIG')
+    if(not configname or not in_folder):
+        return ''
+
+    # P4CONFIG files apply to the folder they are in and all of its subfolders
+    folder = os.path.abspath(in_folder)
+    while True:
+        configfile = os.path.join(folder, configname)
+        if(os.path.isfile(configfile)):
+            return configfile
+        parentfolder = os.path.dirname(folder)
+        if(parentfolder == folder):
+            return ''
+        folder = parentfolder
+
+def GetConnectionInfo(in_context):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    ttl = perforce_settings.get('perforce_info_cache_ttl')
+    if(ttl is None):
+        ttl = 300
+
+    connection_info_cache_lock.acquire()
+    try:
+        entry = connection_info_cache.get(in_context.key)
+    finally:
+        connection_info_cache_lock.release()
+
+    if(entry and time.time() - entry['time'] < ttl):
+        return 1, entry['info']
+
+    records, err = RunP4Command(['info'], in_context)
 
     if(err):
-        WarnUser("usererr " + err.strip())
-        return -1 
+        return 0, err
 
-    # locate the line containing "User name: " and extract the following name
-    startindex = result.find("User name: ")
-    if(startindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
-        return -1
-    
-    startindex += 11 # advance after 'User name: '
+    if(not records):
+        return 0, "Unexpected output from 'p4 info'."
+
+    info = {}
+    info['clientName'] = records[0].get('clientName', '')
+    info['clientRoot'] = records[0].get('clientRoot')
+    info['userName'] = records[0].get('userName')
+    info['serverAddress'] = records[0].get('serverAddress', '')
+    info['serverVersion'] = records[0].get('serverVersion', '')
+    info['caseHandling'] = records[0].get('caseHandling', '')
+
+    connection_info_cache_lock.acquire()
+    try:
+        connection_info_cache[in_context.key] = {'info': info, 'time': time.time()}
+    finally:
+        connection_info_cache_lock.release()
+
+    return 1, info
+
+def InvalidateConnectionInfo():
+    connection_info_cache_lock.acquire()
+    try:
+        connection_info_cache.clear()
+        client_view_cache.clear()
+    finally:
+        connection_info_cache_lock.release()
+    InvalidateOpenedFilesIndexes()
+    InvalidatePendingChangelistsModels()
+    workspace_prefetcher.Reset()
+    perforce_circuit_breaker.Reset()
+
+def OnPerforceSettingsChanged():
+    RefreshPerforceEnvironment()
+    InvalidateConnectionInfo()
+
+sublime.load_settings('Perforce.sublime-settings').add_on_change('perforce_plugin', OnPerforceSettingsChanged)
 
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
+def GetUserFromClientspec(in_context):
+    success, info = GetConnectionInfo(in_context)
+
+    if(not success):
+        WarnUser("usererr " + info)
+        return -1 
+
+    if(not info['userName']):
         WarnUser("Unexpected output from 'p4 info'.")
         return -1
 
-    return result[startindex:endindex].strip();
+    return info['userName']
 
-def GetClientRoot(in_dir):
+def GetClientRoot(in_context, in_dir):
     # check if the file is in the depot
-    command = ConstructCommand('p4 info')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    success, info = GetConnectionInfo(in_context)
 
-    if(err):
-        WarnUser(err.strip())
+    if(not success):
+        WarnUser(info)
         return -1 
     
-    # locate the line containing "Client root: " and extract the following path
-    startindex = result.find("Client unknown.")
-    if(startindex == 0):
+    if(info['clientName'] == '*unknown*'):
         return -1
 
-    startindex = result.find("Client root: ")
-    if(startindex == -1):
+    if(not info['clientRoot']):
         # sometimes the clientspec is not displayed 
         sublime.error_message("Perforce Plugin: p4 info didn't supply a valid clientspec, launching p4 client");
-        command = ConstructCommand('p4 client')
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        return -1
-            
-    startindex += 13 # advance after 'Client root: '
-
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
+        InvalidateConnectionInfo()
+        RunP4TextCommand(['client'], in_context)
         return -1
 
     # convert all paths to "os.sep" slashes 
-    convertedclientroot = result[startindex:endindex].strip().replace('\\', os.sep).replace('/', os.sep)
+    convertedclientroot = info['clientRoot'].replace('\\', os.sep).replace('/', os.sep)
 
     return convertedclientroot
 
 
-def IsFolderUnderClientRoot(in_folder):
+# Client View section
+# the view of the clientspec is fetched once per workspace and compiled so that mapping questions are answered locally
+client_view_cache = {}
+
+def SplitViewLine(in_line):
+    # view lines are two paths, each of them can be quoted when it contains spaces
+    paths = []
+    for match in re.finditer(r'"([^"]*)"|(\S+)', in_line):
+        if(match.group(1) is not None):
+            paths.append(match.group(1))
+        else:
+            paths.append(match.group(2))
+    return paths
+
+class ClientViewMapping(object):
+    def __init__(self, in_flag, in_depotpath, in_clientpath, in_caseinsensitive):
+        self.flag = in_flag
+        self.depotpath = in_depotpath
+        self.clientpath = in_clientpath
+        self.depotregex, self.depotwildcards = self.CompilePattern(in_depotpath, in_caseinsensitive)
+        self.clientregex, self.clientwildcards = self.CompilePattern(in_clientpath, in_caseinsensitive)
+        self.clientprefix = re.split(r'\.\.\.|\*|%%[0-9]', in_clientpath)[0]
+        if(in_caseinsensitive):
+            self.clientprefix = self.clientprefix.lower()
+
+    def CompilePattern(self, in_pattern, in_caseinsensitive):
+        # '...' matches anything, '*' and '%%n' match within a single folder
+        regex = ''
+        wildcards = []
+        for token in re.split(r'(\.\.\.|\*|%%[0-9])', in_pattern):
+            if(token == '...'):
+                regex += '(.*)'
+                wildcards.append(token)
+            elif(token == '*' or token.startswith('%%')):
+                regex += '([^/]*)'
+                wildcards.append(token)
+            else:
+                regex += re.escape(token)
+        flags = 0
+        if(in_caseinsensitive):
+            flags = re.IGNORECASE
+        return re.compile('^' + regex + '$', flags), wildcards
+
+    def Translate(self, in_path, in_fromregex, in_fromwildcards, in_topattern):
+        match = in_fromregex.match(in_path)
+        if(not match):
+            return None
+
+        # positional wildcards are substituted in order, numbered ones by their number
+        positionalvalues = []
+        numberedvalues = {}
+        for wildcard, value in zip(in_fromwildcards, match.groups()):
+            if(wildcard.startswith('%%')):
+                numberedvalues[wildcard] = value
+            else:
+                positionalvalues.append(value)
+
+        result = []
+        for token in re.split(r'(\.\.\.|\*|%%[0-9])', in_topattern):
+            if(token.startswith('%%') and len(token) == 3):
+                result.append(numberedvalues.get(token, ''))
+            elif(token == '...' or token == '*'):
+                if(positionalvalues):
+                    result.append(positionalvalues.pop(0))
+            else:
+                result.append(token)
+        return ''.join(result)
+
+    def ClientToDepot(self, in_clientpath):
+        return self.Translate(in_clientpath, self.clientregex, self.clientwildcards, self.depotpath)
+
+    def DepotToClient(self, in_depotpath):
+        return self.Translate(in_depotpath, self.depotregex, self.depotwildcards, self.clientpath)
+
+class ClientView(object):
+    def __init__(self, in_clientspec, in_caseinsensitive):
+        self.clientname = in_clientspec.get('Client', '')
+        self.caseinsensitive = in_caseinsensitive
+
+        self.roots = [in_clientspec.get('Root', '')]
+        index = 0
+        while 'AltRoots' + str(index) in in_clientspec:
+            self.roots.append(in_clientspec['AltRoots' + str(index)])
+            index += 1
+
+        self.mappings = []
+        index = 0
+        while 'View' + str(index) in in_clientspec:
+            paths = SplitViewLine(in_clientspec['View' + str(index)])
+            index += 1
+            if(len(paths) != 2):
+                continue
+
+            flag = ''
+            if(paths[0][0] in '-+&'):
+                flag = paths[0][0]
+                paths[0] = paths[0][1:]
+            self.mappings.append(ClientViewMapping(flag, paths[0], paths[1], in_caseinsensitive))
+
+        # prefix table: view lines are bucketed by the first folder of their client path
+        # lines with a wildcard in the first folder have to be tested for every path
+        self.clientprefixlength = len('//' + self.clientname + '/')
+        self.prefixtable = {}
+        self.wildcardmappings = []
+        for index, mapping in enumerate(self.mappings):
+            firstfolder = mapping.clientprefix[self.clientprefixlength:]
+            if(firstfolder.find('/') == -1):
+                self.wildcardmappings.append(index)
+            else:
+                self.prefixtable.setdefault(firstfolder.split('/')[0], []).append(index)
+
+    def NormalizeCase(self, in_path):
+        if(self.caseinsensitive):
+            return in_path.lower()
+        return in_path
+
+    def LocalToClient(self, in_filename):
+        filename = os.path.abspath(in_filename)
+        for root in self.roots:
+            if(root.lower() == 'null'):
+                return '//' + self.clientname + '/' + filename.replace('\\', '/').lstrip('/')
+
+            root = os.path.abspath(root.replace('\\', os.sep).replace('/', os.sep))
+            if(self.NormalizeCase(filename).startswith(self.NormalizeCase(root.rstrip(os.sep) + os.sep))):
+                relativepath = filename[len(root.rstrip(os.sep)) + 1:]
+                return '//' + self.clientname + '/' + relativepath.replace(os.sep, '/')
+        return None
+
+    def ClientToLocal(self, in_clientpath):
+        relativepath = in_clientpath[self.clientprefixlength:]
+        if(self.roots[0].lower() == 'null'):
+            return relativepath.replace('/', os.sep)
+        return os.path.join(self.roots[0], relativepath.replace('/', os.sep))
+
+    def CandidateMappings(self, in_clientpath):
+        firstfolder = self.NormalizeCase(in_clientpath[self.clientprefixlength:]).split('/')[0]
+        candidates = self.prefixtable.get(firstfolder, []) + self.wildcardmappings
+        # later lines of the view take precedence over earlier ones
+        candidates.sort(reverse=True)
+        return candidates
+
+    def ClientToDepot(self, in_clientpath):
+        normalizedpath = self.NormalizeCase(in_clientpath)
+        for index in self.CandidateMappings(in_clientpath):
+            mapping = self.mappings[index]
+            if(not normalizedpath.startswith(mapping.clientprefix)):
+                continue
+            depotpath = mapping.ClientToDepot(in_clientpath)
+            if(depotpath is None):
+                continue
+            if(mapping.flag == '-'):
+                return None
+            # a later line can remap the depot file somewhere else, making this client path unmapped
+            if(self.NormalizeCase(self.DepotToClient(depotpath) or '') != normalizedpath):
+                return None
+            return depotpath
+        return None
+
+    def DepotToClient(self, in_depotpath):
+        for mapping in reversed(self.mappings):
+            clientpath = mapping.DepotToClient(in_depotpath)
+            if(clientpath is None):
+                continue
+            if(mapping.flag == '-'):
+                return None
+            return clientpath
+        return None
+
+    def LocalToDepot(self, in_filename):
+        clientpath = self.LocalToClient(in_filename)
+        if(clientpath is None):
+            return None
+        return self.ClientToDepot(clientpath)
+
+    def DepotToLocal(self, in_depotpath):
+        clientpath = self.DepotToClient(in_depotpath)
+        if(clientpath is None):
+            return None
+        return self.ClientToLocal(clientpath)
+
+def GetClientView(in_context):
+    success, info = GetConnectionInfo(in_context)
+    if(not success):
+        return 0, info
+
+    if(not info['clientRoot'] or info['clientName'] == '*unknown*'):
+        return 0, "No valid clientspec for this workspace."
+
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    ttl = perforce_settings.get('perforce_info_cache_ttl')
+    if(ttl is None):
+        ttl = 300
+
+    connection_info_cache_lock.acquire()
+    try:
+        entry = client_view_cache.get(in_context.key)
+    finally:
+        connection_info_cache_lock.release()
+
+    if(entry and time.time() - entry['time'] < ttl):
+        return 1, entry['view']
+
+    records, err = RunP4Command(['client', '-o'], in_context)
+
+    if(err):
+        return 0, err
+
+    if(not records or not records[0].get('View0')):
+        return 0, "Unexpected output from 'p4 client -o'."
+
+    caseinsensitive = info['caseHandling'] == 'insensitive' or (not info['caseHandling'] and sublime.platform() == "windows")
+    clientview = ClientView(records[0], caseinsensitive)
+
+    connection_info_cache_lock.acquire()
+    try:
+        client_view_cache[in_context.key] = {'view': clientview, 'time': time.time()}
+    finally:
+        connection_info_cache_lock.release()
+
+    return 1, clientview
+
+def IsFileUnderClientView(in_context, in_filename):
+    success, clientview = GetClientView(in_context)
+    if(not success):
+        # without a view to work with, fall back on the client root
+        return IsFolderUnderClientRoot(in_context, os.path.dirname(in_filename))
+
+    if(clientview.LocalToDepot(in_filename) is None):
+        return 0
+    return 1
+
+def IsFolderUnderClientRoot(in_context, in_folder):
     # check if the file is in the depot
-    clientroot = GetClientRoot(in_folder)
+    clientroot = GetClientRoot(in_context, in_folder)
     if(clientroot == -1):
         return 0
 
@@ -166,8 +1100,8 @@ def IsFolderUnderClientRoot(in_folder):
     
     return 1
 
-def IsFileInDepot(in_folder, in_filename):
-    isUnderClientRoot = IsFolderUnderClientRoot(in_folder);
+def IsFileInDepot(in_context, in_folder, in_filename):
+    isUnderClientRoot = IsFileUnderClientView(in_context, os.path.join(in_folder, in_filename));
     if(os.path.isfile(os.path.join(in_folder, in_filename))): # file exists on disk, not being added
         if(isUnderClientRoot):
             return 1
@@ -179,84 +1113,580 @@ def IsFileInDepot(in_folder, in_filename):
         else:
             return 0
 
-def IsFileOpenedOnClient(in_filename):
-    command = ConstructCommand('p4 opened "' + in_filename + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+# Opened Files section
+# the files opened on each workspace are indexed in memory, the index is loaded with a single 'p4 opened',
+# kept up to date from the results of the plugin's own commands and fully reloaded on a background interval
+opened_files_indexes = {}
+opened_files_indexes_lock = threading.Lock()
+
+def ClientFileToLocalFile(in_info, in_clientfile):
+    # client syntax is //clientname/path relative to the client root
+    relativepath = in_clientfile[len('//' + in_info['clientName'] + '/'):].replace('/', os.sep)
+    if(in_info['clientRoot'].lower() == "null"):
+        return relativepath
+
+    return os.path.join(in_info['clientRoot'], relativepath)
+
+class OpenedFilesIndex(object):
+    def __init__(self, in_context):
+        self.context = in_context.WithOrigin('Background reload')
+        self.loaded = False
+        self.caseinsensitive = sublime.platform() == "windows"
+        self.bylocalfile = {}
+        self.bydepotfile = {}
+        # files p4 refused to open because they are not in the depot, to avoid asking again until the next reload
+        self.unversionedfiles = set()
+        # changes whenever the opened files change, for those who keep a copy of them
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def NormalizeFileName(self, in_filename):
+        filename = os.path.normpath(os.path.abspath(in_filename))
+        if(self.caseinsensitive):
+            return filename.lower()
+        return filename
 
-    if(err):
+    def Load(self, in_context=None):
+        # loaded on behalf of the command that needs it, or in the background where each reload is an invocation
+        context = in_context or self.context.WithOrigin(self.context.origin)
+        success, info = GetConnectionInfo(context)
+        if(not success):
+            return 0, info
+
+        if(not info['clientRoot'] or info['clientName'] == '*unknown*'):
+            return 0, "No valid clientspec for this workspace."
+
+        bylocalfile = {}
+        bydepotfile = {}
+        self.caseinsensitive = info['caseHandling'] == 'insensitive' or (not info['caseHandling'] and sublime.platform() == "windows")
+        for record in P4Records(['opened', '-C', info['clientName']], context):
+            if(record.get('code') == 'error'):
+                # 'file(s) not opened on this client' is reported as an error when nothing is opened
+                if(record.get('data', '').find('not opened') == -1):
+                    return 0, record.get('data', '').strip()
+                continue
+
+            entry = {}
+            entry['depotFile'] = record['depotFile']
+            entry['localFile'] = ClientFileToLocalFile(info, record['clientFile'])
+            entry['action'] = record.get('action', '')
+            entry['change'] = record.get('change', 'default')
+            entry['type'] = record.get('type', '')
+            entry['rev'] = record.get('rev', '')
+            entry['user'] = record.get('user', '')
+            bylocalfile[self.NormalizeFileName(entry['localFile'])] = entry
+            bydepotfile[entry['depotFile']] = entry
+
+        self.lock.acquire()
+        try:
+            self.bylocalfile = bylocalfile
+            self.bydepotfile = bydepotfile
+            self.unversionedfiles = set()
+            self.generation += 1
+            self.loaded = True
+        finally:
+            self.lock.release()
+
+        return 1, ''
+
+    def Invalidate(self):
+        self.loaded = False
+
+    def GetByLocalFile(self, in_filename):
+        self.lock.acquire()
+        try:
+            return self.bylocalfile.get(self.NormalizeFileName(in_filename))
+        finally:
+            self.lock.release()
+
+    def GetByDepotFile(self, in_depotfile):
+        self.lock.acquire()
+        try:
+            return self.bydepotfile.get(in_depotfile)
+        finally:
+            self.lock.release()
+
+    def GetFilesInChangelist(self, in_changelist):
+        self.lock.acquire()
+        try:
+            return [entry for entry in self.bydepotfile.values() if entry['change'] == in_changelist]
+        finally:
+            self.lock.release()
+
+    def GetAllFiles(self):
+        self.lock.acquire()
+        try:
+            return self.bydepotfile.values()
+        finally:
+            self.lock.release()
+
+    def IsUnversioned(self, in_filename):
+        self.lock.acquire()
+        try:
+            return self.NormalizeFileName(in_filename) in self.unversionedfiles
+        finally:
+            self.lock.release()
+
+    def SetUnversioned(self, in_filename):
+        self.lock.acquire()
+        try:
+            self.unversionedfiles.add(self.NormalizeFileName(in_filename))
+        finally:
+            self.lock.release()
+
+    def SetOpened(self, in_entry):
+        self.lock.acquire()
+        try:
+            previousentry = self.bydepotfile.get(in_entry['depotFile'])
+            if(previousentry):
+                del self.bylocalfile[self.NormalizeFileName(previousentry['localFile'])]
+            self.bylocalfile[self.NormalizeFileName(in_entry['localFile'])] = in_entry
+            self.bydepotfile[in_entry['depotFile']] = in_entry
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def SetClosed(self, in_depotfile):
+        self.lock.acquire()
+        try:
+            entry = self.bydepotfile.pop(in_depotfile, None)
+            if(entry):
+                del self.bylocalfile[self.NormalizeFileName(entry['localFile'])]
+                self.generation += 1
+        finally:
+            self.lock.release()
+
+    def SetChangelistClosed(self, in_changelist):
+        for entry in self.GetFilesInChangelist(in_changelist):
+            self.SetClosed(entry['depotFile'])
+
+    def Update(self, in_command, in_changelist, in_records):
+        # applies the records of an edit/add/delete/revert/reopen to the index
+        for record in in_records:
+            if(record.get('code') != 'stat' or 'depotFile' not in record):
+                continue
+
+            if(in_command == 'revert'):
+                self.SetClosed(record['depotFile'])
+                continue
+
+            previousentry = self.GetByDepotFile(record['depotFile'])
+            entry = {}
+            entry['depotFile'] = record['depotFile']
+            if(record.get('clientFile', '').startswith('//') or not record.get('clientFile')):
+                if(not previousentry):
+                    continue
+                entry['localFile'] = previousentry['localFile']
+            else:
+                entry['localFile'] = record['clientFile']
+            entry['action'] = record.get('action', '')
+            entry['change'] = record.get('change', in_changelist)
+            entry['type'] = record.get('type', '')
+            entry['rev'] = record.get('workRev', record.get('rev', ''))
+            entry['user'] = ''
+            if(previousentry):
+                if(in_command != 'reopen'):
+                    entry['change'] = previousentry['change']
+                entry['action'] = entry['action'] or previousentry['action']
+                entry['type'] = entry['type'] or previousentry['type']
+                entry['rev'] = entry['rev'] or previousentry['rev']
+                entry['user'] = previousentry['user']
+            self.SetOpened(entry)
+
+def GetOpenedFilesIndex(in_context):
+    opened_files_indexes_lock.acquire()
+    try:
+        index = opened_files_indexes.get(in_context.key)
+        if(index is None):
+            index = OpenedFilesIndex(in_context)
+            opened_files_indexes[in_context.key] = index
+    finally:
+        opened_files_indexes_lock.release()
+
+    if(not index.loaded):
+        success, message = index.Load(in_context)
+        if(not success):
+            return 0, message
+
+    return 1, index
+
+def PeekOpenedFilesIndex(in_context):
+    # returns the index only if it can answer without going to the server
+    opened_files_indexes_lock.acquire()
+    try:
+        index = opened_files_indexes.get(in_context.key)
+    finally:
+        opened_files_indexes_lock.release()
+
+    if(index and index.loaded):
+        return index
+    return None
+
+def InvalidateOpenedFilesIndexes():
+    opened_files_indexes_lock.acquire()
+    try:
+        opened_files_indexes.clear()
+    finally:
+        opened_files_indexes_lock.release()
+
+def ReloadOpenedFilesIndexes():
+    opened_files_indexes_lock.acquire()
+    try:
+        indexes = opened_files_indexes.values()
+    finally:
+        opened_files_indexes_lock.release()
+
+    for index in indexes:
+        index.Load()
+
+def ScheduleOpenedFilesIndexesReload(in_stopped):
+    # in_stopped is set when the plugin is unloaded, the timer isn't scheduled again
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    interval = perforce_settings.get('perforce_opened_files_refresh_interval')
+
+    def reload_indexes():
+        if(in_stopped.isSet()):
+            return
+        if(interval and interval > 0):
+            threading.Thread(target=ReloadOpenedFilesIndexes).start()
+            threading.Thread(target=ReloadPendingChangelistsModels).start()
+        ScheduleOpenedFilesIndexesReload(in_stopped)
+
+    # when disabled, the setting is checked again every minute
+    if(not interval or interval <= 0):
+        sublime.set_timeout(reload_indexes, 60000)
+    else:
+        sublime.set_timeout(reload_indexes, int(interval * 1000))
+
+def LoadOpenedFilesIndexInBackground(in_context, in_keys):
+    # batch function of the index queue, the key of the workspace stands for its file name
+    success, message = GetOpenedFilesIndex(in_context)
+    if(not success):
+        return {in_keys[0]: (-1, message)}
+    return {}
+
+def ScheduleOpenedFilesIndexLoad(in_context):
+    # a full 'p4 opened' can take seconds on a large workspace, the commands never wait for it: they use the index
+    # once it's loaded and ask the server about their own files until then
+    if(PeekOpenedFilesIndex(in_context) is None):
+        perforce_index_queue.Enqueue('index', in_context, [in_context.key])
+
+def GetOpenedFileEntries(in_context, in_filenames):
+    # returns whether it could be found out, the index entry of each file (None when it's not opened) and the files
+    # known not to be in the depot. Without a loaded index the files are asked for with a single fstat
+    entries = {}
+    unversioned = set()
+    index = PeekOpenedFilesIndex(in_context)
+    if(index):
+        for filename in in_filenames:
+            entries[filename] = index.GetByLocalFile(filename)
+            if(index.IsUnversioned(filename)):
+                unversioned.add(filename)
+        return 1, entries, unversioned
+
+    ScheduleOpenedFilesIndexLoad(in_context)
+    filesbyname = {}
+    for filename in in_filenames:
+        entries[filename] = None
+        filesbyname[os.path.normcase(os.path.abspath(filename))] = filename
+
+    success = 1
+    for record in P4Records(['-x', '-', 'fstat', '-T', 'depotFile,clientFile,action,change,type,haveRev'], in_context, '\n'.join(in_filenames) + '\n'):
+        if(record.get('code') == 'stat' and record.get('clientFile')):
+            filename = filesbyname.get(os.path.normcase(os.path.abspath(record['clientFile'])))
+            if(filename and record.get('action')):
+                entries[filename] = {'depotFile': record['depotFile'], 'localFile': filename, 'action': record['action'],
+                    'change': record.get('change', 'default'), 'type': record.get('type', ''), 'rev': record.get('haveRev', ''), 'user': ''}
+        elif(record.get('code') == 'error'):
+            data = record.get('data', '')
+            filename = filesbyname.get(os.path.normcase(os.path.abspath(data.split(' - ')[0].strip())))
+            if(filename and (data.find('no such file') != -1 or data.find('not in client view') != -1)):
+                unversioned.add(filename)
+            elif(not filename):
+                success = 0
+    return success, entries, unversioned
+
+def IsFileOpenedOnClient(in_context, in_filename):
+    success, entries, unversioned = GetOpenedFileEntries(in_context, [in_filename])
+    if(not success or not entries[in_filename]):
         return 0
     return 1
 
-def GetPendingChangelists():
+def DescribeFileRecord(in_command, in_record):
+    # rebuilds the message p4 prints for one file from its -G record
+    if(in_record.get('code') != 'stat'):
+        return in_record.get('data', '').strip()
+
+    depotfile = in_record.get('depotFile', '')
+    if(in_command == 'revert'):
+        return depotfile + '#' + in_record.get('haveRev', 'none') + ' - was ' + in_record.get('oldAction', '') + ', reverted'
+    if(in_command == 'reopen'):
+        return depotfile + '#' + in_record.get('workRev', '') + ' - reopened; change ' + in_record.get('change', '')
+    return depotfile + '#' + in_record.get('workRev', '') + ' - opened for ' + in_record.get('action', in_command)
+
+def PerforceBatchFileOperation(in_context, in_command, in_filenames, in_changelist=None):
+    # runs edit/add/delete/revert/reopen on all the files with a single p4 call, the file names are streamed on its
+    # standard input with '-x -'; the records are matched back to their file and applied to the opened files index
+    arguments = ['-x', '-', in_command]
+    if(in_changelist):
+        arguments += ['-c', in_changelist]
+    records = list(P4Records(arguments, in_context, '\n'.join(in_filenames) + '\n'))
+
+    # an index that isn't loaded yet gets these changes from the server when it is
+    index = PeekOpenedFilesIndex(in_context)
+    success = index is not None
+    if(success):
+        index.Update(in_command, in_changelist or 'default', records)
+        normalize = index.NormalizeFileName
+    else:
+        normalize = lambda filename: os.path.normcase(os.path.abspath(filename))
+
+    filesbyname = {}
+    viewsuccess, clientview = GetClientView(in_context)
+    for filename in in_filenames:
+        filesbyname[normalize(filename)] = filename
+        if(viewsuccess):
+            depotfile = clientview.LocalToDepot(filename)
+            if(depotfile):
+                filesbyname[depotfile] = filename
+
+    def find_file(in_record):
+        for key in ['depotFile', 'clientFile']:
+            if(key in in_record):
+                if(in_record[key].startswith('//')):
+                    return filesbyname.get(in_record[key])
+                return filesbyname.get(normalize(in_record[key]))
+        # messages start with the file they are about, possibly followed by a revision
+        path = in_record.get('data', '').split(' - ')[0].split('#')[0].strip()
+        if(path.startswith('//')):
+            return filesbyname.get(path)
+        if(path):
+            return filesbyname.get(normalize(path))
+        return None
+
+    errors = {}
+    messages = {}
+    for record in records:
+        filename = find_file(record)
+        if(filename is None and len(in_filenames) == 1):
+            filename = in_filenames[0]
+        message = DescribeFileRecord(in_command, record)
+        if(record.get('code') == 'error'):
+            errors.setdefault(filename, []).append(message)
+        else:
+            messages.setdefault(filename, []).append(message)
+
+    results = {}
+    for filename in in_filenames:
+        if(filename in errors):
+            message = '\n'.join(messages.get(filename, []) + errors[filename])
+            results[filename] = (0, message)
+            if(success and (message.find('not on client') != -1 or message.find('no such file') != -1 or message.find('not in client view') != -1)):
+                index.SetUnversioned(filename)
+        else:
+            results[filename] = (1, '\n'.join(messages.get(filename, [])))
+
+    # errors that can't be related to a file, like a lost connection, fail every file
+    if(None in errors):
+        for filename in in_filenames:
+            if(results[filename][0]):
+                results[filename] = (0, '\n'.join(errors[None]))
+
+    # the status bar of the views of these files is out of date, and they are being worked on
+    view_status_service.Request(in_context, in_filenames)
+    for filename in in_filenames:
+        out_of_date_watcher.Touch(filename)
+    return results
+
+def PerforceFileOperation(in_context, in_command, in_filenames, in_changelist=None):
+    results = PerforceBatchFileOperation(in_context, in_command, in_filenames, in_changelist)
+
+    success = 1
+    messages = []
+    for filename in in_filenames:
+        filesuccess, message = results[filename]
+        if(not filesuccess):
+            success = 0
+        if(message and message not in messages):
+            messages.append(message)
+    return success, '\n'.join(messages)
+
+def GetPendingChangelists(in_context):
     # Launch p4 changes to retrieve all the pending changelists
-    currentuser = GetUserFromClientspec()
+    currentuser = GetUserFromClientspec(in_context)
     if(currentuser == -1):
         return 0, "Unexpected output from 'p4 info'."
 
-    command = ConstructCommand('p4 changes -s pending -u ' + currentuser)  
-
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    records, err = RunP4Command(['changes', '-s', 'pending', '-u', currentuser], in_context)
     if(not err):
-        return 1, result
-    return 0, result
+        return 1, records
+    return 0, err
+
+# Pending Changelists section
+# the pending changelists of each workspace are kept in memory, loaded with a single 'p4 changes', updated in place
+# by the plugin's own commands and revalidated in the background so that the pickers open without waiting
+pending_changelists_models = {}
+pending_changelists_models_lock = threading.Lock()
+
+class PendingChangelistsModel(object):
+    def __init__(self, in_context):
+        self.context = in_context.WithOrigin('Background reload')
+        self.loaded = False
+        self.changelists = {}
+        self.lock = threading.Lock()
+
+    def Load(self, in_context=None):
+        # each background reload is an invocation of its own
+        success, records = GetPendingChangelists(in_context or self.context.WithOrigin(self.context.origin))
+        if(not success):
+            return 0, records
+
+        changelists = {}
+        for record in records:
+            entry = {}
+            entry['change'] = record['change']
+            entry['desc'] = record.get('desc', '').strip()
+            entry['client'] = record.get('client', '')
+            entry['shelved'] = 'shelved' in record
+            changelists[record['change']] = entry
+
+        self.lock.acquire()
+        try:
+            self.changelists = changelists
+            self.loaded = True
+        finally:
+            self.lock.release()
+        return 1, ''
 
-def AppendToChangelistDescription(changelist, input):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = ConstructCommand('p4 change -o ' + changelist)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.loaded = False
+            self.changelists = {}
+        finally:
+            self.lock.release()
 
-    if(err):
-        return 0, err
+    def GetChangelists(self):
+        # most recent first, like 'p4 changes', with the number of opened files when the index is loaded
+        self.lock.acquire()
+        try:
+            changelists = [dict(entry) for entry in self.changelists.values()]
+        finally:
+            self.lock.release()
 
-    # Find the description field and modify it
-    lines = result.splitlines()
+        index = PeekOpenedFilesIndex(self.context)
+        for entry in changelists:
+            entry['files'] = None
+            if(index):
+                entry['files'] = len(index.GetFilesInChangelist(entry['change']))
 
-    descriptionindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Description:"):
-            descriptionindex = index
-            break;
-    
-    filesindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Files:"):
-            filesindex = index
-            break;
-
-    if(filesindex == -1): # The changelist is empty
-        endindex = index
-    else:
-        endindex = filesindex - 1
+        changelists.sort(key=lambda entry: int(entry['change']), reverse=True)
+        return changelists
 
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
-    lines.insert(endindex , "\t" + input)
+    def SetChangelist(self, in_change, in_description, in_client):
+        self.lock.acquire()
+        try:
+            entry = self.changelists.setdefault(in_change, {'change': in_change, 'shelved': False})
+            # like 'p4 changes', only the beginning of the description is kept
+            entry['desc'] = (in_description.strip().splitlines() or [''])[0]
+            entry['client'] = in_client
+        finally:
+            self.lock.release()
+
+    def SetShelved(self, in_change, in_shelved):
+        self.lock.acquire()
+        try:
+            if(in_change in self.changelists):
+                self.changelists[in_change]['shelved'] = in_shelved
+        finally:
+            self.lock.release()
 
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
+    def SetClosed(self, in_change):
+        self.lock.acquire()
+        try:
+            self.changelists.pop(in_change, None)
+        finally:
+            self.lock.release()
 
+def GetPendingChangelistsModel(in_context):
+    pending_changelists_models_lock.acquire()
     try:
-        temp_changelist_description_file.write(perforce_settings.get('perforce_end_line_separator').join(lines))
+        model = pending_changelists_models.get(in_context.key)
+        if(model is None):
+            model = PendingChangelistsModel(in_context)
+            pending_changelists_models[in_context.key] = model
     finally:
-        temp_changelist_description_file.close()
+        pending_changelists_models_lock.release()
 
-    command = ConstructCommand('p4 change -i < ' + temp_changelist_description_file.name)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    if(not model.loaded):
+        success, message = model.Load(in_context)
+        if(not success):
+            return 0, message
+
+    return 1, model
+
+def PeekPendingChangelistsModel(in_context):
+    # returns the model only if it can answer without going to the server
+    pending_changelists_models_lock.acquire()
+    try:
+        model = pending_changelists_models.get(in_context.key)
+    finally:
+        pending_changelists_models_lock.release()
 
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
+    if(model and model.loaded):
+        return model
+    return None
+
+def InvalidatePendingChangelistsModels():
+    pending_changelists_models_lock.acquire()
+    try:
+        pending_changelists_models.clear()
+    finally:
+        pending_changelists_models_lock.release()
+
+def ReloadPendingChangelistsModels():
+    pending_changelists_models_lock.acquire()
+    try:
+        models = pending_changelists_models.values()
+    finally:
+        pending_changelists_models_lock.release()
+
+    for model in models:
+        model.Load()
+
+def FormatChangelistEntry(in_entry):
+    text = "Changelist " + in_entry['change'] + " - " + in_entry['desc']
+    if(in_entry['files'] is not None):
+        text += " (" + str(in_entry['files']) + " file(s))"
+    if(in_entry['shelved']):
+        text += " [shelved]"
+    return text
+
+def AppendToChangelistDescription(in_context, changelist, input):
+    # Retrieve the changelist spec, the description is then extended by one line
+    records, err = RunP4Command(['change', '-o', changelist], in_context)
 
     if(err):
         return 0, err
 
-    return 1, result
+    spec = records[0]
+    del spec['code']
+    spec['Description'] = spec.get('Description', '').rstrip('\n') + '\n' + input + '\n'
 
-def PerforceCommandOnFile(in_command, in_folder, in_filename):
-    command = ConstructCommand('p4 ' + in_command + ' "' + in_filename + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    # the modified spec is sent back marshalled on the standard input of 'p4 change -i'
+    records, err = RunP4Command(['change', '-i'], in_context, marshal.dumps(spec, 0))
+
+    if(err):
+        return 0, err
+
+    model = PeekPendingChangelistsModel(in_context)
+    if(model):
+        model.SetChangelist(changelist, spec['Description'], spec.get('Client', ''))
+
+    return 1, records[0].get('data', '').strip()
+
+def PerforceCommandOnFile(in_context, in_command, in_folder, in_filename):
+    result, err = RunP4TextCommand(in_command.split(' ') + [in_filename], in_context)
 
     if(not err):
         return 1, result.strip()
@@ -290,26 +1720,681 @@ def IsFileWritable(in_filename):
         return 1
     return 0
 
-# Checkout section
-def Checkout(in_filename):
-    if(IsFileWritable(in_filename)):
-        return -1, "File is already writable."
+# Prefetch section
+# when the active view moves to another workspace, the data the first commands need is loaded ahead of time: the
+# connection info first, then the client view, the opened files and the pending changelists in parallel. Requests
+# are debounced, a newer request or a settings change cancels the steps not started yet
+class WorkspacePrefetcher(object):
+    def __init__(self):
+        self.generation = 0
+        self.lastkey = None
+        self.lock = threading.Lock()
+
+    def Request(self, in_folder):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        if(not perforce_settings.get('perforce_prefetch')):
+            return
 
-    folder_name, filename = os.path.split(in_filename)
-    isInDepot = IsFileInDepot(folder_name, filename)
+        generation = self.Cancel()
+        sublime.set_timeout(lambda: self.Start(in_folder, generation), 500)
 
-    if(isInDepot != 1):
-        return -1, "File is not under the client root."
-    
-    # check out the file
-    return PerforceCommandOnFile("edit", folder_name, in_filename);
+    def Cancel(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            return self.generation
+        finally:
+            self.lock.release()
+
+    def IsCancelled(self, in_generation):
+        return in_generation != self.generation
+
+    def Start(self, in_folder, in_generation):
+        if(self.IsCancelled(in_generation)):
+            return
+        threading.Thread(target=self.Prefetch, args=(in_folder, in_generation)).start()
+
+    def Prefetch(self, in_folder, in_generation):
+        context = WorkspaceContext(in_folder, self)
+        if(context.key == self.lastkey or self.IsCancelled(in_generation)):
+            return
+
+        success, info = GetConnectionInfo(context)
+        if(not success or not info['clientRoot'] or info['clientName'] == '*unknown*'):
+            return
+        self.lastkey = context.key
+
+        threads = []
+        for function in [GetClientView, GetOpenedFilesIndex, GetPendingChangelistsModel]:
+            if(self.IsCancelled(in_generation)):
+                break
+            thread = threading.Thread(target=function, args=(context,))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+    def Reset(self):
+        # the next request loads everything again
+        self.Cancel()
+        self.lastkey = None
+
+workspace_prefetcher = WorkspacePrefetcher()
+
+def PrefetchActiveWorkspace():
+    window = sublime.active_window()
+    if(window and window.active_view() and window.active_view().file_name()):
+        workspace_prefetcher.Request(os.path.dirname(window.active_view().file_name()))
+
+# View status section
+# the Perforce state of the files of the open views (opened for what and in which changelist, have and head
+# revisions) is shown in their status bar. The files are resolved in the background with one fstat per workspace:
+# the views are queried when they are loaded or saved, after the plugin changed their files, and all of them on the
+# configured interval
+view_status_fields = 'depotFile,clientFile,headRev,haveRev,headAction,action,change'
+
+def FormatViewStatus(in_record):
+    parts = []
+    if(in_record.get('action')):
+        change = in_record.get('change', 'default')
+        if(change == 'default'):
+            parts.append(in_record['action'] + " in the default changelist")
+        else:
+            parts.append(in_record['action'] + " in change " + change)
+    if(in_record.get('haveRev') and in_record.get('headRev')):
+        revision = "#" + in_record['haveRev'] + "/" + in_record['headRev']
+        if(int(in_record['haveRev']) < int(in_record['headRev'])):
+            revision += " (out of date)"
+        parts.append(revision)
+    elif(in_record.get('headAction', '').find('delete') != -1):
+        parts.append("deleted at head")
+    elif(in_record.get('headRev') and in_record.get('action') != 'add'):
+        parts.append("not synced")
+    return "Perforce: " + ', '.join(parts)
+
+class ViewStatusService(threading.Thread):
+    def __init__(self):
+        self.queue = Queue()
+        # normalized file name -> text of its status, empty once resolved without one (out of the client view)
+        self.statuses = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def Stop(self):
+        # the thread ends once the requests already picked up are resolved
+        self.stopped = True
+        self.queue.put(None)
+
+    def Request(self, in_context, in_filenames):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        if(perforce_settings.get('perforce_view_status') and in_filenames):
+            self.queue.put((in_context, in_filenames))
+
+    def GetStatus(self, in_filename):
+        # None until the file is resolved
+        self.lock.acquire()
+        try:
+            return self.statuses.get(os.path.normcase(in_filename))
+        finally:
+            self.lock.release()
+
+    def Resolve(self, in_context, in_filenames):
+        # the files out of the client view have no status, the others are resolved with a single call
+        statuses = {}
+        filenames = []
+        for filename in in_filenames:
+            statuses[os.path.normcase(filename)] = ''
+            if(IsFileUnderClientView(in_context, filename)):
+                filenames.append(filename)
+        records = []
+        if(filenames):
+            records = list(P4Records(['-x', '-', 'fstat', '-T', view_status_fields], in_context, '\n'.join(filenames) + '\n'))
+            # the revisions are fresh, the out of date watcher doesn't need to ask for them again
+            out_of_date_watcher.Record(records)
+        self.Store(records, statuses)
+
+    def Store(self, in_records, in_statuses=None):
+        statuses = in_statuses or {}
+        for record in in_records:
+            if(record.get('code') == 'stat' and record.get('clientFile')):
+                statuses[os.path.normcase(record['clientFile'])] = FormatViewStatus(record)
+            elif(record.get('code') == 'error' and record.get('data', '').find('no such file') != -1):
+                path = record['data'].split(' - ')[0].strip()
+                statuses[os.path.normcase(path)] = "Perforce: not in depot"
+
+        self.lock.acquire()
+        try:
+            self.statuses.update(statuses)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while not self.stopped:
+            jobs = [self.queue.get()]
+            # views loaded together (a project being opened) are resolved together
+            time.sleep(0.2)
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            jobs = [job for job in jobs if job is not None]
+
+            contexts = {}
+            filenames = {}
+            for context, jobfilenames in jobs:
+                if(context.key not in contexts):
+                    contexts[context.key] = context
+                    filenames[context.key] = set()
+                filenames[context.key].update(jobfilenames)
+
+            for key, context in contexts.items():
+                try:
+                    self.Resolve(context.WithOrigin('View status'), sorted(filenames[key]))
+                except Exception, e:
+                    print "Perforce: unable to get the status of the open files: " + str(e)
+            sublime.set_timeout(ShowViewStatuses, 10)
+
+view_status_service = ViewStatusService()
+
+def ShowViewStatus(in_view):
+    status = None
+    if(in_view.file_name()):
+        status = view_status_service.GetStatus(in_view.file_name())
+    if(status):
+        in_view.set_status('perforce_file', status)
+    else:
+        in_view.erase_status('perforce_file')
+
+def ShowViewStatuses():
+    for window in sublime.windows():
+        for view in window.views():
+            ShowViewStatus(view)
+
+def RequestViewStatuses(in_views):
+    # one context per folder, the service groups the folders of a workspace
+    filenames = {}
+    for view in in_views:
+        if(view.file_name()):
+            filenames.setdefault(os.path.dirname(view.file_name()), []).append(view.file_name())
+    for folder, folderfilenames in filenames.items():
+        context = WorkspaceContext(folder, 'View status')
+        view_status_service.Request(context, folderfilenames)
+        out_of_date_watcher.Track(context, folderfilenames)
+
+def RequestAllViewStatuses():
+    views = []
+    for window in sublime.windows():
+        views.extend(window.views())
+    RequestViewStatuses(views)
+
+def ScheduleViewStatusesRefresh(in_stopped):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    interval = perforce_settings.get('perforce_view_status_refresh_interval')
+
+    def refresh_statuses():
+        if(in_stopped.isSet()):
+            return
+        if(interval and interval > 0):
+            RequestAllViewStatuses()
+        ScheduleViewStatusesRefresh(in_stopped)
+
+    # when disabled, the setting is checked again every minute
+    if(not interval or interval <= 0):
+        sublime.set_timeout(refresh_statuses, 60000)
+    else:
+        sublime.set_timeout(refresh_statuses, int(interval * 1000))
+
+class PerforceViewStatus(sublime_plugin.EventListener):
+    def on_load(self, view):
+        RequestViewStatuses([view])
+
+    def on_post_save(self, view):
+        RequestViewStatuses([view])
+        if(view.file_name()):
+            out_of_date_watcher.Touch(view.file_name())
+
+    def on_close(self, view):
+        if(view.file_name()):
+            out_of_date_watcher.Forget(view.file_name())
+
+    def on_activated(self, view):
+        # a view of a file already resolved shows its status at once, the others are queried
+        if(view.file_name()):
+            if(view_status_service.GetStatus(view.file_name()) is None):
+                RequestViewStatuses([view])
+            ShowViewStatus(view)
+
+# Out of date section
+# the files of the open views and the opened files are watched for newer revisions submitted by others. Every file
+# has its own polling interval: it doubles each time its head revision is found unchanged, up to a maximum, and goes
+# back to the minimum when the file is saved or checked out. The files due are resolved together with one fstat per
+# workspace, and no more than the configured number of queries is sent to the server per minute
+class OutOfDateWatcher(threading.Thread):
+    def __init__(self):
+        # normalized file name -> {filename, context, have, head, interval, due, view, opened, warned}
+        self.files = {}
+        self.contexts = {}
+        # times of the queries of the last minute
+        self.queries = deque()
+        # workspace key -> (index, generation) of the opened files last tracked
+        self.openedgenerations = {}
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.stopped = False
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def Stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def GetIntervals(self):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        mininterval = perforce_settings.get('perforce_out_of_date_min_interval') or 30
+        maxinterval = perforce_settings.get('perforce_out_of_date_max_interval') or 600
+        return mininterval, max(mininterval, maxinterval)
+
+    def AddFile(self, in_context, in_filename, in_due):
+        key = os.path.normcase(in_filename)
+        entry = self.files.get(key)
+        if(entry is None):
+            entry = {'filename': in_filename, 'context': in_context, 'have': None, 'head': None,
+                'interval': self.GetIntervals()[0], 'due': in_due, 'view': False, 'opened': False, 'warned': False}
+            self.files[key] = entry
+        self.contexts[in_context.key] = in_context
+        return entry
+
+    def Track(self, in_context, in_filenames):
+        # the views are resolved by the status bar at the same time, their first check comes one interval later
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for filename in in_filenames:
+                self.AddFile(in_context, filename, now + self.GetIntervals()[0])['view'] = True
+        finally:
+            self.lock.release()
+
+    def Touch(self, in_filename):
+        # a file being worked on is checked again soon, and then often
+        self.lock.acquire()
+        try:
+            entry = self.files.get(os.path.normcase(in_filename))
+            if(entry):
+                entry['interval'] = self.GetIntervals()[0]
+                entry['due'] = min(entry['due'], time.time() + entry['interval'])
+        finally:
+            self.lock.release()
+        # the watcher may be sleeping until a later file is due
+        self.wakeup.set()
+
+    def Forget(self, in_filename):
+        self.lock.acquire()
+        try:
+            entry = self.files.get(os.path.normcase(in_filename))
+            if(entry):
+                entry['view'] = False
+                if(not entry['opened']):
+                    del self.files[os.path.normcase(in_filename)]
+        finally:
+            self.lock.release()
+
+    def Record(self, in_records):
+        # applies fresh revisions, returns the entries of the files which just became out of date
+        now = time.time()
+        mininterval = self.GetIntervals()[0]
+        stale = []
+        self.lock.acquire()
+        try:
+            for record in in_records:
+                if(record.get('code') != 'stat' or not record.get('clientFile')):
+                    continue
+                entry = self.files.get(os.path.normcase(record['clientFile']))
+                if(entry is None):
+                    continue
+
+                # the poll already backed off, a new head revision brings the file back to the shortest interval
+                head = record.get('headRev')
+                if(entry['head'] is not None and head != entry['head']):
+                    entry['interval'] = mininterval
+                entry['have'] = record.get('haveRev')
+                entry['head'] = head
+                entry['due'] = now + entry['interval']
+
+                isstale = IsRevisionOutOfDate(entry['have'], entry['head']) and record.get('action') != 'add'
+                if(isstale and not entry['warned']):
+                    stale.append(entry)
+                entry['warned'] = isstale
+        finally:
+            self.lock.release()
+        return stale
+
+    def GetOutOfDateMessage(self, in_filename):
+        # answered from what is known, without going to the server
+        self.lock.acquire()
+        try:
+            entry = self.files.get(os.path.normcase(in_filename))
+            if(entry and IsRevisionOutOfDate(entry['have'], entry['head'])):
+                return os.path.basename(in_filename) + " is out of date: you have #" + entry['have'] + ", the head revision is #" + entry['head'] + "."
+            return None
+        finally:
+            self.lock.release()
+
+    def TrackOpenedFiles(self):
+        # the opened files come from the loaded indexes, the server isn't asked for them. They are only gone through
+        # again when an index changed
+        self.lock.acquire()
+        try:
+            contexts = self.contexts.values()
+        finally:
+            self.lock.release()
+
+        changedkeys = set()
+        openedfiles = {}
+        for context in contexts:
+            index = PeekOpenedFilesIndex(context)
+            generation = None
+            if(index):
+                generation = (index, index.generation)
+            if(self.openedgenerations.get(context.key) == generation):
+                continue
+            self.openedgenerations[context.key] = generation
+            changedkeys.add(context.key)
+            if(index):
+                for entry in index.GetAllFiles():
+                    if(entry['action'] not in ('add', 'branch', 'move/add')):
+                        openedfiles[os.path.normcase(entry['localFile'])] = (context, entry['localFile'])
+        if(not changedkeys):
+            return
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for key, entry in self.files.items():
+                if(entry['context'].key not in changedkeys):
+                    continue
+                entry['opened'] = key in openedfiles
+                if(not entry['opened'] and not entry['view']):
+                    del self.files[key]
+            for context, filename in openedfiles.values():
+                self.AddFile(context, filename, now)['opened'] = True
+        finally:
+            self.lock.release()
+
+    def GetNextQueryTime(self):
+        # now when a query is allowed, otherwise when the oldest query of the last minute leaves the window
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        maxqueries = perforce_settings.get('perforce_out_of_date_max_queries_per_minute') or 6
+        now = time.time()
+        while self.queries and self.queries[0] < now - 60:
+            self.queries.popleft()
+        if(len(self.queries) < maxqueries):
+            return now
+        return self.queries[0] + 60
+
+    def Poll(self):
+        # returns when the watcher has something to do next
+        self.TrackOpenedFiles()
+
+        now = time.time()
+        nextdue = now + self.GetIntervals()[0]
+        dues = {}
+        self.lock.acquire()
+        try:
+            for entry in self.files.values():
+                if(entry['due'] <= now):
+                    dues.setdefault(entry['context'].key, (entry['context'], []))[1].append(entry['filename'])
+                else:
+                    nextdue = min(nextdue, entry['due'])
+        finally:
+            self.lock.release()
+
+        for context, filenames in dues.values():
+            # over the cap, the files stay due and are resolved as soon as a query is allowed
+            nextquery = self.GetNextQueryTime()
+            if(nextquery > time.time()):
+                return nextquery
+            self.queries.append(time.time())
+
+            # backs off before asking, the files without an answer (not in the depot, lost connection) back off too
+            self.lock.acquire()
+            try:
+                maxinterval = self.GetIntervals()[1]
+                for filename in filenames:
+                    entry = self.files.get(os.path.normcase(filename))
+                    if(entry):
+                        entry['due'] = time.time() + entry['interval']
+                        entry['interval'] = min(entry['interval'] * 2, maxinterval)
+            finally:
+                self.lock.release()
+
+            # each poll is an invocation of its own in the stats
+            records = list(P4Records(['-x', '-', 'fstat', '-T', view_status_fields], context.WithOrigin('Out of date watcher'), '\n'.join(filenames) + '\n'))
+            for entry in self.Record(records):
+                WarnUser(entry['filename'] + " was updated to #" + entry['head'] + " on the server, you have #" + entry['have'] + ".")
+            view_status_service.Store(records)
+            sublime.set_timeout(ShowViewStatuses, 10)
+        return nextdue
+
+    def run(self):
+        # sleeps until the next file is due, at most the shortest interval so that the opened files and the settings
+        # are looked at again, or until a file is touched
+        while not self.stopped:
+            nextpoll = time.time() + self.GetIntervals()[0]
+            perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+            if(perforce_settings.get('perforce_out_of_date_watcher')):
+                try:
+                    nextpoll = min(self.Poll(), nextpoll)
+                except Exception, e:
+                    print "Perforce: unable to check the open files for newer revisions: " + str(e)
+            self.wakeup.wait(max(nextpoll - time.time(), 0.1))
+            self.wakeup.clear()
+
+def IsRevisionOutOfDate(in_have, in_head):
+    return bool(in_have and in_head and in_have != 'none' and int(in_have) < int(in_head))
+
+out_of_date_watcher = OutOfDateWatcher()
+
+# Background work section
+# automatic operations triggered by editor events are run on a worker thread. Requests for the same operation on the
+# same file are coalesced while one is queued or running, requests made within the batch window are sent to p4 in a
+# single call and results are reported on the main thread
+class PerforceWorkQueue(threading.Thread):
+    def __init__(self, in_batchfunctions):
+        self.batchfunctions = in_batchfunctions
+        self.queue = Queue()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def Stop(self):
+        # the batch being run is finished, the work still queued is dropped and its waiters released
+        self.stopped = True
+        self.queue.put(None)
+
+    def Enqueue(self, in_command, in_context, in_filenames, in_batchwindow=0):
+        events = []
+        filenames = []
+        self.lock.acquire()
+        try:
+            for filename in in_filenames:
+                event = self.pending.get((in_command, filename))
+                if(event is None):
+                    event = threading.Event()
+                    self.pending[(in_command, filename)] = event
+                    filenames.append(filename)
+                events.append(event)
+            if(filenames):
+                self.queue.put((in_command, in_context, filenames, in_batchwindow))
+            return events
+        finally:
+            self.lock.release()
+
+    def IsPending(self, in_command, in_filename):
+        self.lock.acquire()
+        try:
+            return (in_command, in_filename) in self.pending
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            # give the other events of the same burst the chance to join the batch
+            if(jobs[0] is not None and jobs[0][3] > 0):
+                time.sleep(jobs[0][3])
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if(self.stopped):
+                self.lock.acquire()
+                try:
+                    for event in self.pending.values():
+                        event.set()
+                    self.pending.clear()
+                finally:
+                    self.lock.release()
+                return
+            jobs = [job for job in jobs if job is not None]
+
+            # one batch per command and workspace
+            batches = []
+            contexts = {}
+            for command, context, filenames, batchwindow in jobs:
+                if((command, context.key) not in contexts):
+                    contexts[(command, context.key)] = context
+                    batches.append((command, context.key))
+
+            for command, key in batches:
+                filenames = []
+                for jobcommand, jobcontext, jobfilenames, batchwindow in jobs:
+                    if(jobcommand == command and jobcontext.key == key):
+                        filenames.extend(jobfilenames)
+
+                try:
+                    results = self.batchfunctions[command](contexts[(command, key)], filenames)
+                except Exception, e:
+                    results = dict([(filename, (0, str(e))) for filename in filenames])
+
+                self.lock.acquire()
+                try:
+                    for filename in filenames:
+                        self.pending.pop((command, filename)).set()
+                finally:
+                    self.lock.release()
+
+                def log_results(results=results):
+                    for success, message in results.values():
+                        if(message):
+                            LogResults(success, message)
+                sublime.set_timeout(log_results, 10)
+
+# seconds a save waits for the checkout of its file when the 'edit' command has no deadline
+auto_checkout_max_wait = 30
+
+def GetBatchWindow():
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    batchwindow = perforce_settings.get('perforce_batch_window')
+    if(batchwindow is None):
+        batchwindow = 100
+    return batchwindow / 1000.0
+
+# Checkout section
+def CheckoutFiles(in_context, in_filenames):
+    results = {}
+    candidates = []
+    success, entries, unversioned = GetOpenedFileEntries(in_context, in_filenames)
+    # the files found not to be in the depot aren't asked about again until the index is reloaded
+    index = PeekOpenedFilesIndex(in_context)
+    for filename in in_filenames:
+        if(success):
+            # the server knows about files opened elsewhere and files made writable by hand
+            entry = entries[filename]
+            if(entry):
+                results[filename] = (-1, "File is already opened for " + entry['action'] + ".")
+                continue
+            if(filename in unversioned):
+                if(index):
+                    index.SetUnversioned(filename)
+                results[filename] = (-1, "File is not in the depot.")
+                continue
+        elif(IsFileWritable(filename)):
+            results[filename] = (-1, "File is already writable.")
+            continue
+
+        folder_name, name = os.path.split(filename)
+        if(IsFileInDepot(in_context, folder_name, name) != 1):
+            if(index and IsFileWritable(filename)):
+                index.SetUnversioned(filename)
+            results[filename] = (-1, "File is not under the client root.")
+            continue
+
+        candidates.append(filename)
+
+    # check out the files
+    if(candidates):
+        results.update(PerforceBatchFileOperation(in_context, "edit", candidates))
+    return results
+
+def Checkout(in_context, in_filename):
+    return CheckoutFiles(in_context, [in_filename])[in_filename]
+
+def AutoCheckoutFiles(in_context, in_filenames):
+    # a writable file is only opened if it's known to the depot, and that without any noise when it isn't
+    writablefiles = set([filename for filename in in_filenames if IsFileWritable(filename)])
+    index = PeekOpenedFilesIndex(in_context)
+    success = index is not None
+    if(not success):
+        ScheduleOpenedFilesIndexLoad(in_context)
+
+    filenames = []
+    for filename in in_filenames:
+        if(filename not in writablefiles or (success and not index.IsUnversioned(filename))):
+            filenames.append(filename)
+
+    # the checkout isn't held back, but editing a stale revision means a resolve at submit time
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    if(perforce_settings.get('perforce_warn_out_of_date_checkout')):
+        for filename in filenames:
+            message = out_of_date_watcher.GetOutOfDateMessage(filename)
+            if(message):
+                WarnUser(message + " Checking it out anyway, sync it to avoid a resolve.")
+
+    results = CheckoutFiles(in_context, filenames)
+    for filename in in_filenames:
+        if(filename not in results or (filename in writablefiles and results[filename][0] != 1)):
+            results[filename] = (-1, '')
+    return results
+
+def NeedsAutoCheckout(in_context, in_filename):
+    # answered on the main thread, the server is only queried from the work queue
+    if(not IsFileWritable(in_filename)):
+        return 1
+
+    # a writable file is left alone until the index can tell whether it's opened or not in the depot, otherwise
+    # every save of a file outside of the depot would go to the server
+    index = PeekOpenedFilesIndex(in_context)
+    if(index is None):
+        ScheduleOpenedFilesIndexLoad(in_context)
+        return 0
+    if(index.GetByLocalFile(in_filename) or index.IsUnversioned(in_filename)):
+        return 0
+    return 1
   
 class PerforceAutoCheckout(sublime_plugin.EventListener):  
     def on_modified(self, view):
         if(not view.file_name()):
             return
 
-        if(IsFileWritable(view.file_name())):
+        context = GetViewContext(view, self)
+        if(not NeedsAutoCheckout(context, view.file_name())):
             return
 
         perforce_settings = sublime.load_settings('Perforce.sublime-settings')
@@ -319,9 +2404,7 @@ class PerforceAutoCheckout(sublime_plugin.EventListener):
             return
               
         if(view.is_dirty()):
-            PrepareCommand();
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+            perforce_work_queue.Enqueue('edit', context, [view.file_name()], GetBatchWindow())
 
     def on_pre_save(self, view):
         perforce_settings = sublime.load_settings('Perforce.sublime-settings')
@@ -330,70 +2413,104 @@ class PerforceAutoCheckout(sublime_plugin.EventListener):
         if(not perforce_settings.get('perforce_auto_checkout') or not perforce_settings.get('perforce_auto_checkout_on_save')):
             return
               
-        if(view.is_dirty()):
-            PrepareCommand();
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+        if(not view.file_name() or not view.is_dirty()):
+            return
+
+        context = GetViewContext(view, self)
+        if(NeedsAutoCheckout(context, view.file_name())):
+            if(IsFileWritable(view.file_name())):
+                perforce_work_queue.Enqueue('edit', context, [view.file_name()], GetBatchWindow())
+                return
+
+            # a read-only file has to be writable before Sublime Text writes it, so this waits for the checkout (or
+            # the one already requested by on_modified) to complete. Saves happen one after the other: for a
+            # "Save All", the other modified read-only views of the workspace are checked out in the same batch
+            filenames = []
+            if(perforce_settings.get('perforce_auto_checkout_batch_modified_views') and view.window()):
+                for otherview in view.window().views():
+                    filename = otherview.file_name()
+                    if(filename and filename != view.file_name() and otherview.is_dirty() and not IsFileWritable(filename)):
+                        if(GetViewContext(otherview, self).key == context.key):
+                            filenames.append(filename)
+            filenames.append(view.file_name())
+
+            # bounded by the deadline of the checkout, the editor isn't blocked longer when the server doesn't answer.
+            # Without a deadline, the save waits no longer than auto_checkout_max_wait
+            timeout = GetCommandTimeout(['edit']) or auto_checkout_max_wait
+            event = perforce_work_queue.Enqueue('edit', context, filenames)[-1]
+            event.wait(timeout + GetBatchWindow())
+            if(not event.isSet()):
+                WarnUser("The checkout of " + view.file_name() + " did not complete in time.")
 
 class PerforceCheckoutCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         if(self.view.file_name()):
-            PrepareCommand();
-            success, message = Checkout(self.view.file_name())
+            perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+            if(perforce_settings.get('perforce_warn_out_of_date_checkout')):
+                message = out_of_date_watcher.GetOutOfDateMessage(self.view.file_name())
+                if(message and not sublime.ok_cancel_dialog(message + "\n\nCheck it out anyway?", "Checkout")):
+                    return
+            success, message = Checkout(GetViewContext(self.view, self), self.view.file_name())
             LogResults(success, message)
         else:
             WarnUser("View does not contain a file")
 
 # Add section
-def Add(in_folder, in_filename):
+def Add(in_context, in_folder, in_filename):
     # add the file
-    return PerforceCommandOnFile("add", in_folder, in_filename);
+    return PerforceFileOperation(in_context, "add", [os.path.join(in_folder, in_filename)]);
+
+def AutoAddFiles(in_context, in_filenames):
+    results = {}
+    candidates = []
+    for filename in in_filenames:
+        if(IsFileUnderClientView(in_context, filename)):
+            candidates.append(filename)
+        else:
+            results[filename] = (-1, "Adding file outside of clientspec, ignored for auto add")
+
+    if(candidates):
+        results.update(PerforceBatchFileOperation(in_context, "add", candidates))
+    return results
+
+perforce_work_queue = PerforceWorkQueue({'edit': AutoCheckoutFiles, 'add': AutoAddFiles})
+
+# the opened files indexes are loaded on their own queue, the checkouts don't wait behind a long 'p4 opened'
+perforce_index_queue = PerforceWorkQueue({'index': LoadOpenedFilesIndexInBackground})
 
 class PerforceAutoAdd(sublime_plugin.EventListener):
-    preSaveIsFileInDepot = 0
+    def __init__(self):
+        self.newfiles = set()
+
     def on_pre_save(self, view):
         # file already exists, no need to add
         if view.file_name() and os.path.isfile(view.file_name()):
             return
 
-        global global_folder
-        global_folder, filename = os.path.split(view.file_name())
-
         perforce_settings = sublime.load_settings('Perforce.sublime-settings')
 
-        self.preSaveIsFileInDepot = 0
-
         # check if this part of the plugin is enabled
         if(not perforce_settings.get('perforce_auto_add')):
             WarnUser("Auto Add disabled")
             return
 
-        PrepareCommand();
-
-        folder_name, filename = os.path.split(view.file_name())
-
-        if(not IsFolderUnderClientRoot(folder_name)):
-            WarnUser("Adding file outside of clientspec, ignored for auto add")
-            return
-
-        self.preSaveIsFileInDepot = IsFileInDepot(folder_name, filename)
+        # the clientspec check is left to the worker thread, only remember that the file is new
+        self.newfiles.add(view.file_name())
 
     def on_post_save(self, view):
-        if(self.preSaveIsFileInDepot == -1):
-            PrepareCommand();
-            folder_name, filename = os.path.split(view.file_name())
-            success, message = Add(folder_name, filename)
-            LogResults(success, message)
+        if(view.file_name() in self.newfiles):
+            self.newfiles.discard(view.file_name())
+            perforce_work_queue.Enqueue('add', GetViewContext(view, self), [view.file_name()], GetBatchWindow())
 
 class PerforceAddCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         if(self.view.file_name()):
-            PrepareCommand();
+            context = GetViewContext(self.view, self)
 
             folder_name, filename = os.path.split(self.view.file_name())
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = Add(folder_name, filename)
+            if(IsFileInDepot(context, folder_name, filename)):
+                success, message = Add(context, folder_name, filename)
             else:
                 success = 0
                 message = "File is not under the client root."
@@ -403,180 +2520,1221 @@ class PerforceAddCommand(sublime_plugin.TextCommand):
             WarnUser("View does not contain a file")
 
 # Rename section
-def Rename(in_filename, in_newname):
-    command = ConstructCommand('p4 integrate -d -t -Di -f "' + in_filename + '" "' + in_newname + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+def Rename(in_context, in_filename, in_newname):
+    result, err = RunP4TextCommand(['integrate', '-d', '-t', '-Di', '-f', in_filename, in_newname], in_context)
 
     if(err):
         return 0, err.strip()
     
-    command = ConstructCommand('p4 delete "' + in_filename + '" "' + in_newname + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    result, err = RunP4TextCommand(['delete', in_filename, in_newname], in_context)
+
+    index = PeekOpenedFilesIndex(in_context)
+    if(index):
+        index.Invalidate()
 
     if(not err):
         return 1, result.strip()
     else:
         return 0, err.strip()
 
-class PerforceRenameCommand(sublime_plugin.WindowCommand):
-    def run(self):
-        # Get the description
-        self.window.show_input_panel('New File Name', self.window.active_view().file_name(),
-            self.on_done, self.on_change, self.on_cancel)
+class PerforceRenameCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        # Get the description
+        self.window.show_input_panel('New File Name', self.window.active_view().file_name(),
+            self.on_done, self.on_change, self.on_cancel)
+
+    def on_done(self, input):
+        success, message = Rename(GetWindowContext(self.window, self), self.window.active_view().file_name(), input)
+        if(success):
+            self.window.run_command('close')
+            self.window.open_file(input)
+
+        LogResults(success, message)
+
+    def on_change(self, input):
+        pass
+
+    def on_cancel(self):
+        pass
+
+# Delete section
+def Delete(in_context, in_folder, in_filename):
+    success, message = PerforceFileOperation(in_context, "delete", [os.path.join(in_folder, in_filename)])
+    if(success):
+        # test if the file is deleted
+        if(os.path.isfile(os.path.join(in_folder, in_filename))):
+            success = 0
+
+    return success, message
+
+class PerforceDeleteCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(self.window.active_view().file_name()):
+            context = GetWindowContext(self.window, self)
+
+            folder_name, filename = os.path.split(self.window.active_view().file_name())
+
+            if(IsFileInDepot(context, folder_name, filename)):
+                success, message = Delete(context, folder_name, filename)
+                if(success): # the file was properly deleted on perforce, ask Sublime Text to close the view
+                    self.window.run_command('close');
+            else:
+                success = 0
+                message = "File is not under the client root."
+
+            LogResults(success, message)
+        else:
+            WarnUser("View does not contain a file")
+
+# Revert section
+def Revert(in_context, in_folder, in_filename):
+    # revert the file
+    return PerforceFileOperation(in_context, "revert", [os.path.join(in_folder, in_filename)]);
+
+class PerforceRevertCommand(sublime_plugin.TextCommand):
+    def run_(self, args): # revert cannot be called when an Edit object exists, manually handle the run routine
+        if(self.view.file_name()):
+            context = GetViewContext(self.view, self)
+
+            folder_name, filename = os.path.split(self.view.file_name())
+
+            if(IsFileInDepot(context, folder_name, filename)):
+                success, message = Revert(context, folder_name, filename)
+                if(success): # the file was properly reverted, ask Sublime Text to refresh the view
+                    self.view.run_command('revert');
+            else:
+                success = 0
+                message = "File is not under the client root."
+
+            LogResults(success, message)
+        else:
+            WarnUser("View does not contain a file")
+
+# Open Views section
+def GetOpenViewFileNames(in_window):
+    filenames = []
+    for view in in_window.views():
+        if(view.file_name() and view.file_name() not in filenames):
+            filenames.append(view.file_name())
+    return filenames
+
+class OpenViewsOperationThread(threading.Thread):
+    def __init__(self, window, context, command, filenames):
+        self.window = window
+        self.context = context
+        self.command = command
+        self.filenames = filenames
+        threading.Thread.__init__(self)
+
+    def run(self):
+        if(self.command == 'edit'):
+            results = CheckoutFiles(self.context, self.filenames)
+        else:
+            # only the files opened on this client are sent to p4
+            success, index = GetOpenedFilesIndex(self.context)
+            filenames = self.filenames
+            if(success):
+                filenames = [filename for filename in filenames if index.GetByLocalFile(filename)]
+            results = {}
+            if(filenames):
+                results = PerforceBatchFileOperation(self.context, self.command, filenames)
+
+        def show_results():
+            done = 0
+            for filename in self.filenames:
+                if(filename not in results):
+                    continue
+                success, message = results[filename]
+                if(success == 1):
+                    done += 1
+                    if(self.command == 'revert'): # ask Sublime Text to refresh the reverted views
+                        for view in self.window.views():
+                            if(view.file_name() == filename):
+                                view.run_command('revert')
+                if(message):
+                    LogResults(success, message)
+            sublime.status_message("Perforce: " + self.command + " done on " + str(done) + " of " + str(len(self.filenames)) + " open file(s)")
+        sublime.set_timeout(show_results, 10)
+
+class PerforceCheckoutOpenViewsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        filenames = GetOpenViewFileNames(self.window)
+        if(not filenames):
+            WarnUser("No open view contains a file")
+            return
+
+        OpenViewsOperationThread(self.window, GetWindowContext(self.window, self), 'edit', filenames).start()
+
+class PerforceRevertOpenViewsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        filenames = GetOpenViewFileNames(self.window)
+        if(not filenames):
+            WarnUser("No open view contains a file")
+            return
+
+        OpenViewsOperationThread(self.window, GetWindowContext(self.window, self), 'revert', filenames).start()
+
+# Output panel section
+# the Perforce output panel shows the output of the long commands, its content is replaced by each of them
+def ShowOutputPanel(in_window, in_text):
+    panel = in_window.get_output_panel('perforce')
+    edit = panel.begin_edit()
+    panel.erase(edit, sublime.Region(0, panel.size()))
+    panel.insert(edit, 0, in_text)
+    panel.end_edit(edit)
+    in_window.run_command('show_panel', {'panel': 'output.perforce'})
+
+def AppendToOutputPanel(in_window, in_text):
+    panel = in_window.get_output_panel('perforce')
+    edit = panel.begin_edit()
+    panel.insert(edit, panel.size(), in_text)
+    panel.end_edit(edit)
+    panel.show(panel.size())
+
+# Folder operations section
+# folders are checked out, reverted when unchanged or reconciled with a single wildcard p4 call per workspace
+# ('p4 edit dir/...') whatever the number of files they contain; the records are only counted per action and
+# summarised in the Perforce output panel
+folder_operations = {
+    'edit': ['edit'],
+    'revert_unchanged': ['revert', '-a'],
+    'reconcile': ['reconcile'],
+}
+
+def GetFolderFileSpec(in_path):
+    if(os.path.isdir(in_path)):
+        return os.path.join(in_path, '...')
+    return in_path
+
+def SummarizeRecords(in_title, in_command, in_records):
+    # the number of files per action, with the messages of a few files: they tell what happened to the others
+    actions = {}
+    messages = []
+    errors = []
+    for record in in_records:
+        if(record.get('code') == 'stat'):
+            action = record.get('action', in_command)
+            actions[action] = actions.get(action, 0) + 1
+        elif(record.get('code') == 'error'):
+            errors.append(record.get('data', '').strip())
+        elif(record.get('data', '').strip()):
+            messages.append(record.get('data', '').strip())
+
+    lines = [in_title]
+    for action in sorted(actions.keys()):
+        lines.append("  " + action + ": " + str(actions[action]) + " file(s)")
+    if(not actions):
+        lines.append("  no file changed")
+    for title, entries in [("messages", messages), ("errors", errors)]:
+        if(entries):
+            lines.append("  " + title + ": " + str(len(entries)))
+            lines.extend(["    " + entry for entry in entries[:10]])
+            if(len(entries) > 10):
+                lines.append("    ...")
+    return '\n'.join(lines) + '\n'
+
+def GroupPathsByWorkspace(in_paths, in_origin):
+    # [(context, paths)] in the order the workspaces first appear
+    groups = []
+    contexts = {}
+    for path in in_paths:
+        folder = path
+        if(not os.path.isdir(folder)):
+            folder = os.path.dirname(path)
+        context = WorkspaceContext(folder, in_origin)
+        if(context.key not in contexts):
+            contexts[context.key] = (context, [])
+            groups.append(contexts[context.key])
+        contexts[context.key][1].append(path)
+    return groups
+
+class FolderOperationThread(threading.Thread):
+    def __init__(self, window, origin, operation, paths):
+        self.window = window
+        self.origin = origin
+        self.arguments = folder_operations[operation]
+        self.paths = paths
+        threading.Thread.__init__(self)
+
+    def run(self):
+        sublime.set_timeout(lambda: ShowOutputPanel(self.window, "Perforce: running p4 " + ' '.join(self.arguments) + " on " + str(len(self.paths)) + " path(s)\n"), 10)
+
+        revertedfiles = set()
+        for context, paths in GroupPathsByWorkspace(self.paths, self.origin):
+            filespecs = [GetFolderFileSpec(path) for path in paths]
+            records = list(P4Records(self.arguments + filespecs, context))
+
+            success, index = GetOpenedFilesIndex(context)
+            if(success):
+                index.Update(self.arguments[0], 'default', records)
+            if(self.arguments[0] == 'revert'):
+                for record in records:
+                    if(record.get('code') == 'stat' and record.get('clientFile') and not record['clientFile'].startswith('//')):
+                        revertedfiles.add(os.path.normcase(record['clientFile']))
+
+            summary = SummarizeRecords("p4 " + ' '.join(self.arguments + filespecs), self.arguments[0], records)
+            sublime.set_timeout(lambda summary=summary: AppendToOutputPanel(self.window, summary), 10)
+
+        def refresh_views():
+            # ask Sublime Text to reload the reverted files
+            for view in self.window.views():
+                if(view.file_name() and os.path.normcase(view.file_name()) in revertedfiles):
+                    view.run_command('revert')
+            RequestAllViewStatuses()
+            sublime.status_message("Perforce: p4 " + ' '.join(self.arguments) + " done")
+        sublime.set_timeout(refresh_views, 10)
+
+class PerforceFolderOperationCommand(sublime_plugin.WindowCommand):
+    def run(self, operation, paths=[]):
+        # the side bar passes the selected folders and files, the folder of the current file is used otherwise
+        if(not paths):
+            view = self.window.active_view()
+            if(view and view.file_name()):
+                paths = [os.path.dirname(view.file_name())]
+            elif(last_activated_folder):
+                paths = [last_activated_folder]
+            else:
+                WarnUser("No folder selected")
+                return
+
+        FolderOperationThread(self.window, self, operation, paths).start()
+
+# Changed files scan section
+# the files edited while writable but not opened are found without digesting the whole workspace: an index of the
+# have revisions (depot file, revision, type and server digest from 'p4 fstat -Ol') is kept on disk per workspace,
+# along with the size and modification time each file had when it was last found identical to its revision. A scan
+# only looks at writable files which aren't opened (p4 syncs files read-only) and only digests those whose size or
+# modification time changed. The suspects are checked against the server with one batched fstat and the files that
+# really changed are passed to a single 'p4 reconcile'. New files outside the client view or matched by the P4IGNORE
+# files and the perforce_reconcile_ignore setting are left out, as 'p4 reconcile' would not add them
+workspace_file_indexes = {}
+workspace_file_indexes_lock = threading.Lock()
+
+def GetWorkspaceFileIndexDir():
+    indexdir = os.path.join(GetPerforceTempDir(), 'workspaces')
+    if(not os.path.isdir(indexdir)):
+        os.makedirs(indexdir)
+    return indexdir
+
+def GetP4IgnoreNames(in_context):
+    # P4IGNORE comes from the environment or from the P4CONFIG file of the workspace, it may list several files
+    value = in_context.environment.get('P4IGNORE', '')
+    if(in_context.configfile):
+        try:
+            f = open(in_context.configfile, 'r')
+            try:
+                for line in f:
+                    match = re.match(r'^\s*P4IGNORE\s*=(.*)$', line)
+                    if(match):
+                        value = match.group(1).strip()
+            finally:
+                f.close()
+        except IOError:
+            pass
+    return [name for name in value.split(os.pathsep) if name.strip()]
+
+def ConvertIgnorePattern(in_pattern):
+    # '...' and '**' match across folders, '*' and '?' within a file or folder name
+    regex = ''
+    i = 0
+    while(i < len(in_pattern)):
+        if(in_pattern.startswith('...', i)):
+            regex += '.*'
+            i += 3
+        elif(in_pattern.startswith('**', i)):
+            regex += '.*'
+            i += 2
+        elif(in_pattern[i] == '*'):
+            regex += '[^/]*'
+            i += 1
+        elif(in_pattern[i] == '?'):
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(in_pattern[i])
+            i += 1
+    return regex
+
+def ParseIgnoreRules(in_lines):
+    # returns (regex, negated) for each rule, matched against paths relative to the folder of the rules
+    flags = 0
+    if(os.path.normcase('A') == 'a'):
+        flags = re.IGNORECASE
+    rules = []
+    for line in in_lines:
+        line = line.strip()
+        if(not line or line.startswith('#')):
+            continue
+        negated = line.startswith('!')
+        if(negated):
+            line = line[1:]
+        if(os.sep == '\\'):
+            line = line.replace('\\', '/')
+        folderonly = line.endswith('/')
+        # a rule without a slash matches at any depth, other rules from the folder of the rules
+        anchored = '/' in line.rstrip('/')
+        regex = ConvertIgnorePattern(line.strip('/'))
+        if(not anchored):
+            regex = '(.*/)?' + regex
+        if(folderonly):
+            regex = '^' + regex + '/.*$'
+        else:
+            regex = '^' + regex + '(/.*)?$'
+        rules.append((re.compile(regex, flags), negated))
+    return rules
+
+class IgnoreRules(object):
+    def __init__(self, in_names, in_folder, in_patterns):
+        self.names = in_names
+        # folder -> rules of its ignore files
+        self.folderrules = {}
+        # the patterns of the settings apply to the scanned folder
+        self.folder = os.path.normcase(in_folder)
+        self.patternrules = ParseIgnoreRules(in_patterns)
+
+    def GetFolderRules(self, in_folder):
+        rules = self.folderrules.get(in_folder)
+        if(rules is None):
+            rules = []
+            for name in self.names:
+                if(os.path.isabs(name) and os.path.normcase(os.path.dirname(name)) != os.path.normcase(in_folder)):
+                    continue
+                filename = os.path.join(in_folder, name)
+                if(not os.path.isfile(filename)):
+                    continue
+                try:
+                    f = open(filename, 'r')
+                    try:
+                        rules += ParseIgnoreRules(f.readlines())
+                    finally:
+                        f.close()
+                except IOError:
+                    pass
+            if(os.path.normcase(in_folder) == self.folder):
+                rules = rules + self.patternrules
+            self.folderrules[in_folder] = rules
+        return rules
+
+    def IsIgnored(self, in_path, in_isfolder=False):
+        if(not self.names and not self.patternrules):
+            return False
+
+        folders = []
+        folder = os.path.dirname(in_path)
+        while True:
+            folders.append(folder)
+            parentfolder = os.path.dirname(folder)
+            if(parentfolder == folder):
+                break
+            folder = parentfolder
+
+        # the last matching rule wins, the rules of a folder come after those of its parents
+        ignored = False
+        for folder in reversed(folders):
+            rules = self.GetFolderRules(folder)
+            if(not rules):
+                continue
+            relativepath = os.path.relpath(in_path, folder).replace(os.sep, '/')
+            if(in_isfolder):
+                relativepath += '/'
+            for regex, negated in rules:
+                if(regex.match(relativepath)):
+                    ignored = not negated
+        return ignored
+
+def GetIgnoreRules(in_context, in_folder):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    patterns = perforce_settings.get('perforce_reconcile_ignore')
+    if(not patterns):
+        patterns = []
+    return IgnoreRules(GetP4IgnoreNames(in_context), in_folder, patterns)
+
+class WorkspaceFileIndex(object):
+    version = 2
+
+    def __init__(self, in_filename):
+        self.filename = in_filename
+        # normalized local file -> [depot file, have revision, type, digest, size, modification time]
+        self.entries = {}
+        # the normalized folders whose have list is in the index
+        self.folders = []
+        self.lock = threading.Lock()
+        self.Load()
+
+    def Load(self):
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if(isinstance(data, dict) and data.get('version') == self.version):
+            self.entries = data['entries']
+            self.folders = data['folders']
+
+    def Save(self):
+        # written next to the index then renamed, a scan interrupted while saving doesn't corrupt it
+        temporaryfile = self.filename + '.tmp'
+        try:
+            f = open(temporaryfile, 'wb')
+            try:
+                marshal.dump({'version': self.version, 'entries': self.entries, 'folders': self.folders}, f)
+            finally:
+                f.close()
+            if(os.path.exists(self.filename)):
+                os.remove(self.filename)
+            os.rename(temporaryfile, self.filename)
+        except (IOError, OSError):
+            pass
+
+    def IsFolderIndexed(self, in_folder):
+        in_folder = os.path.normcase(in_folder)
+        for folder in self.folders:
+            if(in_folder == folder or in_folder.startswith(folder + os.sep)):
+                return 1
+        return 0
+
+    def SetEntry(self, in_record):
+        if(in_record.get('code') != 'stat' or not in_record.get('clientFile') or not in_record.get('haveRev')):
+            return None
+        key = os.path.normcase(in_record['clientFile'])
+        self.entries[key] = [in_record.get('depotFile', ''), in_record['haveRev'], in_record.get('headType', ''), in_record.get('digest', ''), None, None]
+        return key
+
+    def Build(self, in_context, in_folder):
+        # the have list of the folder in a single call, without a deadline as it lists the whole folder. A stopped
+        # call leaves the folder unindexed, the files it didn't list would all be suspects of the next scans
+        folder = os.path.normcase(in_folder)
+        prefix = folder + os.sep
+        for key in [key for key in self.entries.keys() if key.startswith(prefix)]:
+            del self.entries[key]
+        found = 0
+        errors = []
+        for record in P4Records(['fstat', '-Ol', '-T', 'depotFile,clientFile,haveRev,headType,digest', os.path.join(in_folder, '...#have')], in_context, None, 0):
+            if(record.get('stopreason')):
+                for key in [key for key in self.entries.keys() if key.startswith(prefix)]:
+                    del self.entries[key]
+                return 0, record['data'].strip()
+            if(record.get('code') == 'error'):
+                errors.append(record.get('data', '').strip())
+            elif(self.SetEntry(record)):
+                found += 1
+        if(errors and not found):
+            return 0, '\n'.join(errors)
+        self.folders = [indexedfolder for indexedfolder in self.folders if indexedfolder != folder and not indexedfolder.startswith(prefix)] + [folder]
+        return 1, ''
+
+    def Refresh(self, in_context, in_filenames):
+        # the have revisions of the files are fetched again, those without one are removed
+        for filename in in_filenames:
+            self.entries.pop(os.path.normcase(filename), None)
+        records, err = RunP4Command(['-x', '-', 'fstat', '-Ol', '-T', 'depotFile,clientFile,haveRev,headType,digest'], in_context,
+            '\n'.join([filename + '#have' for filename in in_filenames]) + '\n')
+        for record in records:
+            self.SetEntry(record)
+
+    def MatchesRevision(self, in_filename, in_entry):
+        digest = ComputeFileDigest(in_filename, 0)
+        if(digest == in_entry[3]):
+            return 1
+        istext = in_entry[2].find('text') != -1 or in_entry[2] == 'unicode'
+        return istext and ComputeFileDigest(in_filename, 1) == in_entry[3]
+
+    def HasEntriesUnder(self, in_folder):
+        prefix = os.path.normcase(in_folder + os.sep)
+        for key in self.entries:
+            if(key.startswith(prefix)):
+                return True
+        return False
+
+    def Scan(self, in_context, in_folder, in_openedindex):
+        # returns the files that changed and what the scan did
+        stats = {'files': 0, 'digested': 0, 'suspects': 0}
+        if(not self.IsFolderIndexed(in_folder)):
+            success, message = self.Build(in_context, in_folder)
+            if(not success):
+                return 0, message, stats
+
+        def is_opened(in_filename):
+            return in_openedindex and in_openedindex.GetByLocalFile(in_filename)
+
+        # new files are only suspects when p4 would add them: mapped by the client view and not ignored
+        success, clientview = GetClientView(in_context)
+        if(not success):
+            clientview = None
+        ignorerules = GetIgnoreRules(in_context, in_folder)
+
+        suspects = []
+        seen = set()
+        for folder, dirnames, filenames in os.walk(in_folder):
+            # ignored folders (build output) are not walked, unless files of the index are in them
+            for name in list(dirnames):
+                subfolder = os.path.join(folder, name)
+                if(ignorerules.IsIgnored(subfolder, True) and not self.HasEntriesUnder(subfolder)):
+                    dirnames.remove(name)
+            for name in filenames:
+                filename = os.path.join(folder, name)
+                key = os.path.normcase(filename)
+                seen.add(key)
+                stats['files'] += 1
+                entry = self.entries.get(key)
+                if(entry is None):
+                    # added on disk, or synced after the index was built
+                    if(is_opened(filename) or ignorerules.IsIgnored(filename)):
+                        continue
+                    if(clientview and clientview.LocalToDepot(filename) is None):
+                        continue
+                    suspects.append(filename)
+                    continue
+                try:
+                    filestat = os.stat(filename)
+                except OSError:
+                    continue
+                if(not filestat.st_mode & stat.S_IWRITE or (entry[4] == filestat.st_size and entry[5] == filestat.st_mtime)):
+                    continue
+                if(is_opened(filename)):
+                    continue
+                stats['digested'] += 1
+                if(self.MatchesRevision(filename, entry)):
+                    entry[4] = filestat.st_size
+                    entry[5] = filestat.st_mtime
+                else:
+                    suspects.append(filename)
+
+        prefix = os.path.normcase(in_folder + os.sep)
+        for key in self.entries.keys():
+            if(key.startswith(prefix) and key not in seen and not is_opened(key)):
+                suspects.append(key)
+
+        # the index may be older than the last sync, the suspects are compared with their current have revision
+        stats['suspects'] = len(suspects)
+        changed = []
+        if(suspects):
+            previousdigests = {}
+            for filename in suspects:
+                entry = self.entries.get(os.path.normcase(filename))
+                if(entry):
+                    previousdigests[filename] = entry[3]
+            self.Refresh(in_context, suspects)
+            for filename in suspects:
+                entry = self.entries.get(os.path.normcase(filename))
+                if(entry is None or not os.path.isfile(filename) or previousdigests.get(filename) == entry[3]):
+                    changed.append(filename)
+                    continue
+                stats['digested'] += 1
+                if(self.MatchesRevision(filename, entry)):
+                    filestat = os.stat(filename)
+                    entry[4] = filestat.st_size
+                    entry[5] = filestat.st_mtime
+                else:
+                    changed.append(filename)
+        return 1, changed, stats
+
+def GetWorkspaceFileIndex(in_context):
+    success, info = GetConnectionInfo(in_context)
+    if(not success):
+        return 0, info
+
+    key = repr((in_context.key, info['clientName'], info['clientRoot']))
+    workspace_file_indexes_lock.acquire()
+    try:
+        index = workspace_file_indexes.get(key)
+        if(index is None):
+            filename = os.path.join(GetWorkspaceFileIndexDir(), hashlib.md5(key).hexdigest() + '.index')
+            index = WorkspaceFileIndex(filename)
+            workspace_file_indexes[key] = index
+        return 1, index
+    finally:
+        workspace_file_indexes_lock.release()
+
+class ReconcileChangesThread(threading.Thread):
+    def __init__(self, window, context, paths, preview):
+        # without paths, the whole workspace of the context is scanned
+        self.window = window
+        self.context = context
+        self.paths = paths
+        self.preview = preview
+        threading.Thread.__init__(self)
+
+    def ReconcileFolder(self, in_context, in_folder):
+        success, index = GetWorkspaceFileIndex(in_context)
+        if(not success):
+            return index
+
+        success, openedindex = GetOpenedFilesIndex(in_context)
+        if(not success):
+            openedindex = None
+
+        starttime = time.time()
+        index.lock.acquire()
+        try:
+            success, changed, stats = index.Scan(in_context, in_folder, openedindex)
+            index.Save()
+        finally:
+            index.lock.release()
+        if(not success):
+            return in_folder + ": " + changed + "\n"
+
+        lines = [in_folder + ": " + str(stats['files']) + " files scanned in " + "%.1f" % (time.time() - starttime) + " seconds, " +
+            str(stats['digested']) + " digested, " + str(len(changed)) + " changed"]
+        if(not changed):
+            return lines[0] + "\n"
+
+        arguments = ['reconcile']
+        if(self.preview):
+            arguments.append('-n')
+        records = list(P4Records(['-x', '-'] + arguments, in_context, '\n'.join(changed) + '\n'))
+        if(not self.preview and openedindex):
+            openedindex.Update('reconcile', 'default', records)
+        lines.append(SummarizeRecords("p4 " + ' '.join(arguments) + " (" + str(len(changed)) + " files)", 'reconcile', records))
+        return '\n'.join(lines)
+
+    def run(self):
+        sublime.set_timeout(lambda: ShowOutputPanel(self.window, "Perforce: looking for files changed without being opened\n"), 10)
+
+        paths = self.paths
+        if(not paths):
+            success, info = GetConnectionInfo(self.context)
+            if(not success):
+                sublime.set_timeout(lambda: AppendToOutputPanel(self.window, info + "\n"), 10)
+                return
+            paths = [info['clientRoot']]
+
+        for context, folders in GroupPathsByWorkspace(paths, self.context.origin):
+            for folder in folders:
+                if(not os.path.isdir(folder)):
+                    continue
+                summary = self.ReconcileFolder(context, os.path.abspath(folder))
+                sublime.set_timeout(lambda summary=summary: AppendToOutputPanel(self.window, summary), 10)
+
+class PerforceReconcileChangesCommand(sublime_plugin.WindowCommand):
+    def run(self, preview=False, paths=[]):
+        # the side bar passes the selected folders, the whole workspace of the current file is scanned otherwise
+        ReconcileChangesThread(self.window, GetWindowContext(self.window, self), paths, preview).start()
+
+# Diff section
+# the unified diff is shown in a scratch view with the Diff syntax, appended as p4 prints it so that the first files
+# of a large diff can be read while the others are still being compared. The number of context lines and how
+# whitespace is compared come from the settings or from the arguments of the commands
+diff_whitespace_flags = {'': '', 'ignore_changes': 'b', 'ignore_all': 'w', 'ignore_line_endings': 'l'}
+
+def GetDiffArguments(in_contextlines, in_whitespace):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    if(in_contextlines is None):
+        in_contextlines = perforce_settings.get('perforce_diff_context_lines', 3)
+    if(in_whitespace is None):
+        in_whitespace = perforce_settings.get('perforce_diff_whitespace', '')
+    # '-dbu3' is a unified diff with 3 lines of context that ignores changes in the amount of whitespace
+    return ['diff', '-d' + diff_whitespace_flags.get(in_whitespace, '') + 'u' + str(in_contextlines)]
+
+def CreateDiffView(in_window, in_title):
+    view = in_window.new_file()
+    view.set_name(in_title)
+    view.set_scratch(True)
+    view.set_syntax_file('Packages/Diff/Diff.tmLanguage')
+    return view
+
+class StreamedViewThread(threading.Thread):
+    # fills a view with the text of a p4 command as it is printed
+    def __init__(self, view):
+        self.view = view
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = []
+        self.scheduled = False
+        self.lock = threading.Lock()
+        threading.Thread.__init__(self)
+
+    def Append(self, text):
+        # the text is inserted by the main thread, what arrives before it gets to it is inserted with it
+        self.lock.acquire()
+        try:
+            self.pending.append(text)
+            if(self.scheduled):
+                return
+            self.scheduled = True
+        finally:
+            self.lock.release()
+
+        def insert_text():
+            self.lock.acquire()
+            try:
+                text = ''.join(self.pending)
+                self.pending = []
+                self.scheduled = False
+            finally:
+                self.lock.release()
+            edit = self.view.begin_edit()
+            self.view.insert(edit, self.view.size(), text)
+            self.view.end_edit(edit)
+        sublime.set_timeout(insert_text, 10)
+
+    def SetReadOnly(self):
+        def set_read_only():
+            self.view.set_read_only(True)
+        sublime.set_timeout(set_read_only, 10)
+
+class DiffThread(StreamedViewThread):
+    def __init__(self, view, context, arguments, filenames):
+        # the files are passed to p4 on its standard input, all of them are compared by a single p4 diff
+        self.context = context
+        self.arguments = arguments
+        self.filenames = filenames
+        StreamedViewThread.__init__(self, view)
+
+    def run(self):
+        outputlength = [0]
+        def on_output(chunk):
+            outputlength[0] += len(chunk)
+            self.Append(self.decoder.decode(chunk))
+
+        err = StreamP4Output(['-x', '-'] + self.arguments, self.context, on_output, '\n'.join(self.filenames) + '\n')
+        text = self.decoder.decode('', True)
+        if(err.strip()):
+            text += err
+        elif(not outputlength[0]):
+            text += "No differences.\n"
+        self.Append(text)
+        self.SetReadOnly()
+
+class PerforceDiffCommand(sublime_plugin.TextCommand):
+    def run(self, edit, context_lines=None, whitespace=None):
+        if(self.view.file_name()):
+            context = GetViewContext(self.view, self)
+
+            folder_name, filename = os.path.split(self.view.file_name())
+
+            if(IsFileInDepot(context, folder_name, filename)):
+                view = CreateDiffView(self.view.window(), filename + " - p4 diff")
+                DiffThread(view, context, GetDiffArguments(context_lines, whitespace), [self.view.file_name()]).start()
+            else:
+                LogResults(0, "File is not under the client root.")
+        else:
+            WarnUser("View does not contain a file")
+
+class DiffChangelistThread(threading.Thread):
+    def __init__(self, window, context, context_lines, whitespace):
+        self.window = window
+        self.context = context
+        self.context_lines = context_lines
+        self.whitespace = whitespace
+        threading.Thread.__init__(self)
+
+    def MakeChangelistsList(self):
+        # the changelists with files opened on this client, with their files from the opened files index
+        success, index = GetOpenedFilesIndex(self.context)
+        if(not success):
+            WarnUser(index)
+            return []
+
+        self.files = {}
+        for entry in index.GetAllFiles():
+            self.files.setdefault(entry['change'], []).append(entry['depotFile'])
 
-    def on_done(self, input):
-        PrepareCommand();
+        changelists = []
+        if('default' in self.files):
+            changelists.append(['default', "Default Changelist (" + str(len(self.files['default'])) + " file(s))"])
 
-        success, message = Rename(self.window.active_view().file_name(), input)
+        success, model = GetPendingChangelistsModel(self.context)
         if(success):
-            self.window.run_command('close')
-            self.window.open_file(input)
+            for entry in model.GetChangelists():
+                if(entry['change'] in self.files):
+                    changelists.append([entry['change'], FormatChangelistEntry(entry)])
+        return changelists
 
-        LogResults(success, message)
-
-    def on_change(self, input):
-        pass
+    def run(self):
+        self.changelists_list = self.MakeChangelistsList()
 
-    def on_cancel(self):
-        pass
+        def show_quick_panel():
+            if not self.changelists_list:
+                sublime.error_message(__name__ + ': There are no changelists with opened files.')
+                return
+            self.window.show_quick_panel([entry[1] for entry in self.changelists_list], self.on_done)
+        sublime.set_timeout(show_quick_panel, 10)
 
-# Delete section
-def Delete(in_folder, in_filename):
-    success, message = PerforceCommandOnFile("delete", in_folder, in_filename)
-    if(success):
-        # test if the file is deleted
-        if(os.path.isfile(os.path.join(in_folder, in_filename))):
-            success = 0
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        changelist = self.changelists_list[picked][0]
+        view = CreateDiffView(self.window, "Changelist " + changelist + " - p4 diff")
+        DiffThread(view, self.context, GetDiffArguments(self.context_lines, self.whitespace), sorted(self.files[changelist])).start()
+
+class PerforceDiffChangelistCommand(sublime_plugin.WindowCommand):
+    def run(self, context_lines=None, whitespace=None):
+        DiffChangelistThread(self.window, GetWindowContext(self.window, self), context_lines, whitespace).start()
+
+# Annotate section
+# the have revision of the file is annotated with the change, user and date of each line, in a read-only view filled
+# as p4 prints it. A revision never changes once submitted: the annotations are kept for the session, keyed by depot
+# path and revision, and shown again without going to the server
+annotate_line_pattern = re.compile(r'^(\d+): (\S+) (\S+) ?')
+
+class AnnotateCache(object):
+    def __init__(self):
+        self.annotations = {}
+        # least recently used first
+        self.keys = []
+        self.lock = threading.Lock()
+
+    def Get(self, in_key):
+        self.lock.acquire()
+        try:
+            if(in_key not in self.annotations):
+                return None
+            self.keys.remove(in_key)
+            self.keys.append(in_key)
+            return self.annotations[in_key]
+        finally:
+            self.lock.release()
 
-    return success, message
+    def Put(self, in_key, in_text):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        size = perforce_settings.get('perforce_annotate_cache_size', 20)
+        self.lock.acquire()
+        try:
+            if(in_key in self.annotations):
+                self.keys.remove(in_key)
+            self.annotations[in_key] = in_text
+            self.keys.append(in_key)
+            while len(self.keys) > max(size, 0):
+                del self.annotations[self.keys.pop(0)]
+        finally:
+            self.lock.release()
+
+annotate_cache = AnnotateCache()
+
+def FormatAnnotatedLine(in_line):
+    # '1234: jdoe 2012/05/01 text' becomes the change, user and date columns in front of the text
+    match = annotate_line_pattern.match(in_line)
+    if(not match):
+        return in_line
+    return "%8s %-12s %s | %s" % (match.group(1), match.group(2)[:12], match.group(3), in_line[match.end():])
+
+class AnnotateThread(StreamedViewThread):
+    def __init__(self, view, context, filename, integrations, row):
+        self.context = context
+        self.filename = filename
+        self.integrations = integrations
+        self.row = row
+        StreamedViewThread.__init__(self, view)
+
+    def Finish(self, in_title):
+        self.SetReadOnly()
+        def show_row():
+            self.view.set_name(in_title)
+            self.view.show(self.view.text_point(self.row, 0))
+        sublime.set_timeout(show_row, 10)
 
-class PerforceDeleteCommand(sublime_plugin.WindowCommand):
     def run(self):
-        if(self.window.active_view().file_name()):
-            PrepareCommand();
-
-            folder_name, filename = os.path.split(self.window.active_view().file_name())
+        records = [record for record in P4Records(['fstat', '-T', 'depotFile,haveRev', self.filename], self.context) if record.get('code') in ('stat', 'error')]
+        if(not records or records[0].get('code') == 'error'):
+            self.Append(records and records[0].get('data', '') or "File is not in the depot.\n")
+            self.SetReadOnly()
+            return
+        if(not records[0].get('haveRev') or records[0]['haveRev'] == 'none'):
+            self.Append("The file has no revision synced to annotate.\n")
+            self.SetReadOnly()
+            return
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = Delete(folder_name, filename)
-                if(success): # the file was properly deleted on perforce, ask Sublime Text to close the view
-                    self.window.run_command('close');
-            else:
-                success = 0
-                message = "File is not under the client root."
+        filespec = records[0]['depotFile'] + '#' + records[0]['haveRev']
+        title = os.path.basename(self.filename) + '#' + records[0]['haveRev'] + " - p4 annotate"
+        key = (filespec, self.integrations)
+        annotations = annotate_cache.Get(key)
+        if(annotations is not None):
+            self.Append(annotations)
+            self.Finish(title)
+            return
 
-            LogResults(success, message)
+        # the lines are formatted once complete, what is left of a chunk waits for the next one
+        arguments = ['annotate', '-q', '-c', '-u']
+        if(self.integrations):
+            arguments.append('-I')
+        lines = []
+        partial = ['']
+        def on_output(chunk):
+            text = partial[0] + self.decoder.decode(chunk)
+            end = text.rfind('\n') + 1
+            partial[0] = text[end:]
+            if(end):
+                formatted = ''.join([FormatAnnotatedLine(line) for line in text[:end].splitlines(True)])
+                lines.append(formatted)
+                self.Append(formatted)
+
+        err = StreamP4Output(arguments + [filespec], self.context, on_output)
+        text = partial[0] + self.decoder.decode('', True)
+        if(text):
+            lines.append(FormatAnnotatedLine(text))
+            self.Append(lines[-1])
+        if(err.strip()):
+            self.Append(err)
         else:
-            WarnUser("View does not contain a file")
+            annotate_cache.Put(key, ''.join(lines))
+        self.Finish(title)
 
-# Revert section
-def Revert(in_folder, in_filename):
-    # revert the file
-    return PerforceCommandOnFile("revert", in_folder, in_filename);
-
-class PerforceRevertCommand(sublime_plugin.TextCommand):
-    def run_(self, args): # revert cannot be called when an Edit object exists, manually handle the run routine
-        if(self.view.file_name()):
-            PrepareCommand();
+class PerforceAnnotateCommand(sublime_plugin.TextCommand):
+    def run(self, edit, integrations=False):
+        if(not self.view.file_name()):
+            WarnUser("View does not contain a file")
+            return
 
-            folder_name, filename = os.path.split(self.view.file_name())
+        context = GetViewContext(self.view, self)
+        if(not IsFileUnderClientView(context, self.view.file_name())):
+            LogResults(0, "File is not under the client root.")
+            return
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = Revert(folder_name, filename)
-                if(success): # the file was properly reverted, ask Sublime Text to refresh the view
-                    self.view.run_command('revert');
-            else:
-                success = 0
-                message = "File is not under the client root."
+        view = self.view.window().new_file()
+        view.set_name(os.path.basename(self.view.file_name()) + " - p4 annotate")
+        view.set_scratch(True)
+        # the annotations are scrolled to the line of the cursor
+        row = 0
+        if(len(self.view.sel())):
+            row = self.view.rowcol(self.view.sel()[0].begin())[0]
+        AnnotateThread(view, context, self.view.file_name(), integrations, row).start()
 
-            LogResults(success, message)
-        else:
-            WarnUser("View does not contain a file")
+# Graphical Diff With Depot section
+# depot revisions are written by p4 into uniquely named files of the plugin's temporary folder, files left behind
+# by a previous session are removed at startup
+def GetPerforceTempDir():
+    tempdir = os.path.join(tempfile.gettempdir(), 'SublimePerforce')
+    if(not os.path.isdir(tempdir)):
+        os.makedirs(tempdir)
+    return tempdir
+
+def CreateTempFileName(in_filename):
+    # the name of the file is kept at the end so diff applications recognize its type
+    handle, tempfilename = tempfile.mkstemp(prefix='depot_', suffix='_' + in_filename, dir=GetPerforceTempDir())
+    os.close(handle)
+    return tempfilename
+
+def RemoveTempFile(in_filename):
+    try:
+        # p4 writes read-only files, which can't be deleted on Windows
+        os.chmod(in_filename, stat.S_IWRITE | stat.S_IREAD)
+        os.unlink(in_filename)
+    except OSError:
+        pass
 
-# Diff section
-def Diff(in_folder, in_filename):
-    # diff the file
-    return PerforceCommandOnFile("diff", in_folder, in_filename);
+def CleanupTempDir():
+    tempdir = os.path.join(tempfile.gettempdir(), 'SublimePerforce')
+    if(not os.path.isdir(tempdir)):
+        return
+    # a day old files can't belong to a diff still running in another instance
+    for name in os.listdir(tempdir):
+        path = os.path.join(tempdir, name)
+        try:
+            if(os.path.isfile(path) and time.time() - os.path.getmtime(path) > 24 * 60 * 60):
+                RemoveTempFile(path)
+        except OSError:
+            pass
 
-class PerforceDiffCommand(sublime_plugin.TextCommand):
-    def run(self, edit): 
-        if(self.view.file_name()):
-            PrepareCommand();
+def PrintDepotFile(in_context, in_filespec, in_destination):
+    # p4 writes the revision to the destination itself, the content never goes through the plugin
+    records, err = RunP4Command(['print', '-q', '-o', in_destination, in_filespec], in_context)
+    if(err):
+        return 0, err
+    return 1, in_destination
+
+# Revision Cache section
+# submitted revisions never change: they are kept on disk, keyed by depot path and revision, to be used again
+# without any server traffic. A revision is only cached once its content matches the digest of the server, it is
+# downloaded under a temporary name and renamed into place. The least recently used revisions are evicted when the
+# cache grows over its size limit
+revision_cache_lock = threading.Lock()
+
+def GetRevisionCacheDir():
+    cachedir = os.path.join(GetPerforceTempDir(), 'revisions')
+    if(not os.path.isdir(cachedir)):
+        os.makedirs(cachedir)
+    return cachedir
+
+def GetRevisionCacheMaxSize():
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    maxsize = perforce_settings.get('perforce_revision_cache_size')
+    if(maxsize is None):
+        maxsize = 256
+    return maxsize * 1024 * 1024
+
+def GetRevisionCacheFileName(in_depotfile, in_rev):
+    key = hashlib.md5(in_depotfile + '#' + in_rev).hexdigest()
+    return os.path.join(GetRevisionCacheDir(), key[:16] + '_' + in_rev + '_' + in_depotfile.split('/')[-1])
+
+def ComputeFileDigest(in_filename, in_normalizelineendings):
+    # the server computes the digest of text files with their lines ending with LF
+    digest = hashlib.md5()
+    f = open(in_filename, 'rb')
+    try:
+        pending = ''
+        while True:
+            chunk = f.read(64 * 1024)
+            if(not chunk):
+                break
+            if(in_normalizelineendings):
+                chunk = pending + chunk
+                pending = ''
+                if(chunk.endswith('\r')):
+                    pending = '\r'
+                    chunk = chunk[:-1]
+                chunk = chunk.replace('\r\n', '\n')
+            digest.update(chunk)
+        digest.update(pending)
+    finally:
+        f.close()
+    return digest.hexdigest().upper()
+
+def EvictRevisionCache(in_maxsize, in_keptfile):
+    # the least recently used revisions are removed, never in_keptfile which is about to be handed to a diff
+    entries = []
+    totalsize = 0
+    cachedir = GetRevisionCacheDir()
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        try:
+            filestat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((filestat.st_mtime, filestat.st_size, path))
+        totalsize += filestat.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if(totalsize <= in_maxsize):
+            break
+        if(path == in_keptfile):
+            continue
+        RemoveTempFile(path)
+        totalsize -= size
+
+def FetchDepotRevision(in_context, in_depotfile, in_rev):
+    # returns the path of the revision, and whether it's a temporary file the caller has to remove
+    maxsize = GetRevisionCacheMaxSize()
+    filespec = in_depotfile + '#' + in_rev
+    cachedfile = GetRevisionCacheFileName(in_depotfile, in_rev)
+    if(maxsize > 0):
+        # marked as the most recently used under the lock, the eviction of another download doesn't remove it first
+        revision_cache_lock.acquire()
+        try:
+            try:
+                os.utime(cachedfile, None)
+                return 1, cachedfile, 0
+            except OSError:
+                pass # not cached
+        finally:
+            revision_cache_lock.release()
 
-            folder_name, filename = os.path.split(self.view.file_name())
+    downloadfile = CreateTempFileName(in_depotfile.split('/')[-1])
+    success, message = PrintDepotFile(in_context, filespec, downloadfile)
+    if(not success):
+        RemoveTempFile(downloadfile)
+        return 0, message, 0
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = Diff(folder_name, filename)
-            else:
-                success = 0
-                message = "File is not under the client root."
+    # a revision larger than the whole cache would be evicted as soon as it is stored
+    try:
+        if(maxsize <= 0 or os.path.getsize(downloadfile) > maxsize):
+            return 1, downloadfile, 1
+    except OSError:
+        return 1, downloadfile, 1
+
+    digest = ''
+    filetype = ''
+    records, err = RunP4Command(['fstat', '-Ol', filespec], in_context)
+    for record in records:
+        if(record.get('code') == 'stat'):
+            digest = record.get('digest', '')
+            filetype = record.get('headType', '')
+
+    # a revision that can't be verified is only used once
+    if(not digest):
+        return 1, downloadfile, 1
+    istext = filetype.find('text') != -1 or filetype == 'unicode'
+    if(ComputeFileDigest(downloadfile, 0) != digest and (not istext or ComputeFileDigest(downloadfile, 1) != digest)):
+        return 1, downloadfile, 1
+
+    revision_cache_lock.acquire()
+    try:
+        try:
+            if(os.path.isfile(cachedfile)):
+                RemoveTempFile(cachedfile)
+            os.rename(downloadfile, cachedfile)
+        except OSError:
+            return 1, downloadfile, 1
+        EvictRevisionCache(maxsize, cachedfile)
+    finally:
+        revision_cache_lock.release()
+
+    return 1, cachedfile, 0
+
+def GetHaveRevision(in_context, in_filename):
+    # a loaded opened files index knows the revision of the opened files, the others are asked to the server
+    index = PeekOpenedFilesIndex(in_context)
+    if(index):
+        entry = index.GetByLocalFile(in_filename)
+        if(entry):
+            if(entry['action'] in ['add', 'branch', 'move/add', 'import']):
+                return 0, "File has no revision in the depot.", ''
+            return 1, entry['depotFile'], entry['rev']
+
+    records, err = RunP4Command(['fstat', '-T', 'depotFile,haveRev', in_filename], in_context)
+    for record in records:
+        if(record.get('code') == 'stat' and record.get('haveRev')):
+            return 1, record['depotFile'], record['haveRev']
+    if(err):
+        return 0, err, ''
+    return 0, "File is not synced on this client.", ''
 
-            LogResults(success, message)
-        else:
-            WarnUser("View does not contain a file")
-                    
-# Graphical Diff With Depot section
 class GraphicalDiffThread(threading.Thread):
-    def __init__(self, in_folder, in_filename, in_endlineseparator, in_command):
+    def __init__(self, in_context, in_folder, in_filename, in_command):
+        self.context = in_context
         self.folder = in_folder
         self.filename = in_filename
-        self.endlineseparator = in_endlineseparator
         self.command = in_command
         threading.Thread.__init__(self)
 
     def run(self):
-        success, content = PerforceCommandOnFile("print", self.folder, self.filename)
+        # the workspace file is compared with the revision it was synced to
+        success, depotfile, rev = GetHaveRevision(self.context, os.path.join(self.folder, self.filename))
         if(not success):
-            return 0, content
-
-        # Create a temporary file to hold the depot version
-        depotFileName = "depot"+self.filename
-        tmp_file = open(os.path.join(tempfile.gettempdir(), depotFileName), 'w')
+            sublime.set_timeout(lambda: LogResults(success, depotfile), 10)
+            return
 
-        # Remove the first two lines of content
-        linebyline = content.splitlines();
-        content=self.endlineseparator.join(linebyline[1:]);
+        success, depotFilePath, temporary = FetchDepotRevision(self.context, depotfile, rev)
+        if(not success):
+            sublime.set_timeout(lambda: LogResults(success, depotFilePath), 10)
+            return
 
         try:
-            tmp_file.write(content)
+            # Launch P4Diff with both files and the same arguments P4Win passes it
+            diffCommand = self.command
+            diffCommand = diffCommand.replace('%depotfile_path', depotFilePath)
+            diffCommand = diffCommand.replace('%depotfile_name', os.path.basename(depotFilePath))
+            diffCommand = diffCommand.replace('%file_path', os.path.join(self.folder, self.filename))
+            diffCommand = diffCommand.replace('%file_name', self.filename)
+
+            p = subprocess.Popen(diffCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.context.folder, env=self.context.environment, shell=True)
+            result, err = p.communicate()
         finally:
-            tmp_file.close()
-
-        # Launch P4Diff with both files and the same arguments P4Win passes it
-        diffCommand = self.command
-        diffCommand = diffCommand.replace('%depotfile_path', tmp_file.name)
-        diffCommand = diffCommand.replace('%depotfile_name', depotFileName)
-        diffCommand = diffCommand.replace('%file_path', os.path.join(self.folder, self.filename))
-        diffCommand = diffCommand.replace('%file_name', self.filename)
-
-        command = ConstructCommand(diffCommand)
-        
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+            # Clean up
+            if(temporary):
+                RemoveTempFile(depotFilePath)
 
-        # Clean up
-        os.unlink(tmp_file.name);
-
-def GraphicalDiffWithDepot(self, in_folder, in_filename):
+def GraphicalDiffWithDepot(self, in_context, in_folder, in_filename):
     perforce_settings = sublime.load_settings('Perforce.sublime-settings')
     diffcommand = perforce_settings.get('perforce_selectedgraphicaldiffapp_command')
     if not diffcommand:
         diffcommand = perforce_settings.get('perforce_default_graphical_diff_command')
-    GraphicalDiffThread(in_folder, in_filename, perforce_settings.get('perforce_end_line_separator'), diffcommand).start()
+    GraphicalDiffThread(in_context, in_folder, in_filename, diffcommand).start()
 
     return 1, "Launching thread for Graphical Diff"
 
 class PerforceGraphicalDiffWithDepotCommand(sublime_plugin.TextCommand):
     def run(self, edit): 
         if(self.view.file_name()):
-            PrepareCommand();
+            context = GetViewContext(self.view, self)
 
             folder_name, filename = os.path.split(self.view.file_name())
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = GraphicalDiffWithDepot(self, folder_name, filename)
+            if(IsFileInDepot(context, folder_name, filename)):
+                success, message = GraphicalDiffWithDepot(self, context, folder_name, filename)
             else:
                 success = 0
                 message = "File is not under the client root."
@@ -616,71 +3774,592 @@ class PerforceSelectGraphicalDiffApplicationCommand(sublime_plugin.WindowCommand
         settings.set('perforce_selectedgraphicaldiffapp_command', entry['diffcommand'])
         sublime.save_settings('Perforce.sublime-settings')
 
-# List Checked Out Files section
-class ListCheckedOutFilesThread(threading.Thread):
-    def __init__(self, window):
+# File History section
+# the history of a file is listed a page at a time with 'p4 filelog -m', the newest revisions first: older pages are
+# only asked for when the last entry of the list is picked. Submitted revisions don't change, the pages are kept for
+# the session keyed by depot file and newest revision. The revisions are fetched through the revision cache
+class FileHistoryCache(object):
+    def __init__(self):
+        # (depot file, newest revision of the page) -> revisions of the page
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def Get(self, in_depotfile, in_rev):
+        self.lock.acquire()
+        try:
+            return self.pages.get((in_depotfile, in_rev))
+        finally:
+            self.lock.release()
+
+    def Put(self, in_depotfile, in_rev, in_revisions):
+        self.lock.acquire()
+        try:
+            self.pages[(in_depotfile, in_rev)] = in_revisions
+        finally:
+            self.lock.release()
+
+file_history_cache = FileHistoryCache()
+
+def ParseFilelogRecord(in_record):
+    # the revisions of a file are numbered fields of a single record: rev0, change0, ..., rev1, change1, ...
+    revisions = []
+    position = 0
+    while ('rev' + str(position)) in in_record:
+        entry = {}
+        for field in ['rev', 'change', 'action', 'type', 'time', 'user', 'client', 'desc']:
+            entry[field] = in_record.get(field + str(position), '')
+        revisions.append(entry)
+        position += 1
+    return revisions
+
+def GetFileHistoryPage(in_context, in_depotfile, in_rev):
+    # the revisions from in_rev down, returns (success, revisions or error message)
+    revisions = file_history_cache.Get(in_depotfile, in_rev)
+    if(revisions is not None):
+        return 1, revisions
+
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    pagesize = perforce_settings.get('perforce_file_history_page_size') or 50
+    records, err = RunP4Command(['filelog', '-l', '-m', str(pagesize), in_depotfile + '#' + in_rev], in_context)
+    if(err):
+        return 0, err.strip()
+
+    revisions = []
+    for record in records:
+        if(record.get('code') == 'stat' and record.get('depotFile') == in_depotfile):
+            revisions = ParseFilelogRecord(record)
+    file_history_cache.Put(in_depotfile, in_rev, revisions)
+    return 1, revisions
+
+def FormatFileRevision(in_entry):
+    date = ''
+    if(in_entry['time']):
+        date = time.strftime('%Y/%m/%d', time.localtime(int(in_entry['time'])))
+    description = in_entry['desc'].strip().split('\n')[0]
+    return ["#" + in_entry['rev'] + " change " + in_entry['change'] + " " + in_entry['action'] + " on " + date + " by " + in_entry['user'], description]
+
+def IsRevisionDeleted(in_entry):
+    return in_entry['action'] in ['delete', 'move/delete', 'purge', 'archive']
+
+def ReadRevisionText(in_context, in_depotfile, in_rev):
+    success, path, temporary = FetchDepotRevision(in_context, in_depotfile, in_rev)
+    if(not success):
+        return 0, path
+    try:
+        f = open(path, 'rb')
+        try:
+            return 1, f.read().decode('utf-8', 'replace')
+        finally:
+            f.close()
+    finally:
+        if(temporary):
+            RemoveTempFile(path)
+
+class FileHistoryThread(threading.Thread):
+    def __init__(self, window, context, filename, syntax):
         self.window = window
+        self.context = context
+        self.filename = filename
+        self.syntax = syntax
+        self.depotfile = None
+        self.revisions = []
+        self.more = False
         threading.Thread.__init__(self)
 
-    def ConvertFileNameToFileOnDisk(self, in_filename):
-        clientroot = GetClientRoot(os.path.dirname(in_filename))
-        if(clientroot == -1):
-            return 0
+    def LoadPage(self, in_rev):
+        success, revisions = GetFileHistoryPage(self.context, self.depotfile, in_rev)
+        if(not success):
+            sublime.set_timeout(lambda: WarnUser(revisions), 10)
+            return
+        self.revisions.extend(revisions)
+        # a full page may have older revisions after it
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        pagesize = perforce_settings.get('perforce_file_history_page_size') or 50
+        self.more = len(revisions) >= pagesize and int(revisions[-1]['rev']) > 1
+        sublime.set_timeout(self.ShowRevisions, 10)
+
+    def run(self):
+        # the head revision is the key of the newest page
+        records, err = RunP4Command(['fstat', '-T', 'depotFile,headRev', self.filename], self.context)
+        for record in records:
+            if(record.get('code') == 'stat' and record.get('headRev')):
+                self.depotfile = record['depotFile']
+                self.LoadPage(record['headRev'])
+                return
+        sublime.set_timeout(lambda: WarnUser(err.strip() or "File has no history in the depot."), 10)
 
-        if(clientroot == "null"):
-            return in_filename
+    def ShowRevisions(self):
+        entries = [FormatFileRevision(entry) for entry in self.revisions]
+        if(self.more):
+            entries.append(["More revisions...", "Older than #" + self.revisions[-1]['rev']])
+        self.window.show_quick_panel(entries, self.on_done)
 
-        filename = clientroot + os.sep + in_filename.replace('\\', os.sep).replace('/', os.sep)
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        if(picked == len(self.revisions)):
+            rev = str(int(self.revisions[-1]['rev']) - 1)
+            threading.Thread(target=lambda: self.LoadPage(rev)).start()
+            return
 
-        return filename
+        entry = self.revisions[picked]
+        self.actions = []
+        if(not IsRevisionDeleted(entry)):
+            self.actions.append(['print', "Open revision #" + entry['rev']])
+            self.actions.append(['workspace', "Diff #" + entry['rev'] + " against the workspace file"])
+        if(int(entry['rev']) > 1 and not IsRevisionDeleted(entry)):
+            self.actions.append(['previous', "Diff #" + entry['rev'] + " against the previous revision"])
+        if(not self.actions):
+            WarnUser("Revision #" + entry['rev'] + " was deleted, it has no content.")
+            return
+        self.revision = entry
+        sublime.set_timeout(lambda: self.window.show_quick_panel([action[1] for action in self.actions], self.on_action), 10)
 
-    def MakeFileListFromChangelist(self, in_changelistline):
-        files_list = []
-        currentuser = GetUserFromClientspec()
-        # Launch p4 opened to retrieve all files from changelist
-        command = ConstructCommand('p4 opened -c ' + in_changelistline[1] + ' -u ' + currentuser)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        if(not err):
-            lines = result.splitlines()
-            for line in lines:
-                # remove the change #
-                poundindex = line.rfind('#')
-                cleanedfile = line[0:poundindex]
-
-                # just keep the filename
-                cleanedfile = '/'.join(cleanedfile.split('/')[3:])
-
-                file_entry = [cleanedfile[cleanedfile.rfind('/')+1:]]
-                file_entry.append("Changelist: " + in_changelistline[1])
-                file_entry.append(' '.join(in_changelistline[7:]));
-                localfile = self.ConvertFileNameToFileOnDisk(cleanedfile)
-                if(localfile != 0):
-                    file_entry.append(localfile)
-                    files_list.append(file_entry)
+    def on_action(self, picked):
+        if picked == -1:
+            return
+        FileRevisionActionThread(self.window, self.context, self.filename, self.depotfile, self.revision['rev'], self.actions[picked][0], self.syntax).start()
 
-        return files_list
+class FileRevisionActionThread(threading.Thread):
+    def __init__(self, window, context, filename, depotfile, rev, action, syntax):
+        self.window = window
+        self.context = context
+        self.filename = filename
+        self.depotfile = depotfile
+        self.rev = rev
+        self.action = action
+        self.syntax = syntax
+        threading.Thread.__init__(self)
+
+    def Show(self, in_title, in_text, in_syntax):
+        def show_text():
+            view = self.window.new_file()
+            view.set_name(in_title)
+            view.set_scratch(True)
+            if(in_syntax):
+                view.set_syntax_file(in_syntax)
+            edit = view.begin_edit()
+            view.insert(edit, 0, in_text)
+            view.end_edit(edit)
+            view.set_read_only(True)
+        sublime.set_timeout(show_text, 10)
+
+    def run(self):
+        name = self.depotfile.split('/')[-1]
+        success, text = ReadRevisionText(self.context, self.depotfile, self.rev)
+        if(not success):
+            sublime.set_timeout(lambda: LogResults(0, text), 10)
+            return
+
+        if(self.action == 'print'):
+            self.Show(name + "#" + self.rev, text, self.syntax)
+            return
+
+        if(self.action == 'previous'):
+            previousrev = str(int(self.rev) - 1)
+            success, previoustext = ReadRevisionText(self.context, self.depotfile, previousrev)
+            if(not success):
+                sublime.set_timeout(lambda: LogResults(0, previoustext), 10)
+                return
+            oldtext, newtext = previoustext, text
+            oldname, newname = self.depotfile + "#" + previousrev, self.depotfile + "#" + self.rev
+        else:
+            try:
+                f = open(self.filename, 'rb')
+                try:
+                    newtext = f.read().decode('utf-8', 'replace')
+                finally:
+                    f.close()
+            except IOError, e:
+                sublime.set_timeout(lambda: LogResults(0, str(e)), 10)
+                return
+            oldtext = text
+            oldname, newname = self.depotfile + "#" + self.rev, self.filename
+
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        contextlines = perforce_settings.get('perforce_diff_context_lines', 3)
+        diff = ''.join(difflib.unified_diff(oldtext.splitlines(True), newtext.splitlines(True), oldname, newname, n=contextlines))
+        if(not diff):
+            diff = "No differences.\n"
+        self.Show(name + "#" + self.rev + " - diff", diff, 'Packages/Diff/Diff.tmLanguage')
+
+class PerforceFileHistoryCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if(not self.view.file_name()):
+            WarnUser("View does not contain a file")
+            return
+
+        context = GetViewContext(self.view, self)
+        if(not IsFileUnderClientView(context, self.view.file_name())):
+            LogResults(0, "File is not under the client root.")
+            return
+
+        FileHistoryThread(self.view.window(), context, self.view.file_name(), self.view.settings().get('syntax')).start()
+
+# Describe section
+# a changelist is described with 'p4 describe -s', its files without their diffs (-S for the shelved files of a
+# pending change). The diff of a file is only fetched when it is expanded in the view, by a small pool of workers
+# shared by all the describe views; the diffs of submitted and shelved revisions are kept for the session
+describe_views = {}
+describe_removed_actions = ['delete', 'move/delete', 'purge', 'archive']
+describe_added_actions = ['add', 'branch', 'move/add', 'import']
+
+class DescribeDiffPool(object):
+    def __init__(self):
+        self.queue = Queue()
+        # (change, depot file, revision, shelved digest) -> text of the diff
+        self.diffs = {}
+        # keys being fetched -> callbacks waiting for them
+        self.waiting = {}
+        self.workers = 0
+        self.lock = threading.Lock()
+
+    def Request(self, in_key, in_fetch, in_callback):
+        # in_fetch runs on a worker and returns (diff, whether it can be kept), in_callback gets the diff on the main
+        # thread. A file expanded again while its diff is being fetched doesn't start another fetch
+        self.lock.acquire()
+        try:
+            if(in_key in self.diffs):
+                diff = self.diffs[in_key]
+                sublime.set_timeout(lambda: in_callback(diff), 10)
+                return
+            if(in_key in self.waiting):
+                self.waiting[in_key].append(in_callback)
+                return
+            self.waiting[in_key] = [in_callback]
+            self.queue.put((in_key, in_fetch))
+
+            perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+            if(self.workers < max(perforce_settings.get('perforce_describe_diff_workers') or 4, 1)):
+                self.workers += 1
+                worker = threading.Thread(target=self.Work)
+                worker.setDaemon(True)
+                worker.start()
+        finally:
+            self.lock.release()
+
+    def Work(self):
+        # the workers leave once there is nothing left to fetch
+        while True:
+            self.lock.acquire()
+            try:
+                try:
+                    key, fetch = self.queue.get_nowait()
+                except Empty:
+                    self.workers -= 1
+                    return
+            finally:
+                self.lock.release()
+
+            try:
+                diff, keep = fetch()
+            except Exception, e:
+                diff, keep = "Unable to get the diff: " + str(e) + "\n", False
+
+            self.lock.acquire()
+            try:
+                if(keep):
+                    self.diffs[key] = diff
+                callbacks = self.waiting.pop(key, [])
+            finally:
+                self.lock.release()
+            for callback in callbacks:
+                sublime.set_timeout(lambda callback=callback: callback(diff), 10)
+
+describe_diff_pool = DescribeDiffPool()
+
+describe_binary_note = "Binary file, no diff shown.\n"
+
+def IsBinaryFileType(in_type):
+    # binary, ubinary, apple and resource, with or without modifiers (binary+F)
+    basetype = in_type.split('+')[0]
+    return basetype.find('binary') != -1 or basetype in ['apple', 'resource']
+
+def PrintAsDiff(in_context, in_filespec, in_sign):
+    # the whole content of an added or deleted file, as a diff against nothing
+    result, err = RunP4TextCommand(['print', '-q', in_filespec], in_context)
+    if(err.strip()):
+        return err
+    # a file whose type doesn't say it is binary can still be, 'p4 describe' doesn't print it either
+    if(result.find('\0') != -1):
+        return describe_binary_note
+    lines = result.decode('utf-8', 'replace').splitlines(True)
+    if(in_sign == '+'):
+        header = "--- /dev/null\n+++ " + in_filespec + "\n@@ -0,0 +1," + str(len(lines)) + " @@\n"
+    else:
+        header = "--- " + in_filespec + "\n+++ /dev/null\n@@ -1," + str(len(lines)) + " +0,0 @@\n"
+    return header + ''.join([in_sign + line for line in lines])
+
+def FetchDescribedFileDiff(in_context, in_change, in_entry):
+    # returns the diff of a file of the changelist and whether it can be kept for the session
+    if(IsBinaryFileType(in_entry['type'])):
+        return describe_binary_note, True
+
+    depotfile = in_entry['depotFile']
+    rev = in_entry['rev']
+    if(in_change['shelved']):
+        # the shelved content is compared with the revision it was based on
+        current = depotfile + '@=' + in_change['change']
+        previous = depotfile + '#' + rev
+    elif(in_change['status'] == 'submitted'):
+        current = depotfile + '#' + rev
+        previous = depotfile + '#' + str(int(rev) - 1)
+    else:
+        # opened files can only be compared with the workspace they are opened in
+        success, info = GetConnectionInfo(in_context)
+        if(not success or info['clientName'] != in_change['client']):
+            return "The file is opened in the workspace " + in_change['client'] + ", its diff isn't available here.\n", False
+        if(in_entry['action'] in describe_added_actions):
+            return "The file is opened for " + in_entry['action'] + ", it has no revision to compare with.\n", False
+        result, err = RunP4TextCommand(['diff', '-du', depotfile], in_context)
+        return (result.decode('utf-8', 'replace') or err or "No differences.\n"), False
+
+    if(in_entry['action'] in describe_added_actions):
+        return PrintAsDiff(in_context, current, '+'), True
+    if(in_entry['action'] in describe_removed_actions):
+        return PrintAsDiff(in_context, previous, '-'), True
+
+    result, err = RunP4TextCommand(['diff2', '-du', previous, current], in_context)
+    if(err.strip()):
+        return err, False
+    return result.decode('utf-8', 'replace'), True
+
+class DescribeView(object):
+    # the state of a describe view: the files of the changelist, which are expanded and their diffs
+    def __init__(self, in_view, in_context, in_record, in_shelved):
+        self.view = in_view
+        self.context = in_context
+        self.change = {'change': in_record['change'], 'status': in_record.get('status', ''),
+            'client': in_record.get('client', ''), 'shelved': in_shelved}
+        self.header = FormatDescribeHeader(in_record, in_shelved)
+        self.files = []
+        position = 0
+        while ('depotFile' + str(position)) in in_record:
+            entry = {}
+            for field in ['depotFile', 'action', 'type', 'rev', 'digest']:
+                entry[field] = in_record.get(field + str(position), '')
+            entry['expanded'] = False
+            entry['diff'] = None
+            self.files.append(entry)
+            position += 1
+        # first row of each file in the view
+        self.rows = []
+
+    def Render(self, in_position=None, in_offset=0):
+        # the cursor is put back on a file, or in its diff at in_offset rows from its line
+        parts = [self.header]
+        row = self.header.count('\n')
+        self.rows = []
+        for entry in self.files:
+            self.rows.append(row)
+            marker = "[+] "
+            if(entry['expanded']):
+                marker = "[-] "
+            line = marker + entry['depotFile'] + "#" + entry['rev'] + " " + entry['action'] + "\n"
+            if(entry['expanded']):
+                line += entry['diff'] or "    (getting the diff...)\n"
+                if(not line.endswith('\n')):
+                    line += "\n"
+            parts.append(line)
+            row += line.count('\n')
+        if(not self.files):
+            parts.append("No files.\n")
+
+        self.view.set_read_only(False)
+        edit = self.view.begin_edit()
+        self.view.replace(edit, sublime.Region(0, self.view.size()), ''.join(parts))
+        self.view.end_edit(edit)
+        self.view.set_read_only(True)
+        if(in_position is not None):
+            point = self.view.text_point(self.rows[in_position] + in_offset, 0)
+            self.view.sel().clear()
+            self.view.sel().add(sublime.Region(point, point))
+            self.view.show(point)
+
+    def FindFile(self, in_row):
+        # the file whose line or diff the row is in
+        found = None
+        for position, row in enumerate(self.rows):
+            if(row > in_row):
+                break
+            found = position
+        return found
+
+    def Toggle(self, in_positions):
+        for position in in_positions:
+            entry = self.files[position]
+            entry['expanded'] = not entry['expanded']
+            if(entry['expanded'] and entry['diff'] is None):
+                key = (self.change['change'], entry['depotFile'], entry['rev'], self.change['shelved'] and entry['digest'])
+                fetch = lambda entry=entry: FetchDescribedFileDiff(self.context.WithOrigin(self.context.origin), self.change, entry)
+                describe_diff_pool.Request(key, fetch, lambda diff, entry=entry: self.OnDiff(entry, diff))
+        if(in_positions):
+            self.Render(in_positions[0])
+
+    def OnDiff(self, in_entry, in_diff):
+        in_entry['diff'] = in_diff
+        if(in_entry['expanded'] and self.view.id() in describe_views):
+            # without a selection, the cursor isn't put back
+            position = None
+            if(len(self.view.sel())):
+                row = self.view.rowcol(self.view.sel()[0].begin())[0]
+                position = self.FindFile(row)
+            if(position is None):
+                self.Render()
+            else:
+                self.Render(position, row - self.rows[position])
+
+def FormatDescribeHeader(in_record, in_shelved):
+    date = ''
+    if(in_record.get('time')):
+        date = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(int(in_record['time'])))
+    status = in_record.get('status', '')
+    if(in_shelved):
+        status += ', shelved files'
+    text = "Change " + in_record['change'] + " by " + in_record.get('user', '') + "@" + in_record.get('client', '') + " on " + date + " (" + status + ")\n\n"
+    for line in in_record.get('desc', '').rstrip().splitlines():
+        text += "\t" + line + "\n"
+    return text + "\nAffected files (Enter expands and collapses the diff of a file) ...\n\n"
+
+class DescribeChangelistThread(threading.Thread):
+    def __init__(self, window, context, change, shelved):
+        self.window = window
+        self.context = context
+        self.change = change
+        self.shelved = shelved
+        threading.Thread.__init__(self)
+
+    def run(self):
+        arguments = ['describe', '-s']
+        if(self.shelved):
+            arguments.append('-S')
+        records, err = RunP4Command(arguments + [self.change], self.context)
+        records = [record for record in records if record.get('code') == 'stat']
+        if(err or not records):
+            sublime.set_timeout(lambda: WarnUser(err or "Change " + self.change + " unknown."), 10)
+            return
+
+        def show_changelist():
+            view = self.window.new_file()
+            view.set_name("Change " + self.change + " - p4 describe")
+            view.set_scratch(True)
+            view.set_syntax_file('Packages/Diff/Diff.tmLanguage')
+            view.settings().set('perforce_describe_view', True)
+            describe = DescribeView(view, self.context, records[0], self.shelved)
+            describe_views[view.id()] = describe
+            describe.Render()
+        sublime.set_timeout(show_changelist, 10)
+
+class DescribeChangelistPickerThread(threading.Thread):
+    def __init__(self, window, context, shelved):
+        self.window = window
+        self.context = context
+        self.shelved = shelved
+        threading.Thread.__init__(self)
+
+    def run(self):
+        # the pending changelists of the workspace, only those with shelved files for a shelved describe
+        self.changelists_list = [['', "Enter a changelist number..."]]
+        success, model = GetPendingChangelistsModel(self.context)
+        if(success):
+            for entry in model.GetChangelists():
+                if(entry['shelved'] or not self.shelved):
+                    self.changelists_list.append([entry['change'], FormatChangelistEntry(entry)])
+        sublime.set_timeout(lambda: self.window.show_quick_panel([entry[1] for entry in self.changelists_list], self.on_done), 10)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        if picked == 0:
+            sublime.set_timeout(lambda: self.window.show_input_panel("Changelist number", "", self.on_change_entered, None, None), 10)
+            return
+        DescribeChangelistThread(self.window, self.context, self.changelists_list[picked][0], self.shelved).start()
+
+    def on_change_entered(self, input):
+        change = input.strip()
+        if(not change.isdigit()):
+            WarnUser("'" + change + "' is not a changelist number")
+            return
+        DescribeChangelistThread(self.window, self.context, change, self.shelved).start()
+
+class PerforceDescribeChangelistCommand(sublime_plugin.WindowCommand):
+    def run(self, change=None, shelved=False):
+        context = GetWindowContext(self.window, self)
+        if(change):
+            DescribeChangelistThread(self.window, context, str(change), shelved).start()
+        else:
+            DescribeChangelistPickerThread(self.window, context, shelved).start()
+
+class PerforceDescribeToggleFileCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        describe = describe_views.get(self.view.id())
+        if(not describe):
+            return
+        positions = []
+        for region in self.view.sel():
+            position = describe.FindFile(self.view.rowcol(region.begin())[0])
+            if(position is not None and position not in positions):
+                positions.append(position)
+        describe.Toggle(positions)
+
+class PerforceDescribeViews(sublime_plugin.EventListener):
+    def on_close(self, view):
+        describe_views.pop(view.id(), None)
+
+# List Checked Out Files section
+class ListCheckedOutFilesThread(threading.Thread):
+    def __init__(self, window, context):
+        self.window = window
+        self.context = context
+        threading.Thread.__init__(self)
 
     def MakeCheckedOutFileList(self):
-        files_list = self.MakeFileListFromChangelist(['','default','','','','','','Default Changelist']);
+        files_list = []
+
+        success, info = GetConnectionInfo(self.context)
+        if(not success):
+            WarnUser(info)
+            return files_list
+
+        if(not info['userName'] or not info['clientRoot']):
+            WarnUser("Unexpected output from 'p4 info'.")
+            return files_list
 
-        currentuser = GetUserFromClientspec()
-        if(currentuser == -1):
+        # The descriptions of the pending changelists of this client come from the changelists model
+        changelists = ['default']
+        descriptions = {'default': 'Default Changelist'}
+        success, model = GetPendingChangelistsModel(self.context)
+        if(success):
+            for entry in model.GetChangelists():
+                if(entry['client'] == info['clientName']):
+                    changelists.append(entry['change'])
+                    descriptions[entry['change']] = entry['desc']
+
+        # The files of all changelists come from the opened files index, they are grouped in memory
+        success, index = GetOpenedFilesIndex(self.context)
+        if(not success):
+            WarnUser(index)
             return files_list
 
-        # Launch p4 changes to retrieve all the pending changelists
-        command = ConstructCommand('p4 changes -s pending -u ' + currentuser);
+        files_per_changelist = {}
+        for entry in sorted(index.GetAllFiles(), key=lambda entry: entry['depotFile']):
+            if(entry['user'] and entry['user'] != info['userName']):
+                continue
 
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+            change = entry['change']
+            if(change not in descriptions):
+                changelists.append(change)
+                descriptions[change] = ''
 
-        if(not err):
-            changelists = result.splitlines()
+            depotfile = entry['depotFile']
+            file_entry = [depotfile[depotfile.rfind('/')+1:]]
+            file_entry.append("Changelist: " + change)
+            file_entry.append(descriptions[change])
+            file_entry.append(entry['localFile'])
+            files_per_changelist.setdefault(change, []).append(file_entry)
 
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                files_list.extend(self.MakeFileListFromChangelist(changelistlinesplit))
+        for change in changelists:
+            files_list.extend(files_per_changelist.get(change, []))
 
         return files_list
 
@@ -706,50 +4385,37 @@ class ListCheckedOutFilesThread(threading.Thread):
 
 class PerforceListCheckedOutFilesCommand(sublime_plugin.WindowCommand):
     def run(self):
-        PrepareCommand();
-
-        ListCheckedOutFilesThread(self.window).start()
+        ListCheckedOutFilesThread(self.window, GetWindowContext(self.window, self)).start()
 
 # Create Changelist section
-def CreateChangelist(description):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = ConstructCommand('p4 change -o')   
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+def CreateChangelist(in_context, description):
+    # First, retrieve the spec of a new changelist, we will then set the description
+    records, err = RunP4Command(['change', '-o'], in_context)
 
     if(err):
         return 0, err
 
-    # Find the description field and modify it
-    desclabel = 'Description:' + os.linesep
-    descindex = result.find(desclabel) + len(desclabel)
-    descend = result.find(os.linesep*2, descindex)
-    result = result[0:descindex] + '\t' + description + result[descend:]
-
-    # Remove all files from the query, we want them to stay in Default
-    filesindex = result.rfind("Files:")
-    # The Files: section we want to get rid of is only present if there's files in the default changelist
-    if(filesindex > 640):
-        result = result[0:filesindex];
-
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
-
-    try:
-        temp_changelist_description_file.write(result)
-    finally:
-        temp_changelist_description_file.close()
+    spec = records[0]
+    del spec['code']
+    spec['Description'] = description + '\n'
 
-    command = ConstructCommand('p4 change -i < ' + temp_changelist_description_file.name)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    # Remove all files from the spec, we want them to stay in Default
+    for key in spec.keys():
+        if(key.startswith('Files')):
+            del spec[key]
 
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
+    records, err = RunP4Command(['change', '-i'], in_context, marshal.dumps(spec, 0))
 
     if(err):
         return 0, err
 
-    return 1, result
+    # 'Change 1234 created.'
+    message = records[0].get('data', '').strip()
+    model = PeekPendingChangelistsModel(in_context)
+    if(model and len(message.split(' ')) > 1):
+        model.SetChangelist(message.split(' ')[1], description, spec.get('Client', ''))
+
+    return 1, message
 
 class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
     def run(self):
@@ -758,9 +4424,7 @@ class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
             self.on_done, self.on_change, self.on_cancel)
 
     def on_done(self, input):
-        PrepareCommand();
-
-        success, message = CreateChangelist(input)
+        success, message = CreateChangelist(GetWindowContext(self.window, self), input)
         LogResults(success, message)
 
     def on_change(self, input):
@@ -770,43 +4434,31 @@ class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
         pass
 
 # Move Current File to Changelist
-def MoveFileToChangelist(in_filename, in_changelist):
-    folder_name, filename = os.path.split(in_filename)
+def MoveFileToChangelist(in_context, in_filename, in_changelist):
     in_command = 'reopen'
 
     # open and move file if it's not opened else just move
-    if(not IsFileOpenedOnClient(in_filename)):
+    if(not IsFileOpenedOnClient(in_context, in_filename)):
         in_command = 'edit'
 
-    command = ConstructCommand('p4 ' + in_command + ' -c ' + in_changelist + ' "' + filename + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
-
-    if(err):
-        return 0, err
-
-    return 1, result
+    return PerforceFileOperation(in_context, in_command, [in_filename], in_changelist)
 
 class ListChangelistsAndMoveFileThread(threading.Thread):
-    def __init__(self, window):
+    def __init__(self, window, context):
         self.window = window
+        self.context = context
         self.view = window.active_view()
         threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, model = GetPendingChangelistsModel(self.context);
 
         resultchangelists = ['New', 'Default'];
 
         if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
+            for changelist in model.GetChangelists():
                 # Insert at two because we receive the changelist in the opposite order and want to keep new and default on top
-                resultchangelists.insert(2, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+                resultchangelists.insert(2, FormatChangelistEntry(changelist))
 
         return resultchangelists
 
@@ -836,18 +4488,18 @@ class ListChangelistsAndMoveFileThread(threading.Thread):
             if(changelist == 'New'): # Special Case
                 self.window.show_input_panel('Changelist Description', '', self.on_description_done, self.on_description_change, self.on_description_cancel)
             else:
-                success, message = MoveFileToChangelist(self.view.file_name(), changelist.lower())
+                success, message = MoveFileToChangelist(self.context, self.view.file_name(), changelist.lower())
                 LogResults(success, message);
 
         sublime.set_timeout(move_file, 10)
 
     def on_description_done(self, input):
-        success, message = CreateChangelist(input)
+        success, message = CreateChangelist(self.context, input)
         if(success == 1):
             # Extract the changelist name from the message
             changelist = message.split(' ')[1]
             # Move the file
-            success, message = MoveFileToChangelist(self.view.file_name(), changelist)
+            success, message = MoveFileToChangelist(self.context, self.view.file_name(), changelist)
 
         LogResults(success, message)
     
@@ -859,41 +4511,37 @@ class ListChangelistsAndMoveFileThread(threading.Thread):
 
 class PerforceMoveCurrentFileToChangelistCommand(sublime_plugin.WindowCommand):
     def run(self):
-        PrepareCommand();
+        context = GetWindowContext(self.window, self)
 
         # first, test if the file is under the client root
         folder_name, filename = os.path.split(self.window.active_view().file_name())
-        isInDepot = IsFileInDepot(folder_name, filename)
+        isInDepot = IsFileInDepot(context, folder_name, filename)
 
         if(isInDepot != 1):
             WarnUser("File is not under the client root.")
             return 0
 
-        ListChangelistsAndMoveFileThread(self.window).start()
+        ListChangelistsAndMoveFileThread(self.window, context).start()
 
 # Add Line to Changelist Description
 class AddLineToChangelistDescriptionThread(threading.Thread):
-    def __init__(self, window):
+    def __init__(self, window, context):
         self.window = window
+        self.context = context
         self.view = window.active_view()
         threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, model = GetPendingChangelistsModel(self.context);
 
         resultchangelists = [];
 
         if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
+            for changelist in model.GetChangelists():
                 # Insert at zero because we receive the changelist in the opposite order
                 # Might be more efficient to sort...
-                changelist_entry = ["Changelist " + changelistlinesplit[1]]
-                changelist_entry.append(' '.join(changelistlinesplit[7:]));
+                changelist_entry = ["Changelist " + changelist['change']]
+                changelist_entry.append(changelist['desc']);
                 
                 resultchangelists.insert(0, changelist_entry) 
 
@@ -922,7 +4570,7 @@ class AddLineToChangelistDescriptionThread(threading.Thread):
         sublime.set_timeout(get_description_line, 10)
 
     def on_description_done(self, input):
-        success, message = AppendToChangelistDescription(self.changelist, input)
+        success, message = AppendToChangelistDescription(self.context, self.changelist, input)
         
         LogResults(success, message)
     
@@ -934,38 +4582,121 @@ class AddLineToChangelistDescriptionThread(threading.Thread):
 
 class PerforceAddLineToChangelistDescriptionCommand(sublime_plugin.WindowCommand):
     def run(self):
-        PrepareCommand();
+        AddLineToChangelistDescriptionThread(self.window, GetWindowContext(self.window, self)).start()
+
+# Streamed jobs section
+# submit, shelve and unshelve can take minutes on large changelists, p4 runs them in the background and its output
+# is shown in the Perforce output panel as it is printed, with the number of files done so far in the status bar.
+# They are stopped like any other p4 command, with Perforce: Cancel Running Commands
+streamed_file_line_pattern = re.compile(r'^(\S+ )?//')
+
+def GetServerVersion(in_context):
+    # (2015, 1) for 'P4D/LINUX26X86_64/2015.1/1024208 (2015/03/16)', (0, 0) when unknown
+    success, info = GetConnectionInfo(in_context)
+    if(success):
+        match = re.match(r'^[^/]+/[^/]+/(\d+)\.(\d+)', info.get('serverVersion', ''))
+        if(match):
+            return (int(match.group(1)), int(match.group(2)))
+    return (0, 0)
+
+def GetParallelTransferArguments(in_context, in_subcommand):
+    # parallel transfers were added to submit with 2015.1 servers and to shelve with 2017.1 servers
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    threads = perforce_settings.get('perforce_parallel_transfer_threads')
+    minimumversions = {'submit': (2015, 1), 'shelve': (2017, 1)}
+    if(not threads or in_subcommand not in minimumversions):
+        return []
+    if(GetServerVersion(in_context) < minimumversions[in_subcommand]):
+        return []
+    return ['--parallel=threads=' + str(threads)]
+
+class StreamedP4Job(threading.Thread):
+    def __init__(self, window, context, arguments, title, changelist, on_done):
+        # the files of the changelist are counted to show the progress, on_done(err, output) is called from the job
+        # when p4 is done and returns the summary shown last
+        self.window = window
+        self.context = context
+        self.arguments = arguments
+        self.title = title
+        self.changelist = changelist
+        self.total = None
+        self.on_done = on_done
+        self.pending = []
+        self.partialline = ''
+        self.count = 0
+        threading.Thread.__init__(self)
+
+    def GetProgress(self):
+        if(self.total):
+            return self.title + ": " + str(self.count) + "/" + str(self.total) + " files"
+        return self.title + ": " + str(self.count) + " files"
+
+    def Flush(self):
+        text = ''.join(self.pending)
+        self.pending = []
+        progress = self.GetProgress()
+
+        def show_output():
+            AppendToOutputPanel(self.window, text)
+            sublime.status_message("Perforce: " + progress)
+        sublime.set_timeout(show_output, 10)
+
+    def OnOutput(self, chunk, output):
+        output.append(chunk)
+        self.pending.append(chunk)
+        lines = (self.partialline + chunk).split('\n')
+        self.partialline = lines.pop()
+        self.count += len([line for line in lines if streamed_file_line_pattern.match(line)])
+        # the panel is updated a few times per second, not for every line
+        if(time.time() - self.lastflush > 0.2):
+            self.Flush()
+            self.lastflush = time.time()
 
-        AddLineToChangelistDescriptionThread(self.window).start()
+    def run(self):
+        if(self.changelist):
+            success, index = GetOpenedFilesIndex(self.context)
+            if(success):
+                self.total = len(index.GetFilesInChangelist(self.changelist))
+        self.arguments = self.arguments[:1] + GetParallelTransferArguments(self.context, self.arguments[0]) + self.arguments[1:]
+
+        header = "p4 " + ' '.join(self.arguments) + "\n"
+        sublime.set_timeout(lambda: ShowOutputPanel(self.window, header), 10)
+
+        output = []
+        self.lastflush = time.time()
+        err = StreamP4Output(self.arguments, self.context, lambda chunk: self.OnOutput(chunk, output))
+        output = ''.join(output)
+
+        if(err.strip()):
+            self.pending.append(err)
+        summary = self.on_done(err.strip(), output)
+        if(summary):
+            self.pending.append(summary + "\n")
+        self.Flush()
 
 # Submit section
 class SubmitThread(threading.Thread):
-    def __init__(self, window):
+    def __init__(self, window, context):
         self.window = window
+        self.context = context
         self.view = window.active_view()
         threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, model = GetPendingChangelistsModel(self.context);
 
         resultchangelists = ['Default'];
 
-        currentuser = GetUserFromClientspec();
-        command = ConstructCommand('p4 opened -c default -u ' + currentuser)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        if err:
+        # the default changelist is only listed when the current user has files opened in it
+        currentuser = GetUserFromClientspec(self.context);
+        indexsuccess, index = GetOpenedFilesIndex(self.context)
+        if indexsuccess and not [entry for entry in index.GetFilesInChangelist('default') if entry['user'] in ['', currentuser]]:
             resultchangelists.pop()
 
         if success:
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
+            for changelist in model.GetChangelists():
                 # Insert at two because we receive the changelist in the opposite order and want to keep default on top
-                resultchangelists.insert(1, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+                resultchangelists.insert(1, FormatChangelistEntry(changelist))
 
         return resultchangelists
 
@@ -986,15 +4717,37 @@ class SubmitThread(threading.Thread):
         changelist = self.changelists_list[picked]
         changelistsections = changelist.split(' ')
 
-        command = ''
+        changelist = 'default'
         # Check in the selected changelist
         if changelistsections[0] != 'Default':
-            command = ConstructCommand('p4 submit -c ' + changelistsections[1]);   
+            changelist = changelistsections[1]
+            command = ['submit', '-c', changelist]
         else:
-            command = ConstructCommand('p4 submit')
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-    
+            command = ['submit']
+        StreamedP4Job(self.window, self.context, command, "submitting the " + changelist + " changelist", changelist,
+            lambda err, output: self.on_submitted(changelist, err, output)).start()
+
+    def on_submitted(self, changelist, err, output):
+        # 'Change 1234 submitted.' or 'Change 1234 renamed change 1240 and submitted.'
+        match = re.search(r'^Change (\d+) (?:renamed change (\d+) and )?submitted\.', output, re.MULTILINE)
+        if(err or not match):
+            if(not err):
+                err = "The changelist was not submitted."
+            WarnUser(err.splitlines()[0])
+            return "Submit failed."
+
+        success, index = GetOpenedFilesIndex(self.context)
+        if(success):
+            index.SetChangelistClosed(changelist)
+        model = PeekPendingChangelistsModel(self.context)
+        if(model):
+            model.SetClosed(changelist)
+
+        submitted = match.group(2) or match.group(1)
+        sublime.set_timeout(RequestAllViewStatuses, 10)
+        LogResults(1, "Submitted change " + submitted + ".")
+        return "Submitted change " + submitted + "."
+
     def on_description_change(self, input):
         pass
 
@@ -1003,63 +4756,61 @@ class SubmitThread(threading.Thread):
 
 class PerforceSubmitCommand(sublime_plugin.WindowCommand):
     def run(self):
-        PrepareCommand();
-
-        SubmitThread(self.window).start()
+        SubmitThread(self.window, GetWindowContext(self.window, self)).start()
 
 
 class PerforceLogoutCommand(sublime_plugin.WindowCommand):
     def run(self):
-        PrepareCommand();
+        context = GetWindowContext(self.window, self)
 
         try:
-            command = ConstructCommand("p4 set P4PASSWD=")
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4TextCommand(['set', 'P4PASSWD='], context)
         except ValueError:
             pass
 
+        InvalidateConnectionInfo()
+
+class PerforceRefreshEnvironmentCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        RefreshPerforceEnvironment()
+        InvalidateConnectionInfo()
+
 class PerforceLoginCommand(sublime_plugin.WindowCommand):
     def run(self):
         self.window.show_input_panel("Enter Perforce Password", "", self.on_done, None, None)
 
     def on_done(self, password):
         try:
-            PrepareCommand();
+            context = GetWindowContext(self.window, self)
 
-            command = ConstructCommand("p4 logout")
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4TextCommand(['logout'], context)
             #unset var 
-            command = ConstructCommand("p4 set P4PASSWD=" + password)
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4TextCommand(['set', 'P4PASSWD=' + password], context)
         except ValueError:
             pass
 
+        InvalidateConnectionInfo()
+
 class PerforceUnshelveClCommand(sublime_plugin.WindowCommand):
     def run(self):
         try:
-            PrepareCommand();
-
-            ShelveClCommand(self.window, False).start()
+            ShelveClCommand(self.window, GetWindowContext(self.window, self), False).start()
         except:
             WarnUser("Unknown Error, does the included P4 Version support Shelve?")
             return -1
 class PerforceShelveClCommand(sublime_plugin.WindowCommand):
     def run(self):
         try:
-            PrepareCommand();
-
-            ShelveClCommand(self.window, True).start()
+            ShelveClCommand(self.window, GetWindowContext(self.window, self), True).start()
         except:
             WarnUser("Unknown Error, does the included P4 Version support Shelve?")
             return -1
 
 class ShelveClCommand(threading.Thread):
-    def __init__(self, window, shelve=True):
+    def __init__(self, window, context, shelve=True):
         self.shelve = shelve
         self.window = window
+        self.context = context
         threading.Thread.__init__(self)
 
     def run(self):
@@ -1085,29 +4836,110 @@ class ShelveClCommand(threading.Thread):
             changelist = changelistlist[0]
      
         if self.shelve:
-            cmdString = "shelve -c" + changelist
+            command = ['shelve', '-c', changelist]
+            title = "shelving change " + changelist
+            StreamedP4Job(self.window, self.context, command, title, changelist, lambda err, output: self.on_finished(changelist, err, output)).start()
         else:
-            cmdString = "unshelve -s" + changelist + " -f"
-        command = ConstructCommand("p4 " + cmdString)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+            # the shelved files aren't in the opened files index, their number isn't known
+            command = ['unshelve', '-s', changelist, '-f']
+            title = "unshelving change " + changelist
+            StreamedP4Job(self.window, self.context, command, title, None, lambda err, output: self.on_finished(changelist, err, output)).start()
+
+    def on_finished(self, changelist, err, output):
+        if(not self.shelve):
+            # unshelving opens files, the index is reloaded the next time it's needed
+            success, index = GetOpenedFilesIndex(self.context)
+            if(success):
+                index.Invalidate()
+            sublime.set_timeout(RequestAllViewStatuses, 10)
 
         if(err):
-            WarnUser("usererr " + err.strip())
-            return -1 
+            WarnUser("usererr " + err.splitlines()[0])
+            return (self.shelve and "Shelve" or "Unshelve") + " failed."
+
+        if(self.shelve):
+            model = PeekPendingChangelistsModel(self.context)
+            if(model):
+                model.SetShelved(changelist, True)
+            return "Shelved change " + changelist + "."
+        return "Unshelved change " + changelist + "."
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, model = GetPendingChangelistsModel(self.context);
 
         resultchangelists = []
 
         if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                resultchangelists.insert(0, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+            for changelist in model.GetChangelists():
+                resultchangelists.insert(0, FormatChangelistEntry(changelist))
 
         return resultchangelists
+
+# Cancel section
+class PerforceCancelCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        count = CancelRunningP4Processes()
+        if(count):
+            LogResults(1, "Cancelled " + str(count) + " running p4 command(s).")
+        else:
+            LogResults(-1, "No p4 command is running.")
+
+# Performance Stats section
+class PerforceShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        view = self.window.new_file()
+        view.set_name('Perforce Performance Stats')
+        view.set_scratch(True)
+        edit = view.begin_edit()
+        view.insert(edit, 0, perforce_stats.MakeReport())
+        view.end_edit(edit)
+        view.set_read_only(True)
+
+# Plugin lifecycle section
+# the background threads and timers are started when the plugin is loaded and stopped when it is unloaded, so that a
+# reload doesn't leave the pollers of the previous run behind. Threads can't be started twice, a reload creates new
+# instances when it runs the module again
+background_services_stopped = None
+
+def StartBackgroundServices():
+    global background_services_stopped
+    if(background_services_stopped is not None):
+        return
+    background_services_stopped = threading.Event()
+
+    view_status_service.start()
+    out_of_date_watcher.start()
+    perforce_work_queue.start()
+    perforce_index_queue.start()
+    ScheduleOpenedFilesIndexesReload(background_services_stopped)
+    ScheduleViewStatusesRefresh(background_services_stopped)
+
+    # pay for sourcing the profile once, when the plugin is loaded
+    threading.Thread(target=GetPerforceEnvironment).start()
+    threading.Thread(target=CleanupTempDir).start()
+    # warm the workspace of the active view, then show the status of the open views
+    sublime.set_timeout(PrefetchActiveWorkspace, 1000)
+    sublime.set_timeout(RequestAllViewStatuses, 1500)
+
+def StopBackgroundServices():
+    global background_services_stopped
+    if(background_services_stopped is None or background_services_stopped.isSet()):
+        return
+    background_services_stopped.set()
+
+    view_status_service.Stop()
+    out_of_date_watcher.Stop()
+    perforce_work_queue.Stop()
+    perforce_index_queue.Stop()
+    workspace_prefetcher.Cancel()
+
+def plugin_loaded():
+    StartBackgroundServices()
+
+def plugin_unloaded():
+    StopBackgroundServices()
+
+# Sublime Text 2 has no plugin_loaded, the services start with the module, and calls unload_handler before a reload
+unload_handler = plugin_unloaded
+if(not hasattr(sublime, 'set_timeout_async')):
+    plugin_loaded()
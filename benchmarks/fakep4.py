@@ -0,0 +1,500 @@
+# Scriptable stand-in for the p4 command line client used by the benchmarks
+# The workspace is generated from the JSON state file named by FAKEP4_STATE: 'filecount' depot files named
+# //depot/src/fNNNNNNN.txt, the first 'openedcount' of which are opened for edit and spread over the pending
+# changelists. Files opened, reverted and changelists created during a run are written back to the state file.
+# FAKEP4_LATENCY is the number of milliseconds every call waits before answering (the server round trip),
+# FAKEP4_LOG names a file every call is appended to, one line per process, to count the spawns, and
+# FAKEP4_TRANSFER_LATENCY the number of milliseconds submit, shelve and unshelve take per file.
+import hashlib
+import json
+import marshal
+import os
+import re
+import sys
+import time
+
+def Encode(in_value):
+    # json gives unicode strings, p4 -G gives byte strings
+    if(isinstance(in_value, dict)):
+        return dict([(Encode(key), Encode(value)) for key, value in in_value.items()])
+    if(isinstance(in_value, list)):
+        return [Encode(value) for value in in_value]
+    if(isinstance(in_value, unicode)):
+        return in_value.encode('utf-8')
+    return in_value
+
+class Workspace(object):
+    def __init__(self, in_statefile):
+        self.statefile = in_statefile
+        self.state = Encode(json.load(open(in_statefile)))
+        self.root = self.state['root']
+        self.client = self.state['client']
+        self.user = self.state['user']
+        self.prefix = self.root + os.sep + 'src' + os.sep
+
+    def Save(self):
+        json.dump(self.state, open(self.statefile, 'w'))
+
+    def DepotFile(self, in_number):
+        return '//depot/src/f%07d.txt' % in_number
+
+    def FileNumber(self, in_filename):
+        # the number of a depot, client or local file name, None for files outside of the workspace
+        filename = in_filename.split('#')[0].split('@')[0]
+        if(filename.startswith('//')):
+            match = re.match(r'^//(depot|' + re.escape(self.client) + r')/src/f(\d+)\.txt$', filename)
+        else:
+            filename = os.path.abspath(filename)
+            if(not filename.startswith(self.prefix)):
+                return None
+            match = re.match(r'^()f(\d+)\.txt$', filename[len(self.prefix):])
+        if(not match or int(match.group(2)) >= self.state['filecount']):
+            return None
+        return int(match.group(2))
+
+    def LocalFile(self, in_number):
+        return self.prefix + 'f%07d.txt' % in_number
+
+    def ClientFile(self, in_number):
+        return '//%s/src/f%07d.txt' % (self.client, in_number)
+
+    def Changelists(self):
+        return [changelist['change'] for changelist in self.state['changes']]
+
+    def Opened(self, in_number):
+        # (action, change) of an opened file, None when it isn't opened
+        key = str(in_number)
+        if(key in self.state['opened']):
+            return self.state['opened'][key]
+        if(in_number >= self.state['openedcount'] or key in self.state['reverted']):
+            return None
+        changelists = self.Changelists()
+        if(in_number % 3 == 0 or not changelists):
+            return ['edit', 'default']
+        return ['edit', changelists[in_number % len(changelists)]]
+
+    def OpenedNumbers(self):
+        numbers = set([int(key) for key in self.state['opened'].keys()])
+        reverted = set([int(key) for key in self.state['reverted']])
+        for number in range(self.state['openedcount']):
+            if(number not in reverted):
+                numbers.add(number)
+        return sorted(numbers)
+
+    def SetOpened(self, in_number, in_action, in_change):
+        self.state['opened'][str(in_number)] = [in_action, in_change]
+
+    def SetReverted(self, in_number):
+        self.state['opened'].pop(str(in_number), None)
+        if(in_number < self.state['openedcount']):
+            self.state['reverted'].append(str(in_number))
+
+    def Content(self, in_number, in_rev):
+        line = 'line of //depot/src/f%07d.txt#%d\n' % (in_number, in_rev)
+        return line * max(1, self.state['filesize'] / len(line))
+
+class Output(object):
+    def __init__(self, in_tagged):
+        self.tagged = in_tagged
+        self.errors = 0
+
+    def Record(self, in_record, in_text):
+        if(self.tagged):
+            if('code' not in in_record):
+                in_record = dict(in_record)
+                in_record['code'] = 'stat'
+            marshal.dump(in_record, sys.stdout, 0)
+        elif(in_text is not None):
+            sys.stdout.write(in_text + '\n')
+
+    def Info(self, in_message):
+        self.Record({'code': 'info', 'data': in_message, 'level': 0}, in_message)
+
+    def Error(self, in_message):
+        self.errors += 1
+        if(self.tagged):
+            marshal.dump({'code': 'error', 'data': in_message + '\n', 'severity': 3, 'generic': 17}, sys.stdout, 0)
+        else:
+            sys.stderr.write(in_message + '\n')
+
+def OptionValue(in_arguments, in_option):
+    if(in_option in in_arguments):
+        position = in_arguments.index(in_option)
+        if(position + 1 < len(in_arguments)):
+            return in_arguments[position + 1]
+    return None
+
+def FileArguments(in_arguments, in_optionswithvalues):
+    files = []
+    skip = False
+    for argument in in_arguments:
+        if(skip):
+            skip = False
+        elif(argument in in_optionswithvalues):
+            skip = True
+        elif(not argument.startswith('-')):
+            files.append(argument)
+    return files
+
+def Info(in_workspace, in_arguments, in_output):
+    state = in_workspace.state
+    record = {'userName': state['user'], 'clientName': state['client'], 'clientRoot': state['root'], 'serverAddress': state['port'], 'serverVersion': state['version'], 'caseHandling': 'sensitive'}
+    in_output.Record(record, 'User name: %(userName)s\nClient name: %(clientName)s\nClient root: %(clientRoot)s\nServer address: %(serverAddress)s\nServer version: %(serverVersion)s' % record)
+
+def Client(in_workspace, in_arguments, in_output):
+    view = '//depot/... //%s/...' % in_workspace.client
+    record = {'Client': in_workspace.client, 'Root': in_workspace.root, 'Owner': in_workspace.user, 'View0': view}
+    in_output.Record(record, 'Client:\t%s\n\nRoot:\t%s\n\nView:\n\t%s' % (in_workspace.client, in_workspace.root, view))
+
+def Changes(in_workspace, in_arguments, in_output):
+    for changelist in in_workspace.state['changes']:
+        record = {'change': changelist['change'], 'desc': changelist['desc'], 'status': 'pending', 'user': in_workspace.user, 'client': in_workspace.client, 'time': '1400000000'}
+        in_output.Record(record, "Change %(change)s on 2014/01/01 by %(user)s@%(client)s *pending* '%(desc)s'" % record)
+
+def Opened(in_workspace, in_arguments, in_output):
+    change = OptionValue(in_arguments, '-c')
+    files = FileArguments(in_arguments, ['-c', '-u', '-C', '-m'])
+    if(files):
+        numbers = [number for number in [in_workspace.FileNumber(filename) for filename in files] if number is not None]
+    else:
+        numbers = in_workspace.OpenedNumbers()
+
+    found = False
+    for number in numbers:
+        opened = in_workspace.Opened(number)
+        if(not opened or (change and opened[1] != change)):
+            continue
+        found = True
+        record = {'depotFile': in_workspace.DepotFile(number), 'clientFile': in_workspace.ClientFile(number), 'rev': '1', 'haveRev': '1', 'action': opened[0], 'change': opened[1], 'type': 'text', 'user': in_workspace.user, 'client': in_workspace.client}
+        in_output.Record(record, '%s#1 - %s %s (text)' % (record['depotFile'], opened[0], opened[1] == 'default' and 'default change' or 'change ' + opened[1]))
+    if(not found):
+        in_output.Error('File(s) not opened on this client.')
+
+def ExpandFileArguments(in_workspace, in_filenames):
+    # (file name, number) of the files, a 'folder/...' argument is every file of the workspace under the folder
+    files = []
+    for filename in in_filenames:
+        if(not filename.endswith('...')):
+            files.append((filename, in_workspace.FileNumber(filename)))
+            continue
+        folder = os.path.abspath(filename[:-3])
+        if(not folder.endswith(os.sep)):
+            folder += os.sep
+        if(not in_workspace.prefix.startswith(folder) and folder != in_workspace.prefix):
+            files.append((filename, None))
+            continue
+        for number in range(in_workspace.state['filecount']):
+            files.append((in_workspace.LocalFile(number), number))
+    return files
+
+def FileOperation(in_workspace, in_command, in_arguments, in_output):
+    change = OptionValue(in_arguments, '-c') or 'default'
+    files = FileArguments(in_arguments, ['-c', '-t'])
+    wildcard = len([filename for filename in files if filename.endswith('...')]) > 0
+    for filename, number in ExpandFileArguments(in_workspace, files):
+        if(number is None):
+            in_output.Error('%s - file(s) not in client view.' % filename)
+            continue
+        depotfile = in_workspace.DepotFile(number)
+        localfile = in_workspace.LocalFile(number)
+        opened = in_workspace.Opened(number)
+        if(wildcard and in_command in ('revert', 'reopen') and not opened):
+            continue
+        if(in_command == 'revert' and '-a' in in_arguments and number < 5):
+            # the files written on disk are the modified ones
+            continue
+        if(in_command == 'reconcile'):
+            # the writable files which aren't opened were edited offline
+            if(not opened and os.path.exists(localfile) and os.access(localfile, os.W_OK)):
+                if('-n' not in in_arguments):
+                    in_workspace.SetOpened(number, 'edit', change)
+                in_output.Record({'depotFile': depotfile, 'clientFile': localfile, 'workRev': '1', 'action': 'edit', 'change': change, 'type': 'text'}, '%s#1 - opened for edit' % depotfile)
+            continue
+        if(in_command == 'revert'):
+            if(not opened):
+                in_output.Error('%s - file(s) not opened on this client.' % filename)
+                continue
+            in_workspace.SetReverted(number)
+            in_output.Record({'depotFile': depotfile, 'clientFile': localfile, 'haveRev': '1', 'action': 'reverted', 'oldAction': opened[0]}, '%s#1 - was %s, reverted' % (depotfile, opened[0]))
+        elif(in_command == 'reopen'):
+            if(not opened):
+                in_output.Error('%s - file(s) not opened on this client.' % filename)
+                continue
+            in_workspace.SetOpened(number, opened[0], change)
+            in_output.Record({'depotFile': depotfile, 'workRev': '1', 'action': opened[0], 'change': change}, '%s#1 - reopened; change %s' % (depotfile, change))
+        elif(opened):
+            in_output.Record({'depotFile': depotfile, 'clientFile': localfile, 'workRev': '1', 'action': opened[0]}, '%s - currently opened for %s' % (depotfile, opened[0]))
+        else:
+            in_workspace.SetOpened(number, in_command, change)
+            if(in_command == 'edit' and os.path.exists(localfile)):
+                os.chmod(localfile, 0644)
+            in_output.Record({'depotFile': depotfile, 'clientFile': localfile, 'workRev': '1', 'action': in_command, 'change': change, 'type': 'text'}, '%s#1 - opened for %s' % (depotfile, in_command))
+    in_workspace.Save()
+
+def Revision(in_workspace, in_filespec):
+    state = in_workspace.state
+    if('#' not in in_filespec):
+        return state['headrev']
+    rev = in_filespec.split('#')[1]
+    if(rev == 'have'):
+        return 1
+    if(rev == 'head'):
+        return state['headrev']
+    return int(rev)
+
+def Print(in_workspace, in_arguments, in_output):
+    destination = OptionValue(in_arguments, '-o')
+    for filespec in FileArguments(in_arguments, ['-o']):
+        number = in_workspace.FileNumber(filespec)
+        if(number is None):
+            in_output.Error('%s - no such file(s).' % filespec)
+            continue
+        rev = Revision(in_workspace, filespec)
+        content = in_workspace.Content(number, rev)
+        header = '%s#%d - edit change %d (text)' % (in_workspace.DepotFile(number), rev, rev)
+        if(destination):
+            open(destination, 'wb').write(content)
+            in_output.Record({'depotFile': in_workspace.DepotFile(number), 'rev': str(rev), 'type': 'text'}, header)
+        elif(in_output.tagged):
+            in_output.Record({'depotFile': in_workspace.DepotFile(number), 'rev': str(rev), 'type': 'text'}, None)
+            in_output.Record({'code': 'text', 'data': content}, None)
+        else:
+            if('-q' not in in_arguments):
+                sys.stdout.write(header + '\n')
+            sys.stdout.write(content)
+
+def Annotate(in_workspace, in_arguments, in_output):
+    # every line is attributed to one of the revisions up to the one annotated, with -c the change is the revision
+    for filespec in FileArguments(in_arguments, []):
+        number = in_workspace.FileNumber(filespec)
+        if(number is None):
+            in_output.Error('%s - no such file(s).' % filespec)
+            continue
+        rev = Revision(in_workspace, filespec)
+        if('-q' not in in_arguments):
+            sys.stdout.write('%s#%d - edit change %d (text)\n' % (in_workspace.DepotFile(number), rev, rev))
+        for position, line in enumerate(in_workspace.Content(number, rev).splitlines(True)):
+            linerev = position % rev + 1
+            if('-u' in in_arguments):
+                sys.stdout.write('%d: %s 2012/01/%02d %s' % (linerev, in_workspace.user, linerev, line))
+            else:
+                sys.stdout.write('%d: %s' % (linerev, line))
+
+def Filelog(in_workspace, in_arguments, in_output):
+    # the revisions from the one of the file spec down to the first, -m limits how many are listed
+    maximum = OptionValue(in_arguments, '-m')
+    for filespec in FileArguments(in_arguments, ['-m']):
+        number = in_workspace.FileNumber(filespec)
+        if(number is None):
+            in_output.Error('%s - no such file(s).' % filespec)
+            continue
+        revs = range(min(Revision(in_workspace, filespec), in_workspace.state['headrev']), 0, -1)
+        if(maximum):
+            revs = revs[:int(maximum)]
+        record = {'depotFile': in_workspace.DepotFile(number)}
+        lines = [record['depotFile']]
+        for position, rev in enumerate(revs):
+            action = 'edit'
+            if(rev == 1):
+                action = 'add'
+            record['rev%d' % position] = str(rev)
+            record['change%d' % position] = str(rev)
+            record['action%d' % position] = action
+            record['type%d' % position] = 'text'
+            record['time%d' % position] = str(1325376000 + rev * 86400)
+            record['user%d' % position] = in_workspace.user
+            record['client%d' % position] = in_workspace.client
+            record['desc%d' % position] = 'Revision %d of the file\n' % rev
+            lines.append('... #%d change %d %s on 2012/01/01 by %s@%s (text)' % (rev, rev, action, in_workspace.user, in_workspace.client))
+        in_output.Record(record, '\n'.join(lines))
+
+def Fstat(in_workspace, in_arguments, in_output):
+    # a folder/...#have file spec lists the synced files, the ones which exist on disk
+    files = []
+    for filespec in FileArguments(in_arguments, ['-T', '-F', '-m', '-e']):
+        path = filespec.split('#')[0]
+        if(path.endswith('...')):
+            expanded = [(filename, number) for filename, number in ExpandFileArguments(in_workspace, [path]) if number is not None]
+            files.extend([(filespec, number) for filename, number in expanded if os.path.exists(filename)])
+        else:
+            files.append((filespec, in_workspace.FileNumber(filespec)))
+
+    for filespec, number in files:
+        if(number is None):
+            in_output.Error('%s - no such file(s).' % filespec)
+            continue
+        rev = Revision(in_workspace, filespec)
+        record = {'depotFile': in_workspace.DepotFile(number), 'clientFile': in_workspace.LocalFile(number), 'headRev': str(rev), 'haveRev': '1', 'headType': 'text', 'headAction': 'edit'}
+        if('-Ol' in in_arguments):
+            content = in_workspace.Content(number, rev)
+            record['digest'] = hashlib.md5(content).hexdigest().upper()
+            record['fileSize'] = str(len(content))
+        opened = in_workspace.Opened(number)
+        if(opened):
+            record['action'] = opened[0]
+            record['change'] = opened[1]
+        in_output.Record(record, '\n'.join(['... %s %s' % item for item in sorted(record.items())]))
+
+def Change(in_workspace, in_arguments, in_output):
+    state = in_workspace.state
+    if('-i' in in_arguments):
+        if(in_output.tagged):
+            spec = marshal.load(sys.stdin)
+        else:
+            text = sys.stdin.read()
+            spec = {'Change': re.search(r'Change:\s*(\S+)', text).group(1)}
+            spec['Description'] = '\n'.join([line.strip() for line in re.search(r'Description:\n((?:\t.*\n?)*)', text).group(1).splitlines()])
+        if(spec['Change'] == 'new'):
+            change = str(state['nextchange'])
+            state['nextchange'] += 1
+            state['changes'].append({'change': change, 'desc': spec['Description'].strip()})
+            in_output.Info('Change %s created.' % change)
+        else:
+            for changelist in state['changes']:
+                if(changelist['change'] == spec['Change']):
+                    changelist['desc'] = spec['Description'].strip()
+            in_output.Info('Change %s updated.' % spec['Change'])
+        in_workspace.Save()
+        return
+
+    changes = FileArguments(in_arguments, [])
+    change = changes and changes[0] or 'new'
+    record = {'Change': change, 'Client': in_workspace.client, 'User': in_workspace.user, 'Status': change == 'new' and 'new' or 'pending', 'Description': '<enter description here>\n'}
+    for changelist in state['changes']:
+        if(changelist['change'] == change):
+            record['Description'] = changelist['desc'] + '\n'
+    # like p4, the spec of a new changelist lists the files of the default changelist
+    position = 0
+    for number in in_workspace.OpenedNumbers():
+        if(in_workspace.Opened(number)[1] == (change == 'new' and 'default' or change)):
+            record['Files%d' % position] = in_workspace.DepotFile(number)
+            position += 1
+    in_output.Record(record, 'Change:\t%s\n\nClient:\t%s\n\nUser:\t%s\n\nStatus:\t%s\n\nDescription:\n\t%s\n' % (change, in_workspace.client, in_workspace.user, record['Status'], record['Description'].strip()))
+
+def Diff(in_workspace, in_arguments, in_output):
+    for filename in FileArguments(in_arguments, ['-d']):
+        number = in_workspace.FileNumber(filename)
+        if(number is None):
+            in_output.Error('%s - file(s) not opened on this client.' % filename)
+            continue
+        in_output.Record({'depotFile': in_workspace.DepotFile(number)}, '==== %s#1 - %s ====\n@@ -1 +1 @@\n-a\n+b' % (in_workspace.DepotFile(number), in_workspace.LocalFile(number)))
+
+def Describe(in_workspace, in_arguments, in_output):
+    # a pending change lists its opened files, a submitted change N the files whose number ends like N
+    for change in FileArguments(in_arguments, []):
+        record = {'change': change, 'user': in_workspace.user, 'client': in_workspace.client, 'time': '1400000000', 'desc': 'work done in change %s\n' % change}
+        if(change in in_workspace.Changelists()):
+            record['status'] = 'pending'
+            numbers = [number for number in in_workspace.OpenedNumbers() if in_workspace.Opened(number)[1] == change]
+            rev = 1
+        else:
+            record['status'] = 'submitted'
+            numbers = range(int(change) % 10, in_workspace.state['filecount'], 10)
+            rev = in_workspace.state['headrev']
+        for position, number in enumerate(numbers):
+            record['depotFile%d' % position] = in_workspace.DepotFile(number)
+            record['action%d' % position] = 'edit'
+            record['type%d' % position] = 'text'
+            record['rev%d' % position] = str(rev)
+        in_output.Record(record, 'Change %s by %s@%s on 2014/01/01' % (change, in_workspace.user, in_workspace.client))
+
+def Diff2(in_workspace, in_arguments, in_output):
+    # a diff of one line between the contents of the two revisions
+    filespecs = FileArguments(in_arguments, [])
+    numbers = [in_workspace.FileNumber(filespec) for filespec in filespecs]
+    if(len(filespecs) != 2 or None in numbers):
+        in_output.Error('%s - no such file(s).' % ' '.join(filespecs))
+        return
+    old = in_workspace.Content(numbers[0], Revision(in_workspace, filespecs[0])).splitlines()[0]
+    new = in_workspace.Content(numbers[1], Revision(in_workspace, filespecs[1])).splitlines()[0]
+    sys.stdout.write('==== %s (text) - %s (text) ==== content\n@@ -1 +1 @@\n-%s\n+%s\n' % (filespecs[0], filespecs[1], old, new))
+
+def Transfer(in_workspace, in_command, in_arguments, in_output):
+    # the files are listed one line at a time like p4 does while it transfers them
+    change = OptionValue(in_arguments, '-c') or OptionValue(in_arguments, '-s') or 'default'
+    numbers = [number for number in in_workspace.OpenedNumbers() if in_workspace.Opened(number)[1] == change]
+    if(in_command == 'submit'):
+        if(not numbers):
+            in_output.Error('No files to submit.')
+            return
+        in_output.Info('Submitting change %s.' % change)
+        in_output.Info('Locking %d files ...' % len(numbers))
+    elif(in_command == 'shelve'):
+        in_output.Info('Shelving files for change %s.' % change)
+    for number in numbers:
+        depotfile = in_workspace.DepotFile(number)
+        if(in_command == 'unshelve'):
+            in_output.Info('%s#1 - unshelved, opened for edit' % depotfile)
+        else:
+            in_output.Info('edit %s#%d' % (depotfile, in_workspace.state['headrev'] + 1))
+        sys.stdout.flush()
+        time.sleep(float(os.environ.get('FAKEP4_TRANSFER_LATENCY', '0')) / 1000.0)
+    if(in_command == 'submit'):
+        for number in numbers:
+            in_workspace.SetReverted(number)
+        in_workspace.state['changes'] = [changelist for changelist in in_workspace.state['changes'] if changelist['change'] != change]
+        submitted = in_workspace.state['nextchange']
+        in_workspace.state['nextchange'] += 1
+        in_workspace.Save()
+        if(change == 'default'):
+            in_output.Info('Change %d submitted.' % submitted)
+        else:
+            in_output.Info('Change %s renamed change %d and submitted.' % (change, submitted))
+    elif(in_command == 'shelve'):
+        in_output.Info('Change %s files shelved.' % change)
+
+commands = {
+    'info': Info,
+    'client': Client,
+    'changes': Changes,
+    'opened': Opened,
+    'print': Print,
+    'annotate': Annotate,
+    'filelog': Filelog,
+    'fstat': Fstat,
+    'change': Change,
+    'diff': Diff,
+    'diff2': Diff2,
+    'describe': Describe,
+}
+
+def Main(in_arguments):
+    log = os.environ.get('FAKEP4_LOG')
+    if(log):
+        open(log, 'a').write(' '.join(in_arguments) + '\n')
+    time.sleep(float(os.environ.get('FAKEP4_LATENCY', '0')) / 1000.0)
+
+    tagged = False
+    argumentsfile = None
+    arguments = list(in_arguments)
+    while arguments and arguments[0].startswith('-'):
+        option = arguments.pop(0)
+        if(option == '-G'):
+            tagged = True
+        elif(option == '-x'):
+            argumentsfile = arguments.pop(0)
+        elif(option in ('-c', '-u', '-p', '-P', '-d', '-C', '-H', '-z')):
+            arguments.pop(0)
+    if(not arguments):
+        return 0
+
+    command = arguments.pop(0)
+    if(argumentsfile == '-'):
+        arguments.extend([line.rstrip('\r\n') for line in sys.stdin if line.strip()])
+
+    workspace = Workspace(os.environ['FAKEP4_STATE'])
+    output = Output(tagged)
+    if(command in ('submit', 'shelve', 'unshelve')):
+        Transfer(workspace, command, [argument for argument in arguments if not argument.startswith('--parallel')], output)
+    elif(command in ('edit', 'add', 'delete', 'revert', 'reopen', 'reconcile')):
+        FileOperation(workspace, command, arguments, output)
+    elif(command in commands):
+        commands[command](workspace, arguments, output)
+    else:
+        output.Error('Unknown command.  Try \'p4 help\' for info.')
+    if(output.errors):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,339 @@
+# Headless benchmarks of the plugin's p4 usage
+#
+# Perforce.py is imported with stand-ins for the sublime and sublime_plugin modules (benchmarks/stubs) and a fake p4
+# (benchmarks/fakep4.py) first on the PATH, with a simulated server latency and a generated workspace of a given
+# number of opened files. Every scenario drives the real entry points of the plugin in its own process and reports
+# the number of p4 processes spawned, the wall clock latency and the peak memory of that process, so that the
+# effect of a change can be measured before and after it.
+#
+# Usage, with the Python 2 interpreter Sublime Text 2 embeds a version of:
+#   python benchmarks/run_benchmarks.py
+#   python benchmarks/run_benchmarks.py --sizes 10,1000 --scenarios checkout,graphical_diff --latency 50
+#   python benchmarks/run_benchmarks.py --json before.json
+import json
+import optparse
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(benchmarks_dir)
+
+default_sizes = [10, 100, 1000, 10000, 100000]
+
+# number of depot files of the workspace which aren't opened, the scenarios work on those
+spare_files = 100
+
+# Workspace section
+# the fake p4 generates the workspace from a small state file, only the files the scenarios touch exist on disk
+def LocalFileName(in_root, in_number):
+    return os.path.join(in_root, 'src', 'f%07d.txt' % in_number)
+
+def CreateWorkspace(in_directory, in_openedcount, in_filesize, in_python):
+    root = os.path.join(in_directory, 'workspace')
+    os.makedirs(os.path.join(root, 'src'))
+    os.makedirs(os.path.join(in_directory, 'bin'))
+    os.makedirs(os.path.join(in_directory, 'tmp'))
+
+    state = {
+        'user': 'bench',
+        'client': 'bench_ws',
+        'root': root,
+        'port': 'perforce:1666',
+        'version': 'P4D/LINUX26X86_64/2015.1/1024208 (2015/03/16)',
+        'filecount': in_openedcount + spare_files,
+        'openedcount': in_openedcount,
+        'headrev': 3,
+        'filesize': in_filesize,
+        'changes': [{'change': str(change), 'desc': 'pending work %d' % change} for change in range(101, 106)],
+        'nextchange': 1000,
+        'opened': {},
+        'reverted': [],
+    }
+    json.dump(state, open(os.path.join(in_directory, 'state.json'), 'w'))
+
+    # the opened files are writable, the others read-only like after a sync
+    for number in range(min(in_openedcount, 5)):
+        open(LocalFileName(root, number), 'w').write('modified content\n')
+    for number in range(in_openedcount, in_openedcount + spare_files):
+        filename = LocalFileName(root, number)
+        open(filename, 'w').write('line\n' * (in_filesize / 5))
+        os.chmod(filename, stat.S_IREAD)
+
+    # the p4 of the PATH
+    fakep4 = os.path.join(benchmarks_dir, 'fakep4.py')
+    if(os.name == 'nt'):
+        open(os.path.join(in_directory, 'bin', 'p4.bat'), 'w').write('@"%s" "%s" %%*\r\n' % (in_python, fakep4))
+    else:
+        wrapper = os.path.join(in_directory, 'bin', 'p4')
+        open(wrapper, 'w').write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (in_python, fakep4))
+        os.chmod(wrapper, stat.S_IRWXU)
+    return root
+
+def MakeEnvironment(in_directory, in_latency, in_settings):
+    environment = dict(os.environ)
+    for name in ('P4CONFIG', 'P4PORT', 'P4CLIENT', 'P4USER', 'P4PASSWD', 'P4TICKETS'):
+        environment.pop(name, None)
+    environment['PATH'] = os.path.join(in_directory, 'bin') + os.pathsep + environment.get('PATH', '')
+    environment['FAKEP4_STATE'] = os.path.join(in_directory, 'state.json')
+    environment['FAKEP4_LOG'] = os.path.join(in_directory, 'p4.log')
+    environment['FAKEP4_LATENCY'] = str(in_latency)
+    # the revision cache and the temporary files of the plugin stay in the workspace of the run
+    for name in ('TMPDIR', 'TEMP', 'TMP'):
+        environment[name] = os.path.join(in_directory, 'tmp')
+    environment['PERFORCE_BENCHMARK_SETTINGS'] = json.dumps(in_settings)
+    return environment
+
+# Scenarios section
+# a scenario prepares the plugin (warm caches for instance) and returns the operation that is measured
+class FakeWindow(object):
+    def __init__(self):
+        self.viewlist = []
+
+    def views(self):
+        return self.viewlist
+
+    def active_view(self):
+        if(self.viewlist):
+            return self.viewlist[0]
+        return None
+
+    def show_quick_panel(self, in_items, in_callback):
+        pass
+
+class FakeView(object):
+    def __init__(self, in_window, in_filename):
+        self.owner = in_window
+        self.filename = in_filename
+        in_window.viewlist.append(self)
+
+    def file_name(self):
+        return self.filename
+
+    def is_dirty(self):
+        return True
+
+    def window(self):
+        return self.owner
+
+def CheckoutScenario(in_plugin, in_context, in_root, in_openedcount):
+    filename = LocalFileName(in_root, in_openedcount)
+    return lambda: in_plugin.Checkout(in_context, filename)
+
+def CheckoutWarmScenario(in_plugin, in_context, in_root, in_openedcount):
+    # the first checkout schedules the load of the opened files index, which is waited for here
+    in_plugin.Checkout(in_context, LocalFileName(in_root, in_openedcount + 1))
+    in_plugin.GetOpenedFilesIndex(in_context)
+    return CheckoutScenario(in_plugin, in_context, in_root, in_openedcount)
+
+def AutoCheckoutScenario(in_plugin, in_context, in_root, in_openedcount):
+    # 20 keystrokes in each of 5 read-only files followed by a "Save All"
+    in_plugin.GetOpenedFilesIndex(in_context)
+    window = FakeWindow()
+    views = [FakeView(window, LocalFileName(in_root, in_openedcount + number)) for number in range(5)]
+    listener = in_plugin.PerforceAutoCheckout()
+
+    def operation():
+        for keystroke in range(20):
+            for view in views:
+                listener.on_modified(view)
+        for view in views:
+            listener.on_pre_save(view)
+    return operation
+
+def ListCheckedOutScenario(in_plugin, in_context, in_root, in_openedcount):
+    return in_plugin.ListCheckedOutFilesThread(FakeWindow(), in_context).MakeCheckedOutFileList
+
+def ListCheckedOutWarmScenario(in_plugin, in_context, in_root, in_openedcount):
+    operation = ListCheckedOutScenario(in_plugin, in_context, in_root, in_openedcount)
+    operation()
+    return operation
+
+def GraphicalDiffScenario(in_plugin, in_context, in_root, in_openedcount):
+    folder, filename = os.path.split(LocalFileName(in_root, 0))
+    return in_plugin.GraphicalDiffThread(in_context, folder, filename, 'exit 0').run
+
+def GraphicalDiffRepeatScenario(in_plugin, in_context, in_root, in_openedcount):
+    operation = GraphicalDiffScenario(in_plugin, in_context, in_root, in_openedcount)
+    operation()
+    return operation
+
+def CreateChangelistScenario(in_plugin, in_context, in_root, in_openedcount):
+    return lambda: in_plugin.CreateChangelist(in_context, 'benchmark changelist')
+
+scenarios = [
+    ('checkout', CheckoutScenario),
+    ('checkout_warm', CheckoutWarmScenario),
+    ('auto_checkout', AutoCheckoutScenario),
+    ('list_checked_out', ListCheckedOutScenario),
+    ('list_checked_out_warm', ListCheckedOutWarmScenario),
+    ('graphical_diff', GraphicalDiffScenario),
+    ('graphical_diff_repeat', GraphicalDiffRepeatScenario),
+    ('create_changelist', CreateChangelistScenario),
+]
+
+# settings of the plugin for all the scenarios
+scenario_settings = {
+    'perforce_auto_checkout_on_modified': True,
+    'perforce_prefetch': False,
+    'perforce_warnings_enabled': False,
+}
+
+# Measurement section
+def PeakMemory():
+    # in megabytes, None where the resource module doesn't exist
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if(sys.platform == 'darwin'):
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def ReadSpawnLog(in_filename):
+    if(not os.path.exists(in_filename)):
+        return []
+    return open(in_filename).read().splitlines()
+
+def SpawnedCommands(in_lines):
+    # 'info', 'opened', ... of the logged command lines, without the global options
+    commands = []
+    for line in in_lines:
+        arguments = line.split()
+        while arguments and arguments[0].startswith('-'):
+            option = arguments.pop(0)
+            if(option in ('-x', '-c', '-u', '-p', '-P', '-d', '-C', '-H', '-z') and arguments):
+                arguments.pop(0)
+        if(arguments):
+            commands.append(arguments[0])
+    return commands
+
+def RunScenario(in_name, in_root, in_openedcount):
+    # runs in the child process, the result is printed as a line of JSON
+    sys.path.insert(0, os.path.join(benchmarks_dir, 'stubs'))
+    sys.path.insert(0, package_dir)
+    os.chdir(package_dir)
+
+    starttime = time.time()
+    import Perforce
+    importtime = time.time() - starttime
+
+    context = Perforce.WorkspaceContext(os.path.join(in_root, 'src'), 'Benchmark')
+    operation = dict(scenarios)[in_name](Perforce, context, in_root, in_openedcount)
+
+    logfile = os.environ['FAKEP4_LOG']
+    spawnsbefore = len(ReadSpawnLog(logfile))
+    memorybefore = PeakMemory()
+    starttime = time.time()
+    operation()
+    latency = time.time() - starttime
+    spawned = ReadSpawnLog(logfile)[spawnsbefore:]
+
+    result = {
+        'scenario': in_name,
+        'opened': in_openedcount,
+        'spawns': len(spawned),
+        'commands': SpawnedCommands(spawned),
+        'latency': latency,
+        'import': importtime,
+        'memory': PeakMemory(),
+        'memory_before': memorybefore,
+    }
+    sys.stdout.write('\n' + json.dumps(result) + '\n')
+    sys.stdout.flush()
+    # the plugin's worker threads never end
+    os._exit(0)
+
+def RunInChildProcess(in_options, in_name, in_openedcount):
+    directory = tempfile.mkdtemp(prefix='perforce_benchmark_')
+    try:
+        root = CreateWorkspace(directory, in_openedcount, in_options.filesize, in_options.python)
+        environment = MakeEnvironment(directory, in_options.latency, scenario_settings)
+        command = [in_options.python, os.path.abspath(__file__), '--run', in_name, '--root', root, '--opened', str(in_openedcount)]
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+        result, err = p.communicate()
+        lines = result.strip().splitlines()
+        if(p.returncode != 0 or not lines):
+            return None, err.strip() or result.strip()
+        return json.loads(lines[-1]), None
+    finally:
+        shutil.rmtree(directory, True)
+
+def Median(in_values):
+    values = sorted(in_values)
+    return values[len(values) / 2]
+
+def FormatMemory(in_value):
+    if(in_value is None):
+        return 'n/a'
+    return '%.1f' % in_value
+
+def FormatCommands(in_commands):
+    # 'opened x2, edit' for the report
+    counts = []
+    for command in in_commands:
+        if(counts and counts[-1][0] == command):
+            counts[-1][1] += 1
+        else:
+            counts.append([command, 1])
+    return ', '.join([count > 1 and '%s x%d' % (command, count) or command for command, count in counts])
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=','.join([str(size) for size in default_sizes]), help='comma separated numbers of opened files [%default]')
+    parser.add_option('--scenarios', default=','.join([name for name, scenario in scenarios]), help='comma separated scenarios [%default]')
+    parser.add_option('--latency', type='float', default=20, help='milliseconds every p4 call waits [%default]')
+    parser.add_option('--filesize', type='int', default=16384, help='size in bytes of the depot revisions [%default]')
+    parser.add_option('--repeat', type='int', default=1, help='runs of each scenario, the median latency is reported [%default]')
+    parser.add_option('--json', help='also write the results to this file')
+    parser.add_option('--python', default=sys.executable, help='interpreter of the plugin and of the fake p4 [%default]')
+    parser.add_option('--run', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--root', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--opened', type='int', help=optparse.SUPPRESS_HELP)
+    options, arguments = parser.parse_args()
+
+    if(options.run):
+        RunScenario(options.run, options.root, options.opened)
+        return 0
+
+    names = [name for name in options.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in dict(scenarios)]
+    if(unknown):
+        parser.error('unknown scenario(s): ' + ', '.join(unknown))
+    sizes = [int(size) for size in options.sizes.split(',') if size]
+
+    print '%-22s %8s %7s %11s %9s  %s' % ('scenario', 'opened', 'spawns', 'latency ms', 'peak MB', 'p4 commands')
+    results = []
+    failures = 0
+    for size in sizes:
+        for name in names:
+            runs = []
+            for run in range(options.repeat):
+                result, error = RunInChildProcess(options, name, size)
+                if(result is None):
+                    break
+                runs.append(result)
+            if(not runs):
+                failures += 1
+                print '%-22s %8d  failed: %s' % (name, size, error.splitlines()[-1])
+                continue
+
+            result = runs[0]
+            result['latency'] = Median([run['latency'] for run in runs])
+            results.append(result)
+            print '%-22s %8d %7d %11.1f %9s  %s' % (name, size, result['spawns'], result['latency'] * 1000, FormatMemory(result['memory']), FormatCommands(result['commands']))
+            sys.stdout.flush()
+
+    if(options.json):
+        json.dump({'latency': options.latency, 'filesize': options.filesize, 'results': results}, open(options.json, 'w'), indent=1)
+    if(failures):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
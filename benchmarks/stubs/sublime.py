@@ -0,0 +1,140 @@
+# Minimal stand-in for the sublime module of Sublime Text 2, enough to import Perforce.py outside of the editor
+# settings come from the package's Perforce.sublime-settings, overridden by the JSON in PERFORCE_BENCHMARK_SETTINGS
+import json
+import os
+
+package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def StripComments(in_text):
+    # the settings files use // comments which json doesn't accept, strings are kept as they are
+    output = []
+    position = 0
+    instring = False
+    while position < len(in_text):
+        character = in_text[position]
+        if(instring):
+            output.append(character)
+            if(character == '\\'):
+                output.append(in_text[position + 1])
+                position += 1
+            elif(character == '"'):
+                instring = False
+        elif(character == '"'):
+            instring = True
+            output.append(character)
+        elif(in_text[position:position + 2] == '//'):
+            while position < len(in_text) and in_text[position] != '\n':
+                position += 1
+            continue
+        else:
+            output.append(character)
+        position += 1
+    return ''.join(output)
+
+class Settings(object):
+    def __init__(self, in_values):
+        self.values = in_values
+        self.callbacks = {}
+
+    def get(self, in_key, in_default=None):
+        return self.values.get(in_key, in_default)
+
+    def set(self, in_key, in_value):
+        self.values[in_key] = in_value
+        for callback in self.callbacks.values():
+            callback()
+
+    def erase(self, in_key):
+        self.values.pop(in_key, None)
+
+    def has(self, in_key):
+        return in_key in self.values
+
+    def add_on_change(self, in_key, in_callback):
+        self.callbacks[in_key] = in_callback
+
+    def clear_on_change(self, in_key):
+        self.callbacks.pop(in_key, None)
+
+def LoadSettings():
+    values = json.loads(StripComments(open(os.path.join(package_dir, 'Perforce.sublime-settings')).read()))
+    overrides = os.environ.get('PERFORCE_BENCHMARK_SETTINGS')
+    if(overrides):
+        values.update(json.loads(overrides))
+    return Settings(values)
+
+settings = LoadSettings()
+
+def load_settings(in_name):
+    return settings
+
+def save_settings(in_name):
+    pass
+
+# callbacks are queued instead of running on a main thread, the benchmark decides when to run them
+timeouts = []
+
+def set_timeout(in_callback, in_delay):
+    timeouts.append((in_callback, in_delay))
+
+def run_timeouts(in_maxdelay):
+    # runs the queued callbacks that would have fired within in_maxdelay milliseconds, the periodic ones are left alone
+    ran = 0
+    while True:
+        due = [timeout for timeout in timeouts if timeout[1] <= in_maxdelay]
+        if(not due):
+            return ran
+        for timeout in due:
+            timeouts.remove(timeout)
+        for callback, delay in due:
+            callback()
+            ran += 1
+
+messages = []
+
+def status_message(in_message):
+    messages.append(in_message)
+
+def error_message(in_message):
+    messages.append(in_message)
+
+def message_dialog(in_message):
+    messages.append(in_message)
+
+def ok_cancel_dialog(in_message, in_ok_title=''):
+    messages.append(in_message)
+    return True
+
+def platform():
+    if(os.name == 'nt'):
+        return 'windows'
+    return 'linux'
+
+def arch():
+    return 'x64'
+
+def version():
+    return '2221'
+
+def packages_path():
+    return os.path.dirname(package_dir)
+
+def installed_packages_path():
+    return os.path.dirname(package_dir)
+
+def active_window():
+    return None
+
+def windows():
+    return []
+
+class Region(object):
+    def __init__(self, in_a, in_b):
+        self.a = in_a
+        self.b = in_b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
@@ -0,0 +1,14 @@
+# Minimal stand-in for the sublime_plugin module of Sublime Text 2
+class EventListener(object):
+    pass
+
+class ApplicationCommand(object):
+    pass
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view